@@ -1,46 +1,235 @@
 #!/home/hirosi/my_gemini_project/venv/bin/python
 # -*- coding: utf-8 -*- 
-# DESCRIPTION:ネオワールドサーガの物語をランダムに一つ選び、その続きをAIに執筆させてファイルに追記します。
+# DESCRIPTION:ネオワールドサーガの物語をランダムに一つ (バッチモードでは複数を並行して) 選び、その続きをAIに執筆させてファイルに追記します。
 
 import os
+import re
 import sys
+import json
 import random
-import glob
 import time
+import shutil
+import asyncio
+import hashlib
+import argparse
+import tempfile
+
+import gemini_client
+import pipeline_metrics
+import saga_manifest
 
-try:
-    import google.generativeai as genai
-except ImportError:
-    print("エラー: 'google-generativeai' ライブラリが見つかりません。", file=sys.stderr)
-    sys.exit(1)
 
 # --- 定数 ---
-PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-API_FILE_PATH = os.path.join(PROJECT_ROOT, "api")
 NWS_COLLECTION_ROOT = os.path.expanduser("~/neo_world_saga_collection/")
+# 要約モードでプロンプトにそのまま含める直近の節の数
+RECENT_SECTIONS = 3
+# 要約のサイドカーファイル (物語ファイルの隣に置く)
+SUMMARY_SUFFIX = ".summary.json"
+SUMMARY_MAX_CHARS = 2000
+# 追記のたびに入る区切り線 (---) で節を分ける
+SECTION_SEPARATOR_RE = re.compile(r'\n[ ]{0,3}---[ ]*\n')
+# バッチモード: 同時に執筆する物語の数と、1分あたりのリクエスト数の上限
+BATCH_CONCURRENCY = 4
+BATCH_REQUESTS_PER_MINUTE = 15
+
+# --- 要約 ---
+def split_story_sections(content: str) -> list[str]:
+    """物語を区切り線で節に分ける"""
+    return [section.strip() for section in SECTION_SEPARATOR_RE.split(content) if section.strip()]
+
+def hash_sections(sections: list[str]) -> str:
+    digest = hashlib.sha256()
+    for section in sections:
+        data = section.encode('utf-8')
+        digest.update(len(data).to_bytes(8, 'big'))
+        digest.update(data)
+    return digest.hexdigest()
+
+def summary_path_for(story_path: str) -> str:
+    return os.path.splitext(story_path)[0] + SUMMARY_SUFFIX
+
+def load_summary(story_path: str) -> dict | None:
+    try:
+        with open(summary_path_for(story_path), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def save_summary(story_path: str, summary: dict) -> None:
+    """要約をサイドカーファイルにアトミックに書き出す"""
+    path = summary_path_for(story_path)
+    try:
+        fd, temp_path = tempfile.mkstemp(prefix=".tmp_", suffix=SUMMARY_SUFFIX, dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"警告: 要約の保存に失敗しました: {e}", file=sys.stderr)
+
+def summary_prompt(story_path: str, sections: list[str]) -> tuple[str | None, str | None]:
+    """sections (直近の節を除いた前半部分) の要約について、(保存済みの要約, 要約を更新するプロンプト) のどちらかを返す。
+    サイドカーの要約が sections の先頭部分と一致していれば、新しく増えた節だけを要約に反映するプロンプトになる。"""
+    cached = load_summary(story_path)
+    if cached and cached.get("sections") == len(sections) and cached.get("sha256") == hash_sections(sections):
+        return cached["summary"], None
+
+    previous_summary = ""
+    new_sections = sections
+    if cached and 0 < cached.get("sections", 0) <= len(sections) \
+            and cached.get("sha256") == hash_sections(sections[:cached["sections"]]):
+        previous_summary = cached["summary"]
+        new_sections = sections[cached["sections"]:]
+
+    print(f"要約を更新中... (新しい節: {len(new_sections)} / {len(sections)})")
+    new_text = "\n\n---\n\n".join(new_sections)
+    return None, f"""
+あなたは長編SF小説の編集者です。
+以下の「これまでの要約」に「新しい本文」の内容を反映し、物語全体の要約を{SUMMARY_MAX_CHARS}字以内で書き直してください。
+登場人物、その関係、重要な出来事、未解決の伏線、世界設定を優先して残してください。
+出力は要約の本文のみとしてください。
+
+# これまでの要約
+{previous_summary or "（なし）"}
+
+# 新しい本文
+{new_text}
+"""
+
+def store_summary(story_path: str, sections: list[str], summary: str) -> str | None:
+    """生成された要約をサイドカーに保存して返す。空ならNone"""
+    summary = summary.strip()
+    if not summary:
+        return None
+    save_summary(story_path, {"sections": len(sections), "sha256": hash_sections(sections), "summary": summary})
+    return summary
+
+def update_rolling_summary(generate, story_path: str, sections: list[str]) -> str | None:
+    """sections の要約を返す。generate はプロンプトを受け取り文章を返す関数"""
+    cached, prompt = summary_prompt(story_path, sections)
+    if cached is not None:
+        return cached
+    try:
+        summary = generate(prompt)
+    except Exception as e:
+        print(f"警告: 要約の生成中にエラー: {e}", file=sys.stderr)
+        return None
+    return store_summary(story_path, sections, summary)
 
-# --- APIキー取得 ---
-def get_gemini_api_key() -> str | None:
-    if os.path.exists(API_FILE_PATH):
-        with open(API_FILE_PATH, 'r', encoding='utf-8') as f:
-            return f.read().strip()
-    return os.getenv("GEMINI_API_KEY")
+async def update_rolling_summary_async(generate, story_path: str, sections: list[str]) -> str | None:
+    """update_rolling_summary() のバッチモード版。generate はコルーチン関数"""
+    cached, prompt = summary_prompt(story_path, sections)
+    if cached is not None:
+        return cached
+    try:
+        summary = await generate(prompt)
+    except Exception as e:
+        print(f"警告: 要約の生成中にエラー: {e}", file=sys.stderr)
+        return None
+    return store_summary(story_path, sections, summary)
+
+def split_context(content: str, recent_sections: int | None) -> tuple[list[str], list[str]] | None:
+    """要約にする前半の節と、そのまま送る直近の節に分ける。要約を使わないならNone"""
+    if not recent_sections:
+        return None
+    sections = split_story_sections(content)
+    if len(sections) <= recent_sections:
+        return None
+    return sections[:-recent_sections], sections[-recent_sections:]
+
+def format_context(content: str, older: list[str], recent: list[str], summary: str | None) -> str:
+    """要約と直近の節から「既存の物語」を作る。要約がなければ全文を返す"""
+    if summary is None:
+        print("警告: 要約を使えないため、物語の全文を送信します。", file=sys.stderr)
+        return content
+    recent_text = "\n\n---\n\n".join(recent)
+    print(f"要約モード: {len(older)} 節を要約し、直近の {len(recent)} 節をそのまま送信します "
+          f"({len(content)} 字 → {len(summary) + len(recent_text)} 字)。")
+    return f"## これまでのあらすじ\n{summary}\n\n## 直近の本文\n{recent_text}"
+
+def build_story_context(generate, story_path: str, content: str, recent_sections: int | None) -> str:
+    """プロンプトに含める「既存の物語」を作る。
+    recent_sections が指定されていれば、それより前の節は要約に置き換える。"""
+    parts = split_context(content, recent_sections)
+    if parts is None:
+        return content
+    older, recent = parts
+    return format_context(content, older, recent, update_rolling_summary(generate, story_path, older))
+
+async def build_story_context_async(generate, story_path: str, content: str, recent_sections: int | None) -> str:
+    """build_story_context() のバッチモード版。generate はコルーチン関数"""
+    parts = split_context(content, recent_sections)
+    if parts is None:
+        return content
+    older, recent = parts
+    return format_context(content, older, recent, await update_rolling_summary_async(generate, story_path, older))
+
+# --- 執筆と追記 ---
+def build_continuation_prompt(story_context: str) -> str:
+    """続きを執筆させるプロンプトを作る"""
+    return f"""
+あなたは卓越したSF作家であり、既存の物語の続きを執筆する専門家です。
+以下の「既存の物語」を読み、その文体、登場人物の口調、物語の雰囲気を完全に維持したまま、自然で魅力的な「続きの物語」を執筆してください。
+
+# 指示
+- これまでの物語の流れを壊さないように、ごく自然な続きを執筆してください。
+- 出力は「続きの物語」の文章本体のみとし、余計な前置きや後書き（「はい、承知いたしました。続きを執筆します。」など）は一切含めないでください。
+- 新しい展開を少しだけ加えて、物語を前に進めてください。
+
+# 既存の物語
+{story_context}
+
+# 出力（続きの物語）
+"""
+
+def append_continuation(story_path: str, original_content: str, new_content: str) -> None:
+    """生成された続きを区切り線の後に追記する。
+    追記後の全文を一時ファイルに書いてから置き換えるので、途中で失敗しても元のファイルは壊れない。
+    ファイルの改行コード (CRLF/LF) はそのまま保つ。
+    読み込み後に物語が書き換えられていた場合は RuntimeError を送出する。"""
+    def read_raw() -> str:
+        with open(story_path, 'r', encoding='utf-8', newline='') as f:
+            return f.read()
+
+    raw_content = read_raw()
+    # original_content は改行を \n に揃えて読み込んだもの
+    if raw_content.replace('\r\n', '\n').replace('\r', '\n') != original_content:
+        raise RuntimeError("執筆中に物語ファイルが変更されました")
+    newline = '\r\n' if '\r\n' in raw_content else '\n'
+    # 元のファイルの末尾が改行で終わっていることを確認し、適切にスペースを空ける
+    separator = ('' if original_content.endswith('\n') else '\n') + '\n\n---\n\n'
+    story_dir = os.path.dirname(story_path)
+    fd, temp_path = tempfile.mkstemp(prefix=".tmp_", suffix=".md", dir=story_dir)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+            f.write(raw_content + (separator + new_content).replace('\r\n', '\n').replace('\n', newline))
+        shutil.copymode(story_path, temp_path)
+        if read_raw() != raw_content:
+            raise RuntimeError("執筆中に物語ファイルが変更されました")
+        os.replace(temp_path, story_path)
+        pipeline_metrics.record_file(story_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
 
 # --- メイン処理 ---
-def main():
-    """物語の続きを自動執筆するメイン関数"""
+@pipeline_metrics.instrument("append_saga_story")
+def main(recent_sections: int | None = None):
+    """物語の続きを自動執筆するメイン関数。
+    recent_sections を指定すると、直近の節以外は要約 (サイドカーにキャッシュ) にしてプロンプトを一定の大きさに抑える。"""
     print("--- ネオワールドサーガ 自動執筆開始 ---")
 
     # 1. APIキーの確認
-    api_key = get_gemini_api_key()
+    api_key = gemini_client.get_api_key()
     if not api_key:
         print("エラー: Gemini APIキーが取得できませんでした。", file=sys.stderr)
         return False
 
     # 2. 執筆対象の物語をランダムに選択
     try:
-        search_path = os.path.join(NWS_COLLECTION_ROOT, "**", "*.md")
-        files = glob.glob(search_path, recursive=True)
+        files = saga_manifest.load_manifest(NWS_COLLECTION_ROOT).paths()
         if not files:
             print(f"警告: ディレクトリに物語ファイルが見つかりません: {NWS_COLLECTION_ROOT}", file=sys.stderr)
             return False
@@ -56,28 +245,16 @@ def main():
         return False
 
     # 3. AIへの指示プロンプトを構築
-    prompt = f"""
-あなたは卓越したSF作家であり、既存の物語の続きを執筆する専門家です。
-以下の「既存の物語」を読み、その文体、登場人物の口調、物語の雰囲気を完全に維持したまま、自然で魅力的な「続きの物語」を執筆してください。
-
-# 指示
-- これまでの物語の流れを壊さないように、ごく自然な続きを執筆してください。
-- 出力は「続きの物語」の文章本体のみとし、余計な前置きや後書き（「はい、承知いたしました。続きを執筆します。」など）は一切含めないでください。
-- 新しい展開を少しだけ加えて、物語を前に進めてください。
+    def generate(text: str) -> str:
+        return gemini_client.generate(text, api_key=api_key, label="append_saga_story")
 
-# 既存の物語
-{original_content}
-
-# 出力（続きの物語）
-"""
+    story_context = build_story_context(generate, selected_file, original_content, recent_sections)
+    prompt = build_continuation_prompt(story_context)
 
     # 4. Gemini APIを呼び出して続きを生成
     print("AIが物語の続きを執筆中...")
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content(prompt)
-        new_content = response.text
+        new_content = gemini_client.generate(prompt, api_key=api_key, label="append_saga_story")
     except Exception as e:
         print(f"エラー: Gemini APIの呼び出し中にエラー: {e}", file=sys.stderr)
         return False
@@ -89,12 +266,7 @@ def main():
     # 5. 元のファイルに生成された続きを追記
     print("生成された物語をファイルに追記中...")
     try:
-        with open(selected_file, 'a', encoding='utf-8') as f:
-            # 元のファイルの末尾が改行で終わっていることを確認し、適切にスペースを空ける
-            if not original_content.endswith('\n'):
-                f.write('\n')
-            f.write('\n\n---\n\n') # 新しいセクションとして区切り線を入れる
-            f.write(new_content)
+        append_continuation(selected_file, original_content, new_content)
     except Exception as e:
         print(f"エラー: ファイルへの追記中にエラー: {e}", file=sys.stderr)
         return False
@@ -104,8 +276,113 @@ def main():
     return True
 
 
+# --- バッチモード ---
+class RateLimiter:
+    """1分あたりのリクエスト数を超えないよう、リクエストの開始時刻を等間隔に並べる"""
+
+    def __init__(self, requests_per_minute: float):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute > 0 else 0.0
+        self._next_time = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_time)
+            self._next_time = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+async def extend_story_async(generate, story_path: str, recent_sections: int | None) -> tuple[bool, str]:
+    """1つの物語の続きを執筆して追記する。(成功したか, メッセージ) を返す"""
+    try:
+        with open(story_path, 'r', encoding='utf-8') as f:
+            original_content = f.read()
+        story_context = await build_story_context_async(generate, story_path, original_content, recent_sections)
+        new_content = await generate(build_continuation_prompt(story_context))
+        if not new_content.strip():
+            return True, "空のコンテンツが生成されたため追記をスキップしました"
+        append_continuation(story_path, original_content, new_content)
+        return True, f"{len(new_content)} 字を追記しました"
+    except Exception as e:
+        return False, f"エラー: {e}"
+
+async def extend_stories_async(story_paths: list[str], api_key: str, recent_sections: int | None,
+                               concurrency: int, requests_per_minute: float, endpoint: str) -> list[tuple[str, bool, str]]:
+    """複数の物語を、同時実行数と1分あたりのリクエスト数を制限しながら並行して執筆する"""
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    limiter = RateLimiter(requests_per_minute)
+
+    async def generate(prompt: str) -> str:
+        await limiter.acquire()
+        return await gemini_client.generate_async(prompt, api_key=api_key, endpoint=endpoint, label="append_saga_story")
+
+    async def run(story_path: str) -> tuple[str, bool, str]:
+        async with semaphore:
+            ok, message = await extend_story_async(generate, story_path, recent_sections)
+        status = "完了" if ok else "失敗"
+        print(f"  [{status}] {os.path.basename(story_path)}: {message}", file=sys.stdout if ok else sys.stderr)
+        return story_path, ok, message
+
+    try:
+        return await asyncio.gather(*(run(path) for path in story_paths))
+    finally:
+        await gemini_client.close_async()
+
+@pipeline_metrics.instrument("append_saga_story_batch")
+def main_batch(count: int, recent_sections: int | None = None, concurrency: int = BATCH_CONCURRENCY,
+               requests_per_minute: float = BATCH_REQUESTS_PER_MINUTE,
+               endpoint: str = gemini_client.GEMINI_API_ENDPOINT) -> bool:
+    """ランダムに選んだ count 個の物語の続きを並行して執筆する。すべて成功すればTrue"""
+    print(f"--- ネオワールドサーガ 自動執筆開始 (バッチ: {count} 作品, 同時 {concurrency}, {requests_per_minute}回/分) ---")
+    if not gemini_client.AIOHTTP_AVAILABLE:
+        print("エラー: バッチモードには 'aiohttp' ライブラリが必要です (pip install aiohttp)。", file=sys.stderr)
+        return False
+    api_key = gemini_client.get_api_key()
+    if not api_key:
+        print("エラー: Gemini APIキーが取得できませんでした。", file=sys.stderr)
+        return False
+
+    files = saga_manifest.load_manifest(NWS_COLLECTION_ROOT).paths()
+    if not files:
+        print(f"警告: ディレクトリに物語ファイルが見つかりません: {NWS_COLLECTION_ROOT}", file=sys.stderr)
+        return False
+    selected_files = random.sample(files, min(count, len(files)))
+
+    start = time.perf_counter()
+    results = asyncio.run(extend_stories_async(
+        selected_files, api_key, recent_sections, concurrency, requests_per_minute, endpoint
+    ))
+    succeeded = sum(1 for _, ok, _ in results if ok)
+    print(f"--- ネオワールドサーガ 自動執筆完了: 成功 {succeeded} / {len(results)} 作品 "
+          f"({time.perf_counter() - start:.1f}秒) ---")
+    gemini_client.print_call_stats()
+    return succeeded == len(results)
+
 if __name__ == "__main__":
-    if main():
+    parser = argparse.ArgumentParser(description="ネオワールドサーガの物語をランダムに選び、続きを追記します。")
+    parser.add_argument("--recent-sections", type=int, nargs="?", const=RECENT_SECTIONS, default=None,
+                        help=f"直近N節だけを全文で送り、それより前は要約にする (値を省略すると {RECENT_SECTIONS})")
+    parser.add_argument("--batch", type=int, metavar="N", help="N個の物語を並行して執筆する")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY,
+                        help=f"バッチモードで同時に執筆する物語の数 (デフォルト: {BATCH_CONCURRENCY})")
+    parser.add_argument("--rpm", type=float, default=BATCH_REQUESTS_PER_MINUTE,
+                        help=f"バッチモードの1分あたりのリクエスト数の上限 (デフォルト: {BATCH_REQUESTS_PER_MINUTE}, 0で無制限)")
+    parser.add_argument("--endpoint", default=gemini_client.GEMINI_API_ENDPOINT,
+                        help="バッチモードで使うAPIのエンドポイント (fake_gemini_server.py の偽サーバーで試す場合など)")
+    args = parser.parse_args()
+    import saga_daemon
+    # 常駐プロセスが同じジョブを実行中なら重ねて実行しない (同じ物語に同時に追記しないように)
+    with saga_daemon.job_lock("append_story") as acquired:
+        if not acquired:
+            print("エラー: 物語の追記が別のプロセス (常駐プロセスなど) で実行中です。", file=sys.stderr)
+            sys.exit(1)
+        if args.batch:
+            ok = main_batch(args.batch, args.recent_sections, args.concurrency, args.rpm, args.endpoint)
+        else:
+            gemini_client.require_genai()
+            ok = main(args.recent_sections)
+    if ok:
         sys.exit(0)
     else:
         sys.exit(1)
@@ -1,15 +1,26 @@
 #!/home/hirosi/my_gemini_project/venv/bin/python
 # -*- coding: utf-8 -*-
-# DESCRIPTION: テキストからImageMagickとffmpegを直接使用して、テキストが順番に表示される動画を生成します。
+# DESCRIPTION: テキストからPillow (またはImageMagick) とffmpegを使用して、テキストが順番に表示される動画を生成します。
 
 import os
 import sys
 import re
+import argparse
+import contextlib
 import subprocess
 import tempfile
 import shutil
+import time
+import threading
+import unicodedata
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
 
+import disk_cache
+import pipeline_metrics
+import text_rasterizer
+
 # --- 定数 ---
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 VIDEO_OUTPUT_DIR = os.path.join(PROJECT_ROOT, "scripts", "generated_videos")
@@ -17,8 +28,174 @@ VIDEO_OUTPUT_DIR = os.path.join(PROJECT_ROOT, "scripts", "generated_videos")
 FONT = "Takao-Pゴシック"
 WIDTH, HEIGHT = 1280, 720
 FPS = 24
+# シーン画像を並列生成するプロセス数 (CPUコア数に合わせる)
+RENDER_WORKERS = os.cpu_count() or 1
+# 生成済みシーン画像のキャッシュ (テキスト・フォント・解像度が同じなら再利用する)
+FRAME_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+FRAME_CACHE = disk_cache.DiskCache("frames", FRAME_CACHE_MAX_BYTES, suffix=".png")
+# シーンごとにエンコードした動画セグメントのキャッシュ (追記された物語は新しいシーンだけをエンコードする)
+SEGMENT_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+SEGMENT_CACHE = disk_cache.DiskCache("segments", SEGMENT_CACHE_MAX_BYTES, suffix=".mp4")
+# セグメントは並列にエンコードするため、1プロセスあたりのスレッドは1つにする
+# (ストリームコピーで連結できるよう、全セグメントで同じ設定を使うこと)
+SEGMENT_THREAD_ARGS = ['-threads', '1']
+# エンコードプロファイル (フレームレート, GOP, レート制御, +faststart の組み合わせ)
+# 各シーンは3秒以上の静止画なので、"still" はフレームレートを落としてGOPを長く取る
+ENCODING_PROFILES = {
+    # 従来どおりの設定 (FPS=24, x264の既定値相当)
+    "standard": {
+        "fps": FPS,
+        "video_args": ['-preset', 'medium', '-crf', '23', '-g', '250'],
+        "faststart": False,
+    },
+    # 静止画向け: 低フレームレート、長いGOP、stillimageチューニング
+    "still": {
+        "fps": 6,
+        "video_args": ['-preset', 'medium', '-tune', 'stillimage', '-crf', '26', '-g', '60', '-keyint_min', '6'],
+        "faststart": True,
+    },
+    # Web配信向け: 2秒ごとのキーフレームと上限付きビットレートで、moovを先頭に置く
+    "web": {
+        "fps": FPS,
+        "video_args": ['-preset', 'veryfast', '-tune', 'stillimage', '-crf', '23',
+                       '-maxrate', '2M', '-bufsize', '4M', '-g', str(FPS * 2), '-keyint_min', str(FPS * 2)],
+        "faststart": True,
+    },
+    # 保存用: 高画質・低圧縮速度
+    "archive": {
+        "fps": FPS,
+        "video_args": ['-preset', 'slow', '-crf', '18', '-g', str(FPS * 10)],
+        "faststart": False,
+    },
+}
+DEFAULT_PROFILE = "standard"
+# MP4にそのまま格納できる圧縮済み音声 (generate_narration_audio の出力など) は再エンコードしない
+STREAM_COPY_AUDIO_EXTENSIONS = ('.m4a', '.aac', '.opus')
+# 動画の組み立て方式
+# "concat": 無音動画を経由する2パス, "stream": パイプ経由の1パス,
+# "segments": シーンごとのセグメントをキャッシュし、ストリームコピーで連結
+# "subtitles": 画像を作らず、字幕ファイルを黒背景に焼き込む
+# "softsubs": 画像を作らず、字幕を切り替え可能な字幕トラックとして格納する
+ASSEMBLY_MODES = ("concat", "stream", "segments", "subtitles", "softsubs")
+SUBTITLE_MODES = ("subtitles", "softsubs")
+SUBTITLE_FONTSIZE = 48
+SUBTITLE_MARGIN = 20
+DEFAULT_ASSEMBLY_MODE = "concat"
+
+# シーン描画のワーカープロセスの起動方式。常駐プロセス (saga_daemon) のような複数スレッドのプロセスからforkすると、
+# 他のスレッドが持っていたロックを子プロセスが引き継いでしまうため、forkserver (なければspawn) で起動する
+RENDER_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+# forkserverに読み込ませておくモジュール (ワーカーは読み込み済み・フォント解決済みの状態からforkされる)
+RENDER_PRELOAD_MODULES = ["render_preload"]
+
+# 同時に実行するffmpeg/convertプロセス数の上限 (バッチ実行時に set_process_limit() で共有セマフォを渡す)
+_process_slots = None
+# main() の終了時にキャッシュを上限サイズまで削除するか
+# (バッチ実行中は、並行して組み立て中の物語が使うフレームやセグメントを消さないよう止める)
+_evict_on_exit = True
+
+# シーン画像の描画方式 ("pillow": プロセス内ラスタライザ, "imagemagick": convertコマンド)
+# Pillowや日本語フォントが使えない環境では自動的にImageMagickにフォールバックする
+RENDER_BACKEND = "pillow"
+
+def active_render_backend() -> str:
+    """実際に使用する描画方式を返す"""
+    if RENDER_BACKEND == "pillow" and text_rasterizer.get_rasterizer(FONT):
+        return "pillow"
+    return "imagemagick"
+
+def render_context():
+    """シーン描画のワーカープロセスを起動するmultiprocessingのコンテキストを返す。
+    ワーカーと共有するセマフォも、このコンテキストで作ること"""
+    context = multiprocessing.get_context(RENDER_START_METHOD)
+    if RENDER_START_METHOD == "forkserver":
+        context.set_forkserver_preload(RENDER_PRELOAD_MODULES)
+    return context
+
+def set_process_limit(slots) -> None:
+    """ffmpeg/convertの同時実行数を制限するセマフォを設定する (Noneで無制限)。
+    render_context() で作ったセマフォを渡せば、シーン描画のワーカープロセスとも共有される。"""
+    global _process_slots
+    _process_slots = slots
+
+def set_cache_eviction(enabled: bool) -> None:
+    """main() の終了時にフレーム・セグメントキャッシュを削除するかを設定する"""
+    global _evict_on_exit
+    _evict_on_exit = enabled
+
+def evict_caches() -> tuple[int, int]:
+    """フレームとセグメントのキャッシュを古いものから上限サイズまで削除し、(フレーム, セグメント) の削除件数を返す"""
+    return FRAME_CACHE.evict(), SEGMENT_CACHE.evict()
+
+def process_slot():
+    """外部コマンドを1つ実行する間だけ保持する実行枠"""
+    return _process_slots if _process_slots is not None else contextlib.nullcontext()
+
+def run_tool(command: list[str]) -> subprocess.CompletedProcess:
+    """実行枠を確保してからffmpeg/convertを実行する (失敗時は CalledProcessError)"""
+    with process_slot():
+        try:
+            result = subprocess.run(command, check=True, capture_output=True, text=True, encoding='utf-8')
+        except subprocess.CalledProcessError as e:
+            pipeline_metrics.record_exit_code(e.returncode)
+            raise
+    pipeline_metrics.record_exit_code(result.returncode)
+    return result
+
+def settings_fingerprint(mode: str, profile: str) -> str:
+    """出力動画の見た目とエンコードに影響する設定のハッシュを返す (再生成が必要かの判定用)"""
+    encoding_profile = ENCODING_PROFILES[profile]
+    return disk_cache.make_key(mode, active_render_backend(), FONT, WIDTH, HEIGHT, SUBTITLE_FONTSIZE,
+                               encoding_profile["fps"], *video_encode_args(encoding_profile),
+                               *container_args(encoding_profile))
 
-def generate_image_for_scene(scene_text: str, output_path: str) -> bool:
+def video_encode_args(profile: dict) -> list[str]:
+    """プロファイルに従ったH.264エンコードの引数を返す"""
+    return ['-c:v', 'libx264', *profile["video_args"], '-pix_fmt', 'yuv420p']
+
+def container_args(profile: dict) -> list[str]:
+    """最終出力のMP4に付けるオプションを返す"""
+    return ['-movflags', '+faststart'] if profile["faststart"] else []
+
+def audio_codec_args(audio_filepath: str) -> list[str]:
+    """音声の合成方法を返す。MP4にそのまま格納できる圧縮済み音声は再エンコードせずにコピーする"""
+    if os.path.splitext(audio_filepath)[1].lower() in STREAM_COPY_AUDIO_EXTENSIONS:
+        return ['-c:a', 'copy']
+    return ['-c:a', 'aac']
+
+def split_scenes(story_content: str) -> list[str]:
+    """テキストをシーン（空行を除いた段落）に分割する"""
+    return [p.strip() for p in story_content.split('\n') if p.strip()]
+
+def scene_duration(scene_text: str) -> float:
+    """シーンの表示秒数 (文字数に比例、最低3秒)"""
+    return max(3.0, len(scene_text) / 15.0)
+
+def scene_frame_counts(scenes_text: list[str], fps: int) -> list[int]:
+    """各シーンのフレーム数。累積時刻で丸めるので、シーン数が増えても丸め誤差が蓄積しない"""
+    counts = []
+    elapsed = 0.0
+    written_frames = 0
+    for scene_text in scenes_text:
+        elapsed += scene_duration(scene_text)
+        counts.append(round(elapsed * fps) - written_frames)
+        written_frames += counts[-1]
+    return counts
+
+def generate_image_for_scene(scene_text: str, output_path: str, backend: str | None = None) -> bool:
+    """1つのシーンのテキスト画像を生成する"""
+    if (backend or active_render_backend()) == "pillow":
+        try:
+            rasterizer = text_rasterizer.get_rasterizer(FONT)
+            image = rasterizer.render_caption(scene_text, WIDTH-100, HEIGHT-100)
+            text_rasterizer.save_png(image, output_path)
+            return True
+        except Exception as e:
+            print(f"エラー: Pillowでの画像生成に失敗しました: {e}", file=sys.stderr)
+            return False
+    return generate_image_for_scene_imagemagick(scene_text, output_path)
+
+def generate_image_for_scene_imagemagick(scene_text: str, output_path: str) -> bool:
     """ImageMagickを使って、1つのシーンのテキスト画像を生成する"""
     command = [
         'convert',
@@ -31,7 +208,7 @@ def generate_image_for_scene(scene_text: str, output_path: str) -> bool:
         output_path
     ]
     try:
-        subprocess.run(command, check=True, capture_output=True, text=True, encoding='utf-8')
+        run_tool(command)
         return True
     except Exception as e:
         print(f"エラー: ImageMagickでの画像生成に失敗しました: {e}", file=sys.stderr)
@@ -39,15 +216,400 @@ def generate_image_for_scene(scene_text: str, output_path: str) -> bool:
             print(e.stderr, file=sys.stderr)
         return False
 
+def _render_scene_job(index: int, scene_text: str, output_path: str, backend: str) -> tuple[int, bool, float]:
+    """プロセスプール内で1シーンを描画し、(シーン番号, 成否, 所要秒数) を返す"""
+    start = time.perf_counter()
+    ok = generate_image_for_scene(scene_text, output_path, backend)
+    return index, ok, time.perf_counter() - start
+
+def frame_cache_key(scene_text: str, backend: str) -> str:
+    """シーン画像のキャッシュキー (テキストと描画設定のハッシュ) を返す"""
+    return disk_cache.make_key(f"{backend}-caption", scene_text, FONT, WIDTH, HEIGHT)
+
+def render_scenes_parallel(scenes_text: list[str], max_workers: int | None = None) -> list[str] | None:
+    """全シーンの画像をフレームキャッシュから取得し、ないものだけをプロセスプールで並列生成する。
+    シーン順に並んだ画像パスのリストを返す。1つでも失敗した場合は未着手のジョブを取り消してNoneを返す。"""
+    backend = active_render_backend()
+    keys = [frame_cache_key(scene_text, backend) for scene_text in scenes_text]
+    image_paths = [None] * len(scenes_text)
+
+    # キャッシュにないシーンだけを描画対象にする (同じ段落の重複は1回だけ描画)
+    pending = {}
+    for i, key in enumerate(keys):
+        if key in pending:
+            continue
+        cached_path = FRAME_CACHE.get(key)
+        if cached_path:
+            image_paths[i] = cached_path
+        else:
+            pending[key] = i
+    print(f"フレームキャッシュ: ヒット {FRAME_CACHE.hits} / ミス {FRAME_CACHE.misses}")
+
+    start = time.perf_counter()
+    scene_seconds = 0.0
+    if pending:
+        workers = max(1, min(max_workers or RENDER_WORKERS, len(pending)))
+        print(f"{len(pending)} シーンの画像を {workers} プロセスで並列生成中 (描画方式: {backend})...")
+        temp_paths = {key: FRAME_CACHE.temp_path(key) for key in pending}
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=render_context(),
+                                       initializer=set_process_limit, initargs=(_process_slots,))
+        try:
+            futures = {
+                executor.submit(_render_scene_job, i, scenes_text[i], temp_paths[key], backend): key
+                for key, i in pending.items()
+            }
+            for future in as_completed(futures):
+                index, ok, elapsed = future.result()
+                if not ok:
+                    print(f"シーン {index+1} の画像生成に失敗したため、中止します。", file=sys.stderr)
+                    return None
+                key = futures[future]
+                image_paths[index] = FRAME_CACHE.commit(key, temp_paths.pop(key))
+                pipeline_metrics.record_file(image_paths[index])
+                scene_seconds += elapsed
+                print(f"  - シーン {index+1}/{len(scenes_text)}: {elapsed:.2f}秒")
+        finally:
+            # 失敗時は未着手のシーンを取り消し、実行中のconvertの終了を待つ
+            executor.shutdown(wait=True, cancel_futures=True)
+            for temp_path in temp_paths.values():
+                FRAME_CACHE.discard(temp_path)
+
+    # 重複した段落は最初に描画した画像を共有する
+    for i, key in enumerate(keys):
+        if image_paths[i] is None:
+            image_paths[i] = FRAME_CACHE.path_for(key)
+
+    total = time.perf_counter() - start
+    print(f"シーン画像の生成完了: 合計 {total:.2f}秒 (各シーンの処理時間の合計 {scene_seconds:.2f}秒)")
+    return image_paths
+
+def encode_concat(scenes_text: list[str], image_files: list[str], temp_dir: str,
+                  audio_filepath: str | None, output_path: str, profile: dict) -> None:
+    """concat demuxerで無音動画を作り、2回目のffmpegで音声を合成する (2パス方式)"""
+    # ffmpegのconcat demuxer用の入力ファイルリストをシーン順に作成
+    ffmpeg_input_file = os.path.join(temp_dir, "ffmpeg_input.txt")
+    with open(ffmpeg_input_file, 'w', encoding='utf-8') as f:
+        for scene_text, image_path in zip(scenes_text, image_files):
+            duration = scene_duration(scene_text)
+            f.write(f"file '{image_path}'\n")
+            f.write(f"duration {duration}\n")
+
+    # 最後の画像のエントリを追記（concat demuxerの仕様）
+    if image_files:
+        with open(ffmpeg_input_file, 'a', encoding='utf-8') as f:
+            f.write(f"file '{image_files[-1]}'\n")
+
+    # ffmpegで静止画から無音動画を生成
+    silent_video_path = os.path.join(temp_dir, "silent_video.mp4")
+    ffmpeg_cmd1 = [
+        'ffmpeg',
+        '-f', 'concat',
+        '-safe', '0',
+        '-i', ffmpeg_input_file,
+        '-vf', f'fps={profile["fps"]},format=yuv420p',
+        *video_encode_args(profile),
+        '-y',
+        silent_video_path
+    ]
+    print("ffmpegで無音動画を生成中...")
+    run_tool(ffmpeg_cmd1)
+
+    # ffmpegで音声と無音動画を合成
+    ffmpeg_cmd2 = [
+        'ffmpeg',
+        '-i', silent_video_path,
+    ]
+    if audio_filepath and os.path.exists(audio_filepath):
+        print(f"音声ファイル {audio_filepath} を合成中...")
+        ffmpeg_cmd2.extend(['-i', audio_filepath])
+        # -shortest オプションで、短い方のストリームの長さに合わせる
+        ffmpeg_cmd2.extend(['-c:v', 'copy', *audio_codec_args(audio_filepath), '-shortest'])
+    else:
+        print("音声なしで動画を最終処理中...")
+        ffmpeg_cmd2.extend(['-c', 'copy'])
+
+    ffmpeg_cmd2.extend([*container_args(profile), '-y', output_path])
+
+    run_tool(ffmpeg_cmd2)
+
+def encode_stream(scenes_text: list[str], image_files: list[str],
+                  audio_filepath: str | None, output_path: str, profile: dict) -> None:
+    """1つのffmpegの標準入力にフレームを流し込み、映像のエンコードと音声の合成を1パスで行う。
+    中間のPNGや無音動画は一時ディレクトリに書き出さない。"""
+    if text_rasterizer.PIL_AVAILABLE:
+        # 各シーンのPNGを1度だけデコードし、生のグレースケールフレームとして送る
+        frame_width, frame_height = WIDTH - 100, HEIGHT - 100
+        input_args = ['-f', 'rawvideo', '-pix_fmt', 'gray', '-s', f'{frame_width}x{frame_height}']
+    else:
+        input_args = ['-f', 'image2pipe', '-c:v', 'png']
+
+    fps = profile["fps"]
+    ffmpeg_cmd = ['ffmpeg', '-loglevel', 'error', *input_args, '-framerate', str(fps), '-i', 'pipe:0']
+    has_audio = bool(audio_filepath and os.path.exists(audio_filepath))
+    if has_audio:
+        print(f"音声ファイル {audio_filepath} を同時に合成します。")
+        ffmpeg_cmd.extend(['-i', audio_filepath, *audio_codec_args(audio_filepath), '-shortest'])
+    ffmpeg_cmd.extend(['-vf', 'format=yuv420p', *video_encode_args(profile), *container_args(profile), '-y', output_path])
+
+    print("ffmpegにフレームをストリーミングしてエンコード中...")
+    # 上限を超えてffmpegが同時に起動しないよう、エンコードの間は実行枠を確保する
+    with process_slot():
+        process = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        # 標準エラーのパイプが詰まってffmpegが止まらないよう、別スレッドで読み続ける
+        stderr_chunks = []
+        stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)
+        stderr_reader.start()
+
+        try:
+            for frame_count, image_path in zip(scene_frame_counts(scenes_text, fps), image_files):
+                if text_rasterizer.PIL_AVAILABLE:
+                    with text_rasterizer.Image.open(image_path) as image:
+                        frame = image.convert('L').tobytes()
+                else:
+                    with open(image_path, 'rb') as f:
+                        frame = f.read()
+                for _ in range(frame_count):
+                    process.stdin.write(frame)
+            process.stdin.close()
+        except BrokenPipeError:
+            # ffmpegが途中で終了した。原因は下で終了コードとエラー出力から報告する
+            pass
+        except BaseException:
+            # フレームの読み込み失敗や中断では、入力を待ち続けるffmpegを止めてから送出する
+            process.kill()
+            raise
+        finally:
+            returncode = process.wait()
+            stderr_reader.join()
+    pipeline_metrics.record_exit_code(returncode)
+
+    if returncode != 0:
+        stderr_text = b"".join(chunk for chunk in stderr_chunks if chunk).decode('utf-8', errors='replace')
+        raise subprocess.CalledProcessError(returncode, ffmpeg_cmd, stderr=stderr_text)
+
+def _encode_segment_job(image_path: str, frame_count: int, output_path: str, profile: dict) -> None:
+    """1シーンの静止画を指定フレーム数の動画セグメントにエンコードする"""
+    command = [
+        'ffmpeg', '-loglevel', 'error',
+        '-loop', '1', '-framerate', str(profile["fps"]), '-i', image_path,
+        '-frames:v', str(frame_count),
+        *video_encode_args(profile), *SEGMENT_THREAD_ARGS,
+        '-f', 'mp4', '-y', output_path
+    ]
+    run_tool(command)
+
+def plan_segments(scenes_text: list[str], profile: dict) -> tuple[list[str], list[str | None], dict[str, tuple[int, int]]]:
+    """各シーンのセグメントをキャッシュから探す。
+    (シーン順のキャッシュキー, キャッシュ済みのパス (なければNone), {未キャッシュのキー: (シーン番号, フレーム数)}) を返す"""
+    backend = active_render_backend()
+    segment_paths = [None] * len(scenes_text)
+    keys = []
+    pending = {}
+    for i, (scene_text, frame_count) in enumerate(zip(scenes_text, scene_frame_counts(scenes_text, profile["fps"]))):
+        key = disk_cache.make_key("segment", frame_cache_key(scene_text, backend), frame_count, profile["fps"],
+                                  *video_encode_args(profile), *SEGMENT_THREAD_ARGS)
+        keys.append(key)
+        if key in pending:
+            continue
+        cached_path = SEGMENT_CACHE.get(key)
+        if cached_path:
+            segment_paths[i] = cached_path
+        else:
+            pending[key] = (i, frame_count)
+    print(f"セグメントキャッシュ: ヒット {SEGMENT_CACHE.hits} / ミス {SEGMENT_CACHE.misses}")
+    return keys, segment_paths, pending
+
+def encode_segments(plan: tuple[list[str], list[str | None], dict[str, tuple[int, int]]], image_files: dict[int, str],
+                    temp_dir: str, audio_filepath: str | None, output_path: str, profile: dict,
+                    max_workers: int | None = None) -> None:
+    """plan_segments でキャッシュになかったセグメントだけをエンコードしてから、ストリームコピーで連結する。
+    image_files は未キャッシュのシーンの {シーン番号: 画像パス}。音声の合成も連結と同じffmpegで行う。"""
+    keys, segment_paths, pending = plan
+    segment_paths = list(segment_paths)
+    if pending:
+        workers = max(1, min(max_workers or RENDER_WORKERS, len(pending)))
+        print(f"{len(pending)} シーンのセグメントを {workers} 並列でエンコード中...")
+        temp_paths = {key: SEGMENT_CACHE.temp_path(key) for key in pending}
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            futures = {
+                executor.submit(pipeline_metrics.bind(_encode_segment_job), image_files[i], frame_count,
+                                temp_paths[key], profile): key
+                for key, (i, frame_count) in pending.items()
+            }
+            for future in as_completed(futures):
+                # 1つでも失敗すれば例外が送出され、未着手のセグメントは取り消される
+                future.result()
+                key = futures[future]
+                segment_paths[pending[key][0]] = SEGMENT_CACHE.commit(key, temp_paths.pop(key))
+                pipeline_metrics.record_file(segment_paths[pending[key][0]])
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            for temp_path in temp_paths.values():
+                SEGMENT_CACHE.discard(temp_path)
+
+    # 重複した段落は最初にエンコードしたセグメントを共有する
+    for i, key in enumerate(keys):
+        if segment_paths[i] is None:
+            segment_paths[i] = SEGMENT_CACHE.path_for(key)
+
+    segment_list_file = os.path.join(temp_dir, "segments.txt")
+    with open(segment_list_file, 'w', encoding='utf-8') as f:
+        for segment_path in segment_paths:
+            f.write(f"file '{segment_path}'\n")
+
+    ffmpeg_cmd = ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', segment_list_file]
+    if audio_filepath and os.path.exists(audio_filepath):
+        print(f"セグメントを連結し、音声ファイル {audio_filepath} を合成中...")
+        ffmpeg_cmd.extend(['-i', audio_filepath, '-c:v', 'copy', *audio_codec_args(audio_filepath), '-shortest'])
+    else:
+        print("セグメントを連結中...")
+        ffmpeg_cmd.extend(['-c', 'copy'])
+    ffmpeg_cmd.extend([*container_args(profile), '-y', output_path])
+    run_tool(ffmpeg_cmd)
+
+def _ass_timestamp(seconds: float) -> str:
+    """秒数をASSの時刻表記 (H:MM:SS.cc) に変換する"""
+    centiseconds = round(seconds * 100)
+    hours, centiseconds = divmod(centiseconds, 360000)
+    minutes, centiseconds = divmod(centiseconds, 6000)
+    secs, centiseconds = divmod(centiseconds, 100)
+    return f"{hours}:{minutes:02d}:{secs:02d}.{centiseconds:02d}"
+
+def _ass_escape(text: str) -> str:
+    """ASSの制御文字として解釈されないようにテキストをエスケープする"""
+    return text.replace('\\', '＼').replace('{', '｛').replace('}', '｝')
+
+def wrap_subtitle_text(scene_text: str, max_width: int, rasterizer=None) -> list[str]:
+    """字幕の1シーンを max_width に収まる行に分割する。
+    和文には空白がなく、libunibreakなしのlibassでは改行位置が見つからないため、
+    シーン画像と同じ text_rasterizer の折り返しで事前に改行しておく。
+    ラスタライザがなければ、全角文字をフォントサイズ、半角文字をその半分の幅と見積もって折り返す"""
+    if rasterizer:
+        return rasterizer.wrap(scene_text, SUBTITLE_FONTSIZE, max_width)
+    lines, line, line_width = [], "", 0.0
+    for char in scene_text:
+        char_width = SUBTITLE_FONTSIZE if unicodedata.east_asian_width(char) in ('W', 'F', 'A') else SUBTITLE_FONTSIZE / 2
+        if line and line_width + char_width > max_width:
+            lines.append(line)
+            line, line_width = "", 0.0
+        line += char
+        line_width += char_width
+    if line or not lines:
+        lines.append(line)
+    return lines
+
+def write_ass_subtitles(scenes_text: list[str], output_path: str, font_name: str, rasterizer=None) -> float:
+    """シーンを画像と同じ表示時間で並べたASS字幕ファイルを書き出し、全体の秒数を返す"""
+    frame_width, frame_height = WIDTH - 100, HEIGHT - 100
+    # スタイルの左右の余白 (MarginL, MarginR) を除いた幅で折り返す
+    wrap_width = frame_width - SUBTITLE_MARGIN * 2
+    lines = [
+        "[Script Info]",
+        "ScriptType: v4.00+",
+        f"PlayResX: {frame_width}",
+        f"PlayResY: {frame_height}",
+        "WrapStyle: 0",
+        "",
+        "[V4+ Styles]",
+        "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, "
+        "Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, "
+        "Alignment, MarginL, MarginR, MarginV, Encoding",
+        # Alignment 5 = 画面中央 (caption: の -gravity center に合わせる)
+        f"Style: Default,{font_name},{SUBTITLE_FONTSIZE},&H00FFFFFF,&H00FFFFFF,&H00000000,&H00000000,"
+        f"0,0,0,0,100,100,0,0,1,0,0,5,{SUBTITLE_MARGIN},{SUBTITLE_MARGIN},{SUBTITLE_MARGIN},1",
+        "",
+        "[Events]",
+        "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text",
+    ]
+    elapsed = 0.0
+    for scene_text in scenes_text:
+        start = elapsed
+        elapsed += scene_duration(scene_text)
+        text = "\\N".join(_ass_escape(line) for line in wrap_subtitle_text(scene_text, wrap_width, rasterizer))
+        lines.append(f"Dialogue: 0,{_ass_timestamp(start)},{_ass_timestamp(elapsed)},Default,,0,0,0,,{text}")
+
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+    return elapsed
+
+def encode_subtitles(scenes_text: list[str], temp_dir: str, audio_filepath: str | None,
+                     output_path: str, profile: dict, burn_in: bool = True) -> None:
+    """シーンを字幕ファイルにし、黒背景の上に1回のフィルタ処理で焼き込む (burn_in=False なら字幕トラックとして格納)。
+    シーン画像の描画は行わない。"""
+    font_file = text_rasterizer.resolve_font_file(FONT)
+    rasterizer = text_rasterizer.get_rasterizer(FONT)
+    # libassはフォントファミリー名で検索するので、解決できればフォントファイルの名前を使う
+    font_name = rasterizer.font(SUBTITLE_FONTSIZE).getname()[0] if rasterizer else FONT.replace('-', ' ')
+
+    subtitle_path = os.path.join(temp_dir, "scenes.ass")
+    total_seconds = write_ass_subtitles(scenes_text, subtitle_path, font_name, rasterizer)
+    print(f"{len(scenes_text)} シーンを字幕ファイルに変換しました ({total_seconds:.1f}秒)。")
+
+    frame_width, frame_height = WIDTH - 100, HEIGHT - 100
+    ffmpeg_cmd = [
+        'ffmpeg',
+        '-f', 'lavfi', '-i', f'color=c=black:s={frame_width}x{frame_height}:r={profile["fps"]}:d={total_seconds:.2f}',
+    ]
+    input_count = 1
+    if not burn_in:
+        ffmpeg_cmd.extend(['-i', subtitle_path])
+        input_count += 1
+    has_audio = bool(audio_filepath and os.path.exists(audio_filepath))
+    if has_audio:
+        ffmpeg_cmd.extend(['-i', audio_filepath])
+
+    ffmpeg_cmd.extend(['-map', '0:v'])
+    if burn_in:
+        subtitle_filter = f"subtitles=filename='{subtitle_path}'"
+        if font_file:
+            subtitle_filter += f":fontsdir='{os.path.dirname(font_file)}'"
+        ffmpeg_cmd.extend(['-vf', f'{subtitle_filter},format=yuv420p'])
+    else:
+        ffmpeg_cmd.extend(['-map', '1:s', '-c:s', 'mov_text'])
+    if has_audio:
+        print(f"音声ファイル {audio_filepath} を同時に合成します。")
+        ffmpeg_cmd.extend(['-map', f'{input_count}:a', *audio_codec_args(audio_filepath), '-shortest'])
+    ffmpeg_cmd.extend([*video_encode_args(profile), *container_args(profile), '-y', output_path])
+
+    print("ffmpegで字幕付き動画を生成中...")
+    run_tool(ffmpeg_cmd)
+
+def _dir_size(path: str) -> int:
+    """ディレクトリ以下のファイルサイズの合計を返す"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
 # --- メイン処理 ---
-def main(story_content: str, story_name: str, audio_filepath: str = None) -> str | None:
-    """ImageMagickとffmpegを使って動画を生成する"""
+@pipeline_metrics.instrument("assemble_video")
+def main(story_content: str, story_name: str, audio_filepath: str = None,
+         mode: str = DEFAULT_ASSEMBLY_MODE, output_path: str | None = None,
+         profile: str = DEFAULT_PROFILE, render_workers: int | None = None) -> tuple[str | None, dict]:
+    """テキスト画像とffmpegを使って動画を生成し、(動画のパス (失敗時はNone), 今回の計測値) を返す。
+    計測値は {"temp_bytes": 一時ディレクトリへの書き込み量} (並行して呼ばれても実行ごとに別の辞書)。
+    mode: "concat" (無音動画を経由する2パス) / "stream" (パイプ経由の1パス) /
+          "segments" (シーンごとのセグメントをキャッシュして連結) /
+          "subtitles" (字幕を焼き込み) / "softsubs" (字幕トラックとして格納)
+    profile: ENCODING_PROFILES のキー
+    render_workers: シーン描画・セグメントエンコードの並列数 (省略時は RENDER_WORKERS)"""
+    run_stats = {}
     print("--- ImageMagick/ffmpeg 動画組み立てツール ---")
     os.makedirs(VIDEO_OUTPUT_DIR, exist_ok=True)
 
     if not story_content or not story_name:
         print("エラー: 物語のコンテンツと名前が必要です。", file=sys.stderr)
-        return None
+        return None, run_stats
+    if mode not in ASSEMBLY_MODES:
+        print(f"エラー: 不明な組み立てモードです: {mode} (選択肢: {', '.join(ASSEMBLY_MODES)})", file=sys.stderr)
+        return None, run_stats
+    if profile not in ENCODING_PROFILES:
+        print(f"エラー: 不明なエンコードプロファイルです: {profile} (選択肢: {', '.join(ENCODING_PROFILES)})", file=sys.stderr)
+        return None, run_stats
+    encoding_profile = ENCODING_PROFILES[profile]
+    print(f"組み立てモード: {mode}, エンコードプロファイル: {profile}")
 
     # 一時ディレクトリを作成
     temp_dir = tempfile.mkdtemp(prefix="video_gen_")
@@ -55,100 +617,188 @@ def main(story_content: str, story_name: str, audio_filepath: str = None) -> str
 
     try:
         # 1. テキストをシーン（段落）に分割
-        scenes_text = [p.strip() for p in story_content.split('\n') if p.strip()]
+        scenes_text = split_scenes(story_content)
         if not scenes_text:
             print("エラー: 動画にするテキスト内容がありません。", file=sys.stderr)
-            return None
+            return None, run_stats
 
-        # 2. ffmpegのconcat demuxer用の入力ファイルリストを作成
-        ffmpeg_input_file = os.path.join(temp_dir, "ffmpeg_input.txt")
-        image_files = []
-        with open(ffmpeg_input_file, 'w', encoding='utf-8') as f:
-            for i, scene_text in enumerate(scenes_text):
-                image_path = os.path.join(temp_dir, f"scene_{i:03d}.png")
-                
-                if not generate_image_for_scene(scene_text, image_path):
-                    print(f"シーン {i+1} の画像生成に失敗したため、中止します。")
-                    return None
-                
-                duration = max(3.0, len(scene_text) / 15.0)
-                f.write(f"file '{image_path}'\n")
-                f.write(f"duration {duration}\n")
-                image_files.append(image_path)
-        
-        # 最後の画像のエントリを追記（concat demuxerの仕様）
-        if image_files:
-            with open(ffmpeg_input_file, 'a', encoding='utf-8') as f:
-                f.write(f"file '{image_files[-1]}'\n")
-
-        # 3. ffmpegで静止画から無音動画を生成
-        silent_video_path = os.path.join(temp_dir, "silent_video.mp4")
-        ffmpeg_cmd1 = [
-            'ffmpeg',
-            '-f', 'concat',
-            '-safe', '0',
-            '-i', ffmpeg_input_file,
-            '-vf', f'fps={FPS},format=yuv420p',
-            '-y',
-            silent_video_path
-        ]
-        print("ffmpegで無音動画を生成中...")
-        subprocess.run(ffmpeg_cmd1, check=True, capture_output=True, text=True, encoding='utf-8')
-
-        # 4. ffmpegで音声と無音動画を合成
-        # ファイル名を安全にするための正規表現を修正
-        safe_story_name = re.sub(r'[^\w._ -]', '_', story_name.replace('.md', ''))
-        final_output_filename = f"assembled_video_{safe_story_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.mp4"
-        final_output_path = os.path.join(VIDEO_OUTPUT_DIR, final_output_filename)
-        
-        ffmpeg_cmd2 = [
-            'ffmpeg',
-            '-i', silent_video_path,
-        ]
-        if audio_filepath and os.path.exists(audio_filepath):
-            print(f"音声ファイル {audio_filepath} を合成中...")
-            ffmpeg_cmd2.extend(['-i', audio_filepath])
-            # -shortest オプションで、短い方のストリームの長さに合わせる
-            ffmpeg_cmd2.extend(['-c:v', 'copy', '-c:a', 'aac', '-shortest'])
+        # 2. 出力先を決定
+        if output_path:
+            final_output_path = output_path
+        else:
+            # ファイル名を安全にするための正規表現を修正
+            safe_story_name = re.sub(r'[^\w._ -]', '_', story_name.replace('.md', ''))
+            final_output_filename = f"assembled_video_{safe_story_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.mp4"
+            final_output_path = os.path.join(VIDEO_OUTPUT_DIR, final_output_filename)
+
+        # 字幕モードではシーン画像を作らずに、字幕ファイルから直接動画を作る
+        if mode in SUBTITLE_MODES:
+            with pipeline_metrics.stage("ffmpeg_encode", mode=mode, profile=profile):
+                encode_subtitles(scenes_text, temp_dir, audio_filepath, final_output_path, encoding_profile,
+                                 burn_in=(mode == "subtitles"))
+            print(f"動画ファイルの生成が完了しました: {final_output_path}")
+            return final_output_path, run_stats
+
+        # 3. シーン画像を並列生成 (セグメントモードでは、セグメントがキャッシュにないシーンだけ)
+        if mode == "segments":
+            segment_plan = plan_segments(scenes_text, encoding_profile)
+            render_indices = [i for i, _ in segment_plan[2].values()]
         else:
-            print("音声なしで動画を最終処理中...")
-            ffmpeg_cmd2.extend(['-c', 'copy'])
-        
-        ffmpeg_cmd2.extend(['-y', final_output_path])
+            render_indices = list(range(len(scenes_text)))
+        with pipeline_metrics.stage("render_scenes", scenes=len(render_indices), backend=active_render_backend()) as metrics:
+            image_files = render_scenes_parallel([scenes_text[i] for i in render_indices], render_workers)
+            metrics.ok = image_files is not None
+        if image_files is None:
+            return None, run_stats
 
-        subprocess.run(ffmpeg_cmd2, check=True, capture_output=True, text=True, encoding='utf-8')
+        # 4. ffmpegで動画をエンコードし、音声を合成
+        with pipeline_metrics.stage("ffmpeg_encode", mode=mode, profile=profile):
+            if mode == "stream":
+                encode_stream(scenes_text, image_files, audio_filepath, final_output_path, encoding_profile)
+            elif mode == "segments":
+                encode_segments(segment_plan, dict(zip(render_indices, image_files)), temp_dir, audio_filepath,
+                                final_output_path, encoding_profile, render_workers)
+            else:
+                encode_concat(scenes_text, image_files, temp_dir, audio_filepath, final_output_path, encoding_profile)
 
         print(f"動画ファイルの生成が完了しました: {final_output_path}")
-        return final_output_path
+        return final_output_path, run_stats
 
     except Exception as e:
         print(f"エラー: 動画生成のパイプライン中にエラーが発生しました: {e}", file=sys.stderr)
         if hasattr(e, 'stderr'):
             print("--- STDERR ---", file=sys.stderr)
             print(e.stderr, file=sys.stderr)
-        return None
+        return None, run_stats
     finally:
         # 一時ディレクトリをクリーンアップ
-        print(f"一時ディレクトリを削除: {temp_dir}")
+        run_stats["temp_bytes"] = _dir_size(temp_dir)
+        print(f"一時ディレクトリを削除: {temp_dir} ({run_stats['temp_bytes'] / 1024 / 1024:.1f} MB)")
         shutil.rmtree(temp_dir)
+        # 今回使ったフレームは最新扱いなので、古いものから上限サイズまで削除される
+        stats = FRAME_CACHE.save_stats()
+        removed = FRAME_CACHE.evict() if _evict_on_exit else 0
+        print(f"フレームキャッシュ累計: ヒット {stats['hits']} / ミス {stats['misses']} (削除 {removed} 件)")
+        if mode == "segments":
+            stats = SEGMENT_CACHE.save_stats()
+            removed = SEGMENT_CACHE.evict() if _evict_on_exit else 0
+            print(f"セグメントキャッシュ累計: ヒット {stats['hits']} / ミス {stats['misses']} (削除 {removed} 件)")
         print("--- 全処理完了 ---")
 
-if __name__ == "__main__":
-    if len(sys.argv) > 1:
+def benchmark_assembly_modes(story_content: str, audio_filepath: str | None = None) -> None:
+    """同じ物語を各組み立てモードで動画化し、所要時間と一時ディレクトリへの書き込み量を比較する。
+    フレームは事前にキャッシュへ描画しておき、エンコード部分だけを比較する。"""
+    scenes_text = split_scenes(story_content)
+    if not scenes_text or not render_scenes_parallel(scenes_text):
+        print("エラー: ベンチマーク用のシーン画像を用意できませんでした。", file=sys.stderr)
+        return
+    output_dir = tempfile.mkdtemp(prefix="assembly_bench_")
+    results = {}
+    try:
+        for mode in ASSEMBLY_MODES:
+            output_path = os.path.join(output_dir, f"{mode}.mp4")
+            start = time.perf_counter()
+            video_path, run_stats = main(story_content, "benchmark.md", audio_filepath, mode=mode, output_path=output_path)
+            if not video_path:
+                print(f"{mode}: 組み立てに失敗したためスキップします。")
+                continue
+            results[mode] = (time.perf_counter() - start, run_stats.get("temp_bytes", 0))
+    finally:
+        shutil.rmtree(output_dir)
+
+    print(f"--- 組み立てモード比較 ({len(scenes_text)} シーン) ---")
+    for mode, (seconds, temp_bytes) in results.items():
+        print(f"{mode}: {seconds:.2f}秒, 一時ファイル {temp_bytes / 1024 / 1024:.1f} MB")
+    if "concat" in results and "stream" in results:
+        print(f"速度比: stream は concat の {results['concat'][0] / results['stream'][0]:.2f} 倍です。")
+
+def compare_encoding_profiles(story_content: str, audio_filepath: str | None = None,
+                              mode: str = DEFAULT_ASSEMBLY_MODE) -> None:
+    """基準となる物語を各エンコードプロファイルで動画化し、エンコード時間と出力サイズを比較する。
+    フレームは事前にキャッシュへ描画しておき、エンコード部分だけを比較する。"""
+    scenes_text = split_scenes(story_content)
+    if not scenes_text or (mode not in SUBTITLE_MODES and not render_scenes_parallel(scenes_text)):
+        print("エラー: 比較用のシーン画像を用意できませんでした。", file=sys.stderr)
+        return
+    output_dir = tempfile.mkdtemp(prefix="profile_bench_")
+    results = {}
+    try:
+        for profile in ENCODING_PROFILES:
+            output_path = os.path.join(output_dir, f"{profile}.mp4")
+            start = time.perf_counter()
+            if not main(story_content, "benchmark.md", audio_filepath, mode=mode, output_path=output_path, profile=profile)[0]:
+                print(f"{profile}: エンコードに失敗したためスキップします。")
+                continue
+            results[profile] = (time.perf_counter() - start, os.path.getsize(output_path))
+    finally:
+        shutil.rmtree(output_dir)
+
+    print(f"--- エンコードプロファイル比較 ({len(scenes_text)} シーン, モード: {mode}) ---")
+    for profile, (seconds, size) in results.items():
+        print(f"{profile}: {seconds:.2f}秒, {size / 1024 / 1024:.2f} MB")
+
+def benchmark_render_backends(story_content: str) -> None:
+    """同じ物語の全シーンを各描画方式で順番に描画し、1フレームあたりの処理時間を比較する"""
+    scenes_text = split_scenes(story_content)
+    if not scenes_text:
+        print("エラー: ベンチマークするテキスト内容がありません。", file=sys.stderr)
+        return
+    print(f"--- 描画方式ベンチマーク ({len(scenes_text)} シーン, キャッシュ不使用) ---")
+    results = {}
+    for backend in ("pillow", "imagemagick"):
+        if backend == "pillow" and not text_rasterizer.get_rasterizer(FONT):
+            print("pillow: 利用できないためスキップします。")
+            continue
+        temp_dir = tempfile.mkdtemp(prefix="render_bench_")
         try:
-            story_file = sys.argv[1]
-            story_name = os.path.basename(story_file)
-            audio_file = sys.argv[2] if len(sys.argv) > 2 else None
-            with open(story_file, 'r', encoding='utf-8') as f:
-                content = f.read()
-            
-            if main(content, story_name, audio_file):
-                sys.exit(0)
+            start = time.perf_counter()
+            for i, scene_text in enumerate(scenes_text):
+                if not generate_image_for_scene(scene_text, os.path.join(temp_dir, f"scene_{i:03d}.png"), backend):
+                    break
             else:
-                sys.exit(1)
-        except Exception as e:
-            print(f"エラー: 実行中にエラーが発生しました: {e}", file=sys.stderr)
+                results[backend] = (time.perf_counter() - start) / len(scenes_text)
+                print(f"{backend}: 1フレームあたり {results[backend] * 1000:.1f} ms")
+                continue
+            print(f"{backend}: 描画に失敗したためスキップします。")
+        finally:
+            shutil.rmtree(temp_dir)
+    if len(results) == 2:
+        print(f"速度比: pillow は imagemagick の {results['imagemagick'] / results['pillow']:.1f} 倍高速です。")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="テキストが順番に表示される動画を生成します。")
+    parser.add_argument("story_filepath", help="物語のMarkdownファイル")
+    parser.add_argument("audio_filepath", nargs="?", help="合成する音声ファイル")
+    parser.add_argument("--mode", choices=ASSEMBLY_MODES, default=DEFAULT_ASSEMBLY_MODE,
+                        help="動画の組み立て方式")
+    parser.add_argument("--profile", choices=list(ENCODING_PROFILES), default=DEFAULT_PROFILE,
+                        help="エンコードプロファイル")
+    parser.add_argument("--compare-profiles", action="store_true",
+                        help="各エンコードプロファイルで動画を作り、エンコード時間と出力サイズを比較する")
+    parser.add_argument("--benchmark-render", action="store_true",
+                        help="動画は作らず、PillowとImageMagickの描画速度を比較する")
+    parser.add_argument("--benchmark-modes", action="store_true",
+                        help="各組み立て方式で動画を作り、所要時間と一時ファイル量を比較する")
+    args = parser.parse_args()
+    try:
+        story_file = args.story_filepath
+        story_name = os.path.basename(story_file)
+        with open(story_file, 'r', encoding='utf-8') as f:
+            content = f.read()
+
+        if args.benchmark_render:
+            benchmark_render_backends(content)
+            sys.exit(0)
+        if args.compare_profiles:
+            compare_encoding_profiles(content, args.audio_filepath, args.mode)
+            sys.exit(0)
+        if args.benchmark_modes:
+            benchmark_assembly_modes(content, args.audio_filepath)
+            sys.exit(0)
+        if main(content, story_name, args.audio_filepath, mode=args.mode, profile=args.profile)[0]:
+            sys.exit(0)
+        else:
             sys.exit(1)
-    else:
-        print("使用法: python assemble_video.py <story_filepath> [audio_filepath]", file=sys.stderr)
+    except Exception as e:
+        print(f"エラー: 実行中にエラーが発生しました: {e}", file=sys.stderr)
         sys.exit(1)
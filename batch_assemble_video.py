@@ -0,0 +1,219 @@
+#!/home/hirosi/my_gemini_project/venv/bin/python
+# -*- coding: utf-8 -*-
+# DESCRIPTION: ディレクトリまたはマニフェストに含まれる物語をまとめて動画化します。最新の動画はスキップします。
+
+import os
+import sys
+import re
+import json
+import time
+import argparse
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    import resource # CPU使用率の表示にのみ使用
+    RESOURCE_AVAILABLE = True
+except ImportError:
+    RESOURCE_AVAILABLE = False
+
+# 外部スクリプトをインポート
+script_dir = os.path.dirname(os.path.abspath(__file__))
+if script_dir not in sys.path:
+    sys.path.append(script_dir)
+
+import assemble_video
+
+# --- 定数 ---
+BATCH_OUTPUT_DIR = os.path.join(assemble_video.VIDEO_OUTPUT_DIR, "batch")
+# 同時に組み立てる物語の数と、全体で同時に動かすffmpeg/convertの数
+DEFAULT_WORKERS = max(1, (os.cpu_count() or 1) // 2)
+DEFAULT_MAX_PROCESSES = os.cpu_count() or 1
+STAMP_SUFFIX = ".stamp.json"
+
+# --- ヘルパー関数 ---
+def load_jobs(source: str, default_audio: str | None) -> list[dict]:
+    """ディレクトリ (配下の *.md) またはマニフェストから、組み立てるジョブのリストを作る。
+    マニフェストはJSON配列 ([{"story": ..., "audio": ...}] または パスの配列) か、
+    1行に「物語パス[タブ音声パス]」を書いたテキストファイル。"""
+    jobs = []
+    if os.path.isdir(source):
+        for root, _, files in os.walk(source):
+            for name in files:
+                if name.endswith(".md"):
+                    jobs.append({"story": os.path.join(root, name), "audio": default_audio})
+        jobs.sort(key=lambda job: job["story"])
+        return jobs
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    with open(source, 'r', encoding='utf-8') as f:
+        text = f.read()
+    if source.endswith(".json"):
+        for entry in json.loads(text):
+            if isinstance(entry, str):
+                entry = {"story": entry}
+            jobs.append({"story": entry["story"], "audio": entry.get("audio", default_audio)})
+    else:
+        for line in text.splitlines():
+            if not line.strip() or line.startswith('#'):
+                continue
+            story, _, audio = line.partition('\t')
+            jobs.append({"story": story.strip(), "audio": audio.strip() or default_audio})
+
+    # マニフェストからの相対パスを解決する
+    for job in jobs:
+        for field in ("story", "audio"):
+            if job[field] and not os.path.isabs(job[field]):
+                job[field] = os.path.join(base_dir, os.path.expanduser(job[field]))
+    return jobs
+
+def output_path_for(story_path: str, output_dir: str) -> str:
+    """物語ごとに固定の出力パスを返す (タイムスタンプを付けないので再実行時に上書き・スキップできる)"""
+    safe_story_name = re.sub(r'[^\w._ -]', '_', os.path.basename(story_path).replace('.md', ''))
+    path_hash = hashlib.sha1(os.path.abspath(story_path).encode('utf-8')).hexdigest()[:8]
+    return os.path.join(output_dir, f"assembled_video_{safe_story_name}_{path_hash}.mp4")
+
+def build_stamp(job: dict, content: str, mode: str, profile: str) -> dict:
+    """出力動画がどの入力と設定から作られたかを記録するスタンプを作る"""
+    audio = job["audio"]
+    audio_state = None
+    if audio and os.path.exists(audio):
+        st = os.stat(audio)
+        audio_state = [os.path.abspath(audio), st.st_size, st.st_mtime]
+    return {
+        "story_sha256": hashlib.sha256(content.encode('utf-8')).hexdigest(),
+        "audio": audio_state,
+        "settings": assemble_video.settings_fingerprint(mode, profile),
+    }
+
+def is_up_to_date(output_path: str, stamp: dict) -> bool:
+    """出力動画が存在し、スタンプが今回の入力・設定と一致すればTrue"""
+    if not os.path.exists(output_path):
+        return False
+    try:
+        with open(output_path + STAMP_SUFFIX, 'r', encoding='utf-8') as f:
+            return json.load(f) == stamp
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+
+def write_stamp(output_path: str, stamp: dict) -> None:
+    """スタンプを動画の隣にアトミックに書き出す"""
+    stamp_path = output_path + STAMP_SUFFIX
+    fd, temp_path = tempfile.mkstemp(prefix=".tmp_", suffix=".json", dir=os.path.dirname(stamp_path))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(stamp, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, stamp_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+def assemble_job(job: dict, output_dir: str, mode: str, profile: str, force: bool,
+                 render_workers: int | None = None) -> str:
+    """1つの物語を組み立てる。"assembled" / "skipped" / "failed" のいずれかを返す"""
+    story_path = job["story"]
+    with open(story_path, 'r', encoding='utf-8') as f:
+        content = f.read()
+
+    output_path = output_path_for(story_path, output_dir)
+    stamp = build_stamp(job, content, mode, profile)
+    if not force and is_up_to_date(output_path, stamp):
+        print(f"スキップ (最新): {story_path}")
+        return "skipped"
+
+    result, _ = assemble_video.main(content, os.path.basename(story_path), job["audio"], mode=mode,
+                                    output_path=output_path, profile=profile, render_workers=render_workers)
+    if not result:
+        return "failed"
+    write_stamp(output_path, stamp)
+    return "assembled"
+
+def _cpu_seconds() -> float | None:
+    """このプロセスと、終了済みの子孫プロセスが使ったCPU時間の合計 (resource がなければNone)"""
+    if not RESOURCE_AVAILABLE:
+        return None
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+# --- メイン処理 ---
+def main(source: str, default_audio: str | None = None, workers: int = DEFAULT_WORKERS,
+         max_processes: int = DEFAULT_MAX_PROCESSES, mode: str = assemble_video.DEFAULT_ASSEMBLY_MODE,
+         profile: str = assemble_video.DEFAULT_PROFILE, output_dir: str = BATCH_OUTPUT_DIR,
+         force: bool = False) -> bool:
+    """物語をまとめて動画化し、スループットを表示する。全件成功 (またはスキップ) ならTrue"""
+    print("--- 動画一括組み立てツール ---")
+    try:
+        jobs = load_jobs(source, default_audio)
+    except Exception as e:
+        print(f"エラー: 物語リストの読み込みに失敗しました: {e}", file=sys.stderr)
+        return False
+    if not jobs:
+        print(f"エラー: 組み立てる物語が見つかりません: {source}", file=sys.stderr)
+        return False
+    os.makedirs(output_dir, exist_ok=True)
+
+    # 全ワーカー・全描画プロセスで共有する、ffmpeg/convertの同時実行枠
+    assemble_video.set_process_limit(assemble_video.render_context().BoundedSemaphore(max_processes))
+    # 並行する物語が参照中のキャッシュを消さないよう、キャッシュの削除は全件の終了後に1回だけ行う
+    assemble_video.set_cache_eviction(False)
+    # 物語ごとのシーン描画プールがCPUを奪い合わないよう、1物語あたりのプロセス数を割り当てる
+    render_workers = max(1, (os.cpu_count() or 1) // workers)
+    print(f"{len(jobs)} 件の物語を {workers} 並列で組み立てます "
+          f"(外部プロセス上限: {max_processes}, 描画プロセス/物語: {render_workers})")
+
+    results = {"assembled": 0, "skipped": 0, "failed": 0}
+    start_wall = time.perf_counter()
+    start_cpu = _cpu_seconds()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(assemble_job, job, output_dir, mode, profile, force, render_workers): job for job in jobs}
+            for future in as_completed(futures):
+                story_path = futures[future]["story"]
+                try:
+                    status = future.result()
+                except Exception as e:
+                    print(f"エラー: {story_path} の組み立て中にエラー: {e}", file=sys.stderr)
+                    status = "failed"
+                results[status] += 1
+                if status == "failed":
+                    print(f"失敗: {story_path}", file=sys.stderr)
+    finally:
+        assemble_video.set_process_limit(None)
+        assemble_video.set_cache_eviction(True)
+        removed_frames, removed_segments = assemble_video.evict_caches()
+        print(f"キャッシュを整理しました (フレーム {removed_frames} 件, セグメント {removed_segments} 件を削除)")
+
+    wall = time.perf_counter() - start_wall
+    cpu_count = os.cpu_count() or 1
+    stories_per_minute = results["assembled"] / (wall / 60) if wall > 0 else 0.0
+    print("\n--- 一括組み立て結果 ---")
+    print(f"組み立て: {results['assembled']} 件, スキップ: {results['skipped']} 件, 失敗: {results['failed']} 件")
+    print(f"所要時間: {wall:.1f}秒, スループット: {stories_per_minute:.2f} 物語/分")
+    if start_cpu is not None:
+        cpu = _cpu_seconds() - start_cpu
+        utilization = cpu / (wall * cpu_count) * 100 if wall > 0 else 0.0
+        print(f"CPU時間: {cpu:.1f}秒, CPU使用率: {utilization:.1f}% ({cpu_count} コア)")
+    return results["failed"] == 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="物語をまとめて動画化します。")
+    parser.add_argument("source", help="物語ディレクトリ、またはマニフェスト (.json / テキスト)")
+    parser.add_argument("--audio", help="マニフェストで指定がない物語に使う音声ファイル")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="同時に組み立てる物語の数")
+    parser.add_argument("--max-processes", type=int, default=DEFAULT_MAX_PROCESSES,
+                        help="全体で同時に実行するffmpeg/convertの数")
+    parser.add_argument("--mode", choices=assemble_video.ASSEMBLY_MODES, default=assemble_video.DEFAULT_ASSEMBLY_MODE)
+    parser.add_argument("--profile", choices=list(assemble_video.ENCODING_PROFILES), default=assemble_video.DEFAULT_PROFILE)
+    parser.add_argument("--output-dir", default=BATCH_OUTPUT_DIR)
+    parser.add_argument("--force", action="store_true", help="最新の動画も作り直す")
+    args = parser.parse_args()
+
+    ok = main(args.source, args.audio, max(1, args.workers), max(1, args.max_processes), args.mode,
+              args.profile, args.output_dir, args.force)
+    sys.exit(0 if ok else 1)
@@ -5,48 +5,25 @@
 import os
 import sys
 import datetime
-import feedparser
 import re # reモジュールをインポート
-try:
-    import google.generativeai as genai
-except ImportError:
-    print("エラー: 'google-generativeai' ライブラリが見つかりません。", file=sys.stderr)
-    print("以下のコマンドでインストールしてください:", file=sys.stderr)
-    print("pip install google-generativeai", file=sys.stderr)
-    sys.exit(1)
+import argparse
+
+import gemini_client
 
 
 # --- パスとURL設定 ---
-PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-API_FILE_PATH = os.path.join(PROJECT_ROOT, "api")
 DEFAULT_HTML_PATH = "/var/www/html/public/ai_business_homepage.html"
 NHK_RSS_FEED_URL = "https://news.web.nhk/n-data/conf/na/rss/cat0.xml"
+# 同じHTMLと指示に対する応答はこの期間キャッシュから返す (同一入力での試行を繰り返すとき用)
+BRUSH_UP_CACHE_TTL = 24 * 60 * 60
 
 
-# --- APIキー取得関数 ---
-def get_gemini_api_key() -> str:
-    """APIキーを取得する (apiファイル > 環境変数)"""
-    if os.path.exists(API_FILE_PATH):
-        with open(API_FILE_PATH, 'r', encoding='utf-8') as f:
-            api_key = f.read().strip()
-        if api_key:
-            print(f"APIキーをファイル '{API_FILE_PATH}' から読み込みました。")
-            return api_key
-        else:
-            print(f"警告: '{API_FILE_PATH}' は空です。", file=sys.stderr)
-
-    api_key = os.getenv("GEMINI_API_KEY")
-    if api_key:
-        print("APIキーを環境変数 'GEMINI_API_KEY' から読み込みました。")
-        return api_key
-    
-    return ""
-
 # --- RSSフィード取得関数 ---
 def get_latest_rss_headline(rss_url: str) -> str:
     """指定されたRSSフィードから最新記事の見出しを取得する"""
     print(f"RSSフィードを取得中: {rss_url}")
     try:
+        import feedparser # このスクリプトでしか使わない重いライブラリなので、使うときに読み込む
         feed = feedparser.parse(rss_url)
         if feed.entries:
             latest_title = feed.entries[0].title
@@ -59,12 +36,10 @@ def get_latest_rss_headline(rss_url: str) -> str:
         return "最新ニュースの取得に失敗しました。"
 
 # --- Gemini API 呼び出し関数 ---
-def call_gemini_api_for_brush_up(api_key: str, original_html_content: str, user_instruction: str) -> str:
+def call_gemini_api_for_brush_up(api_key: str, original_html_content: str, user_instruction: str,
+                                 use_cache: bool = True) -> str:
     print("\n--- Gemini APIにブラッシュアップをリクエスト中 ---")
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-2.5-flash')
-
         prompt_parts = [
             "あなたは、既存のHTMLコンテンツをユーザーの指示に基づいてブラッシュアップする専門家です。",
             "元のHTMLコンテンツの構造と内容を尊重しつつ、より魅力的で洗練されたHTMLを出力してください。",
@@ -89,8 +64,8 @@ def call_gemini_api_for_brush_up(api_key: str, original_html_content: str, user_
 
         full_prompt = "\n".join(prompt_parts)
         print("--- Gemini API呼び出し中...しばらくお待ちください。 ---")
-        response = model.generate_content(full_prompt)
-        return response.text
+        return gemini_client.generate(full_prompt, api_key=api_key, label="brush_up_homepage",
+                                      cache_ttl=BRUSH_UP_CACHE_TTL, cache_refresh=not use_cache)
     except Exception as e:
         print(f"エラー: Gemini APIの呼び出し中にエラーが発生しました: {e}", file=sys.stderr)
         return ""
@@ -114,11 +89,11 @@ def strip_markdown_code_fences(text: str) -> str:
     return text
 
 # --- メイン処理 ---
-def main():
+def main(use_cache: bool = True):
     """メイン関数 (非対話モード)"""
     print("--- AIページブラッシュアップツール (自動モード) ---")
 
-    api_key = get_gemini_api_key()
+    api_key = gemini_client.get_api_key(verbose=True)
     if not api_key:
         print("エラー: Gemini APIキーが取得できませんでした。処理を中断します。", file=sys.stderr)
         return
@@ -138,7 +113,7 @@ def main():
     user_brush_up_instruction = f"今日のニュースのテーマ「{latest_headline}」に合わせて、より魅力的で洗練されたデザインにブラッシュアップしてください。特に、このテーマに関連するコンテンツや表現を強化してください。"
     print(f"AIへのブラッシュアップ指示: {user_brush_up_instruction}")
 
-    brushed_up_html_raw = call_gemini_api_for_brush_up(api_key, original_html_content, user_brush_up_instruction)
+    brushed_up_html_raw = call_gemini_api_for_brush_up(api_key, original_html_content, user_brush_up_instruction, use_cache)
 
     if not brushed_up_html_raw:
         print("エラー: ブラッシュアップコンテンツの生成に失敗しました。", file=sys.stderr)
@@ -161,4 +136,8 @@ def main():
     print("\n--- 処理完了 ---")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="既存のHTMLファイルをGemini APIでブラッシュアップします。")
+    parser.add_argument("--no-cache", action="store_true", help="キャッシュされた応答を使わずに生成し直す")
+    args = parser.parse_args()
+    gemini_client.require_genai()
+    main(use_cache=not args.no_cache)
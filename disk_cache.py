@@ -0,0 +1,160 @@
+#!/home/hirosi/my_gemini_project/venv/bin/python
+# -*- coding: utf-8 -*-
+# DESCRIPTION: 生成物をコンテンツのハッシュをキーにして保存する、サイズ上限付きLRUディスクキャッシュです。
+
+import os
+import sys
+import json
+import hashlib
+import shutil
+import tempfile
+import threading
+
+# --- 定数 ---
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CACHE_ROOT = os.path.join(PROJECT_ROOT, "scripts", "cache")
+STATS_FILENAME = "stats.json"
+
+# --- ヘルパー関数 ---
+def make_key(*parts) -> str:
+    """キーの構成要素 (文字列・数値・bytes) からSHA-256のキャッシュキーを作る"""
+    digest = hashlib.sha256()
+    for part in parts:
+        data = part if isinstance(part, bytes) else str(part).encode('utf-8')
+        # 要素の区切りが曖昧にならないよう、長さを前置する
+        digest.update(len(data).to_bytes(8, 'big'))
+        digest.update(data)
+    return digest.hexdigest()
+
+class DiskCache:
+    """キャッシュキーごとに1ファイルを保持するディスクキャッシュ。
+    ヒットしたエントリは更新時刻を進め、evict() で古いものから上限サイズまで削除する。"""
+
+    def __init__(self, name: str, max_bytes: int, suffix: str = ""):
+        self.name = name
+        self.root = os.path.join(CACHE_ROOT, name)
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        # 複数スレッドから get() や save_stats() が呼ばれても件数を取りこぼさないようにする
+        self._stats_lock = threading.Lock()
+
+    def path_for(self, key: str) -> str:
+        """キーに対応するエントリのパスを返す (存在するとは限らない)"""
+        return os.path.join(self.root, key[:2], key + self.suffix)
+
+    def get(self, key: str) -> str | None:
+        """エントリがあればパスを返し、LRU用に最終利用時刻を更新する。なければNone"""
+        path = self.path_for(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._stats_lock:
+                self.misses += 1
+            return None
+        with self._stats_lock:
+            self.hits += 1
+        return path
+
+    def temp_path(self, key: str) -> str:
+        """エントリを書き込むための一時ファイルパスを返す (commit() で確定する)"""
+        entry_dir = os.path.dirname(self.path_for(key))
+        os.makedirs(entry_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix=".tmp_", suffix=self.suffix, dir=entry_dir)
+        os.close(fd)
+        return path
+
+    def commit(self, key: str, temp_path: str) -> str:
+        """temp_path() に書き込んだファイルをエントリとしてアトミックに確定する"""
+        path = self.path_for(key)
+        os.replace(temp_path, path)
+        return path
+
+    def put_file(self, key: str, src_path: str) -> str:
+        """既存のファイルをコピーしてエントリとして保存する"""
+        temp_path = self.temp_path(key)
+        shutil.copyfile(src_path, temp_path)
+        return self.commit(key, temp_path)
+
+    def discard(self, temp_path: str) -> None:
+        """確定しなかった一時ファイルを削除する"""
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self) -> int:
+        """合計サイズが上限を超えていれば、最終利用時刻の古い順に削除する。削除した件数を返す"""
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.root):
+            for name in files:
+                if name == STATS_FILENAME or name.startswith(".tmp_"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        removed = 0
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                removed += 1
+        return removed
+
+    def save_stats(self) -> dict:
+        """今回のヒット/ミス数を累計カウンタ (stats.json) に加算し、累計値を返す"""
+        stats_path = os.path.join(self.root, STATS_FILENAME)
+        with self._stats_lock:
+            stats = {"hits": 0, "misses": 0}
+            try:
+                with open(stats_path, 'r', encoding='utf-8') as f:
+                    stats.update(json.load(f))
+            except (FileNotFoundError, json.JSONDecodeError):
+                pass
+            stats["hits"] += self.hits
+            stats["misses"] += self.misses
+            try:
+                os.makedirs(self.root, exist_ok=True)
+                with open(stats_path, 'w', encoding='utf-8') as f:
+                    json.dump(stats, f, ensure_ascii=False, indent=2)
+            except OSError as e:
+                print(f"警告: キャッシュ統計の保存に失敗しました: {e}", file=sys.stderr)
+            self.hits = self.misses = 0
+        return stats
+
+if __name__ == "__main__":
+    # 各キャッシュの使用量と累計ヒット率を表示する
+    if not os.path.isdir(CACHE_ROOT):
+        print(f"キャッシュはまだありません: {CACHE_ROOT}")
+        sys.exit(0)
+    for name in sorted(os.listdir(CACHE_ROOT)):
+        cache_dir = os.path.join(CACHE_ROOT, name)
+        if not os.path.isdir(cache_dir):
+            continue
+        count, size = 0, 0
+        for root, _, files in os.walk(cache_dir):
+            for filename in files:
+                if filename != STATS_FILENAME:
+                    count += 1
+                    size += os.path.getsize(os.path.join(root, filename))
+        stats = {"hits": 0, "misses": 0}
+        try:
+            with open(os.path.join(cache_dir, STATS_FILENAME), 'r', encoding='utf-8') as f:
+                stats.update(json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = stats["hits"] / lookups * 100 if lookups else 0.0
+        print(f"{name}: {count} 件, {size / 1024 / 1024:.1f} MB, ヒット {stats['hits']} / ミス {stats['misses']} ({hit_rate:.1f}%)")
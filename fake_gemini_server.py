@@ -0,0 +1,249 @@
+#!/home/hirosi/my_gemini_project/venv/bin/python
+# -*- coding: utf-8 -*-
+# DESCRIPTION: Gemini REST API (generateContent / streamGenerateContent) の偽サーバーです。本物のAPIを使わずに、ストリーミング・再試行・並行呼び出しを試せます。
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import gemini_client
+
+# --- 定数 ---
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+# ストリーミングで返すチャンク数と、最初のチャンク・2つ目以降のチャンクまでの待ち時間
+DEFAULT_CHUNKS = 5
+DEFAULT_FIRST_CHUNK_DELAY = 0.3
+DEFAULT_CHUNK_DELAY = 0.05
+# generateContent の応答までの待ち時間
+DEFAULT_LATENCY = 0.2
+# 動作確認で並行して送る非同期リクエストの数
+CHECK_ASYNC_REQUESTS = 20
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    """偽のGemini APIサーバー。属性を書き換えると、以降のリクエストの振る舞いが変わる。
+    fail_first: 次の何回のリクエストを fail_status で失敗させるか
+    break_after: ストリーミングで何チャンク送った後に接続を切るか (Noneなら最後まで送る)"""
+
+    daemon_threads = True
+    # 並行呼び出しの確認で接続が待たされないよう、接続待ちの上限を大きくする
+    request_queue_size = 128
+
+    def __init__(self, address: tuple[str, int], chunks: int = DEFAULT_CHUNKS,
+                 first_chunk_delay: float = DEFAULT_FIRST_CHUNK_DELAY, chunk_delay: float = DEFAULT_CHUNK_DELAY,
+                 latency: float = DEFAULT_LATENCY, fail_first: int = 0, fail_status: int = 503,
+                 break_after: int | None = None):
+        super().__init__(address, FakeGeminiHandler)
+        self.chunks = chunks
+        self.first_chunk_delay = first_chunk_delay
+        self.chunk_delay = chunk_delay
+        self.latency = latency
+        self.fail_first = fail_first
+        self.fail_status = fail_status
+        self.break_after = break_after
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def take_failure(self) -> bool:
+        """このリクエストを失敗させるならTrue"""
+        with self._lock:
+            self.requests += 1
+            if self.fail_first > 0:
+                self.fail_first -= 1
+                return True
+            return False
+
+    def chunk_texts(self) -> list[str]:
+        return [f"第{i + 1}節の文章です。" for i in range(self.chunks)]
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    # チャンク転送で途中まで送ってから接続を切れるように HTTP/1.1 で応答する
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            json.loads(body or b"{}")
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": {"code": 400, "message": "invalid JSON"}})
+            return
+        path = self.path.split("?", 1)[0]
+        if self.server.take_failure():
+            status = self.server.fail_status
+            self._send_json(status, {"error": {"code": status, "message": "fake transient error"}})
+        elif path.endswith(":streamGenerateContent"):
+            self._stream()
+        elif path.endswith(":generateContent"):
+            time.sleep(self.server.latency)
+            text = "".join(self.server.chunk_texts())
+            self._send_json(200, _response_body(text, len(text)))
+        else:
+            self._send_json(404, {"error": {"code": 404, "message": f"unknown path: {path}"}})
+
+    def _send_json(self, status: int, data: dict) -> None:
+        payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _stream(self) -> None:
+        """SSEでチャンクを返す。break_after を超えたら終端を送らずに接続を切る"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        texts = self.server.chunk_texts()
+        output_chars = 0
+        for i, text in enumerate(texts):
+            if self.server.break_after is not None and i >= self.server.break_after:
+                self.close_connection = True
+                return
+            time.sleep(self.server.first_chunk_delay if i == 0 else self.server.chunk_delay)
+            output_chars += len(text)
+            data = _response_body(text, output_chars if i == len(texts) - 1 else None, last=i == len(texts) - 1)
+            event = f"data: {json.dumps(data, ensure_ascii=False)}\r\n\r\n".encode('utf-8')
+            self.wfile.write(f"{len(event):x}\r\n".encode('ascii') + event + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+def _response_body(text: str, output_tokens: int | None, last: bool = True) -> dict:
+    candidate = {"content": {"role": "model", "parts": [{"text": text}]}}
+    if last:
+        candidate["finishReason"] = "STOP"
+    body = {"candidates": [candidate]}
+    if output_tokens is not None:
+        body["usageMetadata"] = {"promptTokenCount": 10, "candidatesTokenCount": output_tokens}
+    return body
+
+def start_server(host: str = DEFAULT_HOST, port: int = 0, **options) -> FakeGeminiServer:
+    """サーバーを別スレッドで起動して返す (port=0 なら空いているポートを使う)"""
+    server = FakeGeminiServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# --- 動作確認 ---
+def run_checks() -> bool:
+    """偽サーバーを相手に、ストリーミング・途中切断・再試行・並行呼び出しを確認する。すべて成功すればTrue"""
+    import nws_writer
+
+    # 再試行の待ち時間を短くして確認を速く終わらせる
+    gemini_client.BACKOFF_BASE_SECONDS = 0.05
+    server = start_server()
+    results = []
+
+    def check(name: str, ok: bool, detail: str = "") -> None:
+        results.append(ok)
+        print(f"[{'OK' if ok else 'NG'}] {name}{': ' + detail if detail else ''}")
+
+    temp_dir = tempfile.mkdtemp(prefix="fake_gemini_")
+    try:
+        expected = "".join(server.chunk_texts())
+
+        # 1. 最初のチャンクの前の一時的なエラーは再試行され、全文が保存されて最初の出力までの時間が記録される
+        server.fail_first = 1
+        save_path = os.path.join(temp_dir, "complete.md")
+        ok = nws_writer.stream_story_with_gemini("fake-key", {}, "確認", save_path, endpoint=server.endpoint)
+        stats = gemini_client.call_stats()[-1]
+        with open(save_path, 'r', encoding='utf-8') as f:
+            saved = f.read()
+        check("ストリーミング (503のあと再試行)", ok and saved.endswith(expected) and stats["attempts"] == 2,
+              f"試行 {stats['attempts']} 回, 保存 {len(saved)} 字")
+        first_chunk = stats["first_chunk_seconds"]
+        check("最初の出力までの時間", first_chunk is not None and first_chunk >= server.first_chunk_delay,
+              f"{first_chunk}秒 (サーバーの待ち時間 {server.first_chunk_delay}秒)")
+
+        # 2. 途中で接続が切れた場合は再試行せず、それまでに受け取った部分が保存されている
+        server.break_after = 2
+        save_path = os.path.join(temp_dir, "partial.md")
+        ok = nws_writer.stream_story_with_gemini("fake-key", {}, "確認", save_path, endpoint=server.endpoint)
+        stats = gemini_client.call_stats()[-1]
+        with open(save_path, 'r', encoding='utf-8') as f:
+            saved = f.read()
+        partial = "".join(server.chunk_texts()[:2])
+        check("途中切断で部分保存", not ok and saved.endswith(partial) and not stats["ok"] and stats["attempts"] == 1,
+              f"保存 {len(saved)} 字, 試行 {stats['attempts']} 回")
+        server.break_after = None
+
+        # 3. 最初のチャンクの前に失敗した場合は、見出しだけのファイルも一時ファイルも残らない
+        server.fail_first, server.fail_status = 1, 400
+        save_path = os.path.join(temp_dir, "failed.md")
+        ok = nws_writer.stream_story_with_gemini("fake-key", {}, "確認", save_path, endpoint=server.endpoint)
+        leftovers = sorted(os.listdir(temp_dir))
+        check("出力前の失敗でファイルを残さない", not ok and "failed.md" not in leftovers
+              and not any(name.startswith(".tmp_") for name in leftovers), f"ディレクトリ: {leftovers}")
+
+        # 4. 非同期の並行呼び出し (append_saga_story のバッチモードと同じ経路) が429を再試行して全件成功する
+        if gemini_client.AIOHTTP_AVAILABLE:
+            server.fail_first, server.fail_status = 2, 429
+
+            async def call_all():
+                try:
+                    return await asyncio.gather(*(
+                        gemini_client.generate_async("確認", api_key="fake-key", endpoint=server.endpoint, label="fake")
+                        for _ in range(CHECK_ASYNC_REQUESTS)
+                    ), return_exceptions=True)
+                finally:
+                    await gemini_client.close_async()
+
+            started = time.perf_counter()
+            responses = asyncio.run(call_all())
+            elapsed = time.perf_counter() - started
+            succeeded = sum(1 for response in responses if response == expected)
+            check("非同期の並行呼び出し (429のあと再試行)", succeeded == CHECK_ASYNC_REQUESTS,
+                  f"{succeeded}/{CHECK_ASYNC_REQUESTS} 件成功, {elapsed:.2f}秒 ({CHECK_ASYNC_REQUESTS / elapsed:.1f} 件/秒)")
+        else:
+            print("[--] 非同期の並行呼び出し: aiohttp がないためスキップしました")
+    finally:
+        server.shutdown()
+        server.server_close()
+        for name in os.listdir(temp_dir):
+            os.remove(os.path.join(temp_dir, name))
+        os.rmdir(temp_dir)
+    return all(results)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gemini REST APIの偽サーバーを起動します。")
+    parser.add_argument("--check", action="store_true",
+                        help="サーバーを起動せずに、ストリーミング・途中切断・再試行・並行呼び出しの動作確認だけを行う")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--chunks", type=int, default=DEFAULT_CHUNKS, help="ストリーミングで返すチャンク数")
+    parser.add_argument("--first-chunk-delay", type=float, default=DEFAULT_FIRST_CHUNK_DELAY,
+                        help="最初のチャンクを返すまでの秒数")
+    parser.add_argument("--chunk-delay", type=float, default=DEFAULT_CHUNK_DELAY, help="2つ目以降のチャンクの間隔 (秒)")
+    parser.add_argument("--latency", type=float, default=DEFAULT_LATENCY, help="generateContent の応答までの秒数")
+    parser.add_argument("--fail-first", type=int, default=0, help="最初のN回のリクエストをエラーにする")
+    parser.add_argument("--fail-status", type=int, default=503, help="エラーにするときのHTTPステータス")
+    parser.add_argument("--break-after", type=int, help="ストリーミングでNチャンク送った後に接続を切る")
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(0 if run_checks() else 1)
+
+    server = FakeGeminiServer((args.host, args.port), chunks=args.chunks, first_chunk_delay=args.first_chunk_delay,
+                              chunk_delay=args.chunk_delay, latency=args.latency, fail_first=args.fail_first,
+                              fail_status=args.fail_status, break_after=args.break_after)
+    print(f"偽のGemini APIサーバーを起動しました: {server.endpoint}")
+    print(f"例: nws_writer.py --endpoint {server.endpoint} / append_saga_story.py --batch 5 --endpoint {server.endpoint}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n停止しました。")
+    finally:
+        server.server_close()
@@ -0,0 +1,441 @@
+#!/home/hirosi/my_gemini_project/venv/bin/python
+# -*- coding: utf-8 -*-
+# DESCRIPTION: 各スクリプト共通のGemini APIクライアントです。APIキーの取得、モデル・HTTP接続の再利用、一時的なエラーの再試行、呼び出しごとの所要時間とトークン数の記録、応答のディスクキャッシュ (任意) を行います。
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+import threading
+import collections
+import urllib.error
+import urllib.parse
+import urllib.request
+import importlib.util
+
+import disk_cache
+import pipeline_metrics
+
+def _module_available(name: str) -> bool:
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ImportError:
+        return False
+
+# google-generativeai と aiohttp は読み込みに時間がかかるため、有無だけを確かめておき、実際に使うときにインポートする
+GENAI_AVAILABLE = _module_available("google.generativeai")
+AIOHTTP_AVAILABLE = _module_available("aiohttp") # 非同期呼び出しでのみ使用
+
+# --- 定数 ---
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_FILE_PATH = os.path.join(PROJECT_ROOT, "api")
+DEFAULT_MODEL = 'gemini-2.5-flash'
+GEMINI_API_ENDPOINT = "https://generativelanguage.googleapis.com"
+# 一時的なエラーの再試行 (指数バックオフ + ジッター)
+MAX_ATTEMPTS = 4
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 30.0
+TRANSIENT_STATUS_CODES = frozenset([408, 429, 500, 502, 503, 504])
+# google.api_core.exceptions / aiohttp の例外のうち再試行するもの (ライブラリを必須にしないよう名前で判定する)
+TRANSIENT_ERROR_NAMES = frozenset([
+    'DeadlineExceeded', 'GatewayTimeout', 'InternalServerError', 'ResourceExhausted',
+    'ServiceUnavailable', 'TooManyRequests', 'ServerDisconnectedError', 'ClientConnectorError',
+])
+ASYNC_TIMEOUT_SECONDS = 300
+# 応答キャッシュ (呼び出し側が cache_ttl を指定したときだけ使う)
+RESPONSE_CACHE_MAX_BYTES = 200 * 1024 * 1024
+# "off" でキャッシュを使わない、"refresh" でキャッシュを読まずに上書きする (全呼び出し共通)
+RESPONSE_CACHE_MODE = os.getenv("GEMINI_RESPONSE_CACHE", "").lower()
+# 残しておく呼び出しの記録の件数 (常駐プロセスで記録が増え続けないよう、古いものから捨てる)
+CALL_LOG_MAX_ENTRIES = 1000
+
+class GeminiAPIError(RuntimeError):
+    """REST APIがエラーを返した (status はHTTPステータス)"""
+
+    def __init__(self, message: str, status: int | None = None):
+        super().__init__(message)
+        self.status = status
+
+# --- APIキー ---
+# APIキーファイルの (更新時刻, 内容)。常駐プロセスで何度も読み直さないよう、ファイルが変わったときだけ読む
+_api_key_file_cache = (None, None)
+
+def get_api_key(interactive: bool = False, verbose: bool = False) -> str | None:
+    """APIキーを取得する (apiファイル > 環境変数 > interactive ならユーザー入力)"""
+    global _api_key_file_cache
+    if os.path.exists(API_FILE_PATH):
+        mtime_ns = os.stat(API_FILE_PATH).st_mtime_ns
+        if _api_key_file_cache[0] == mtime_ns:
+            api_key = _api_key_file_cache[1]
+        else:
+            with open(API_FILE_PATH, 'r', encoding='utf-8') as f:
+                api_key = f.read().strip()
+            _api_key_file_cache = (mtime_ns, api_key)
+        if api_key:
+            if verbose:
+                print(f"APIキーをファイル '{API_FILE_PATH}' から読み込みました。")
+            return api_key
+        print(f"警告: '{API_FILE_PATH}' は空です。", file=sys.stderr)
+
+    api_key = os.getenv("GEMINI_API_KEY")
+    if api_key:
+        if verbose:
+            print("APIキーを環境変数 'GEMINI_API_KEY' から読み込みました。")
+        return api_key
+
+    if interactive:
+        print("\n--- Gemini APIキーの入力 ---")
+        try:
+            return input("APIキーを直接入力してください: ").strip() or None
+        except (EOFError, KeyboardInterrupt):
+            return None
+    return None
+
+def require_genai() -> None:
+    """google-generativeai がなければ、インストール方法を表示して終了する"""
+    if not GENAI_AVAILABLE:
+        print("エラー: 'google-generativeai' ライブラリが見つかりません。", file=sys.stderr)
+        print("以下のコマンドでインストールしてください:", file=sys.stderr)
+        print("pip install google-generativeai", file=sys.stderr)
+        sys.exit(1)
+
+# --- 再試行 ---
+def is_transient_error(error: BaseException) -> bool:
+    """再試行すれば成功する可能性のあるエラーか"""
+    if isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return True
+    status = getattr(error, 'status', None) or getattr(error, 'code', None)
+    if isinstance(status, int) and status in TRANSIENT_STATUS_CODES:
+        return True
+    return type(error).__name__ in TRANSIENT_ERROR_NAMES
+
+def backoff_delay(attempt: int) -> float:
+    """attempt 回目 (0始まり) の失敗後に待つ秒数 (full jitter)"""
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+# --- 呼び出しの記録 ---
+_call_log = collections.deque(maxlen=CALL_LOG_MAX_ENTRIES)
+_call_log_lock = threading.Lock()
+
+def _record_call(label: str, model_name: str, mode: str, started: float, attempts: int,
+                 usage: dict | None, ok: bool, first_chunk_seconds: float | None = None) -> None:
+    record = {
+        "label": label,
+        "model": model_name,
+        "mode": mode,
+        "seconds": round(time.perf_counter() - started, 3),
+        "attempts": attempts,
+        "prompt_tokens": (usage or {}).get("prompt_tokens"),
+        "output_tokens": (usage or {}).get("output_tokens"),
+        "ok": ok,
+        "first_chunk_seconds": round(first_chunk_seconds, 3) if first_chunk_seconds is not None else None,
+    }
+    with _call_log_lock:
+        _call_log.append(record)
+    if mode != "cache":
+        pipeline_metrics.record_gemini_call(usage)
+    if mode == "cache":
+        print(f"Gemini ({label or model_name}): キャッシュから応答を取得しました")
+    elif ok:
+        tokens = ""
+        if record["prompt_tokens"] is not None:
+            tokens = f", 入力 {record['prompt_tokens']} / 出力 {record['output_tokens']} トークン"
+        if first_chunk_seconds is not None:
+            tokens = f" (最初の出力まで {first_chunk_seconds:.1f}秒){tokens}"
+        # ストリーミングでは生成された文章の直後に表示されるため改行を入れる
+        prefix = "\n" if mode == "stream" else ""
+        print(f"{prefix}Gemini ({label or model_name}): {record['seconds']:.1f}秒{tokens}")
+
+def call_stats() -> list[dict]:
+    """直近 CALL_LOG_MAX_ENTRIES 件の呼び出しの記録 (label, model, mode, seconds, attempts, prompt_tokens,
+    output_tokens, ok, first_chunk_seconds) を返す。キャッシュから返した呼び出しは mode が "cache"、ストリーミングは "stream" になる"""
+    with _call_log_lock:
+        return list(_call_log)
+
+def print_call_stats() -> None:
+    """呼び出し回数・合計時間・合計トークン数を表示する"""
+    stats = call_stats()
+    if not stats:
+        return
+    seconds = sum(s["seconds"] for s in stats)
+    prompt_tokens = sum(s["prompt_tokens"] or 0 for s in stats)
+    output_tokens = sum(s["output_tokens"] or 0 for s in stats)
+    failed = sum(1 for s in stats if not s["ok"])
+    cached = sum(1 for s in stats if s["mode"] == "cache")
+    print(f"Gemini API: {len(stats)} 回 (失敗 {failed}, キャッシュ {cached}), 合計 {seconds:.1f}秒, "
+          f"入力 {prompt_tokens} / 出力 {output_tokens} トークン")
+
+# --- 応答キャッシュ ---
+_response_cache = disk_cache.DiskCache("gemini_responses", RESPONSE_CACHE_MAX_BYTES, suffix=".json")
+
+def response_cache_key(prompt: str, model_name: str, generation_config=None) -> str:
+    """モデル名・プロンプトのハッシュ・生成設定からキャッシュキーを作る"""
+    config = json.dumps(generation_config, sort_keys=True, ensure_ascii=False, default=str)
+    return disk_cache.make_key("gemini", model_name, hashlib.sha256(prompt.encode('utf-8')).hexdigest(), config)
+
+def _cache_lookup(key: str, cache_ttl: float | None, cache_refresh: bool) -> dict | None:
+    if cache_ttl is None or RESPONSE_CACHE_MODE == "off" or cache_refresh or RESPONSE_CACHE_MODE == "refresh":
+        return None
+    path = _response_cache.get(key)
+    if path is None:
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        entry = None
+    if entry is None or time.time() - entry.get("created", 0) > cache_ttl:
+        # 期限切れのエントリは削除する
+        forget_response(key)
+        return None
+    return entry
+
+def _cache_store(key: str, cache_ttl: float | None, model_name: str, text: str, usage: dict | None) -> None:
+    if cache_ttl is None or RESPONSE_CACHE_MODE == "off":
+        return
+    temp_path = _response_cache.temp_path(key)
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({"created": time.time(), "model": model_name, "text": text, "usage": usage}, f, ensure_ascii=False)
+        _response_cache.commit(key, temp_path)
+        _response_cache.evict()
+    except OSError as e:
+        _response_cache.discard(temp_path)
+        print(f"警告: Gemini応答のキャッシュ保存に失敗しました: {e}", file=sys.stderr)
+
+def forget_response(key: str) -> None:
+    """キャッシュキー (response_cache_key) のエントリを削除する"""
+    try:
+        os.remove(_response_cache.path_for(key))
+    except FileNotFoundError:
+        pass
+
+def purge_response_cache() -> int:
+    """応答キャッシュをすべて削除し、削除した件数を返す"""
+    removed = 0
+    for root, _, files in os.walk(_response_cache.root):
+        for name in files:
+            if name.endswith(_response_cache.suffix) and name != disk_cache.STATS_FILENAME:
+                os.remove(os.path.join(root, name))
+                removed += 1
+    return removed
+
+# --- 同期呼び出し (google-generativeai) ---
+_models = {}
+_models_lock = threading.Lock()
+_configured_key = None
+
+def get_model(model_name: str = DEFAULT_MODEL, api_key: str | None = None):
+    """GenerativeModel を作り、以後は同じものを使い回す"""
+    global _configured_key
+    require_genai()
+    import google.generativeai as genai
+    api_key = api_key or get_api_key()
+    with _models_lock:
+        if api_key != _configured_key:
+            genai.configure(api_key=api_key)
+            _configured_key = api_key
+            _models.clear()
+        model = _models.get(model_name)
+        if model is None:
+            model = _models[model_name] = genai.GenerativeModel(model_name)
+        return model
+
+def _sdk_usage(response) -> dict | None:
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return None
+    return {"prompt_tokens": getattr(usage, 'prompt_token_count', None),
+            "output_tokens": getattr(usage, 'candidates_token_count', None)}
+
+def generate(prompt: str, model_name: str = DEFAULT_MODEL, generation_config: dict | None = None,
+             api_key: str | None = None, label: str = "",
+             cache_ttl: float | None = None, cache_refresh: bool = False) -> str:
+    """プロンプトから文章を生成する。一時的なエラーは待ってから再試行し、それ以外のエラーは送出する。
+    cache_ttl (秒) を指定すると、同じモデル・プロンプト・生成設定の応答をその期間キャッシュから返す。
+    cache_refresh=True ならキャッシュを読まずにAPIを呼び、結果で上書きする。"""
+    started = time.perf_counter()
+    key = response_cache_key(prompt, model_name, generation_config) if cache_ttl is not None else None
+    cached = _cache_lookup(key, cache_ttl, cache_refresh) if key else None
+    if cached is not None:
+        _record_call(label, model_name, "cache", started, 0, None, True)
+        return cached["text"]
+
+    model = get_model(model_name, api_key)
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            response = model.generate_content(prompt, generation_config=generation_config)
+            text = response.text
+        except Exception as e:
+            if attempt + 1 < MAX_ATTEMPTS and is_transient_error(e):
+                delay = backoff_delay(attempt)
+                print(f"警告: Gemini APIの一時的なエラーのため {delay:.1f}秒後に再試行します: {e}", file=sys.stderr)
+                time.sleep(delay)
+                continue
+            _record_call(label, model_name, "sync", started, attempt + 1, None, False)
+            raise
+        usage = _sdk_usage(response)
+        _record_call(label, model_name, "sync", started, attempt + 1, usage, True)
+        if key:
+            _cache_store(key, cache_ttl, model_name, text, usage)
+        return text
+
+# --- ストリーミング ---
+def _sdk_stream(prompt: str, model_name: str, generation_config, api_key: str | None):
+    response = get_model(model_name, api_key).generate_content(prompt, generation_config=generation_config, stream=True)
+    for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            # テキストを含まないチャンク (終了理由だけなど)
+            text = ""
+        yield text, _sdk_usage(chunk)
+
+def _rest_stream(prompt: str, model_name: str, generation_config, api_key: str | None, endpoint: str):
+    """REST API (streamGenerateContent, SSE) からチャンクを読む"""
+    query = urllib.parse.urlencode({"alt": "sse", "key": api_key or get_api_key() or ""})
+    url = f"{endpoint.rstrip('/')}/v1beta/models/{model_name}:streamGenerateContent?{query}"
+    payload = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+    if generation_config:
+        payload["generationConfig"] = generation_config
+    request = urllib.request.Request(url, data=json.dumps(payload).encode('utf-8'),
+                                     headers={"Content-Type": "application/json"}, method="POST")
+    try:
+        response = urllib.request.urlopen(request, timeout=ASYNC_TIMEOUT_SECONDS)
+    except urllib.error.HTTPError as e:
+        raise GeminiAPIError(f"ステータス {e.code}, レスポンス: {e.read().decode('utf-8', 'replace')[:200]}", e.code)
+    except urllib.error.URLError as e:
+        raise ConnectionError(str(e.reason)) from e
+    finished = False
+    with response:
+        for line in response:
+            line = line.decode('utf-8').strip()
+            if not line.startswith("data:"):
+                continue
+            chunk = json.loads(line[len("data:"):])
+            candidate = (chunk.get("candidates") or [{}])[0]
+            parts = candidate.get("content", {}).get("parts", [])
+            # 最後のチャンクには終了理由が付く
+            finished = finished or bool(candidate.get("finishReason"))
+            usage = chunk.get("usageMetadata")
+            if usage is not None:
+                usage = {"prompt_tokens": usage.get("promptTokenCount"), "output_tokens": usage.get("candidatesTokenCount")}
+            yield "".join(part.get("text", "") for part in parts), usage
+    if not finished:
+        # 接続が途中で閉じられても読み込みは正常に終わるため、終了理由の有無で切断を見分ける
+        raise ConnectionError("ストリーミングが終了理由を受け取る前に切断されました")
+
+def generate_stream(prompt: str, model_name: str = DEFAULT_MODEL, generation_config: dict | None = None,
+                    api_key: str | None = None, endpoint: str | None = None, label: str = ""):
+    """生成された文章を届いた順にチャンク (文字列) で返すジェネレータ。
+    一時的なエラーは最初のチャンクを受け取る前だけ再試行する。最初のチャンクを返した後のエラー
+    (途中での切断など) は再試行せずにそのまま送出する。生成をやり直すと、すでに返した文章と
+    食い違う文章が続いてしまうため、受け取った分をどう扱うかは呼び出し側が決める。
+    endpoint を指定するとSDKを使わずにREST API (SSE) を直接呼ぶ (fake_gemini_server.py で試す場合など)。"""
+    started = time.perf_counter()
+    first_chunk_seconds = None
+    usage = None
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            if endpoint is None:
+                chunks = _sdk_stream(prompt, model_name, generation_config, api_key)
+            else:
+                chunks = _rest_stream(prompt, model_name, generation_config, api_key, endpoint)
+            for text, chunk_usage in chunks:
+                usage = chunk_usage or usage
+                if not text:
+                    continue
+                if first_chunk_seconds is None:
+                    first_chunk_seconds = time.perf_counter() - started
+                yield text
+        except Exception as e:
+            if first_chunk_seconds is None and attempt + 1 < MAX_ATTEMPTS and is_transient_error(e):
+                delay = backoff_delay(attempt)
+                print(f"警告: Gemini APIの一時的なエラーのため {delay:.1f}秒後に再試行します: {e}", file=sys.stderr)
+                time.sleep(delay)
+                continue
+            _record_call(label, model_name, "stream", started, attempt + 1, usage, False, first_chunk_seconds)
+            raise
+        _record_call(label, model_name, "stream", started, attempt + 1, usage, True, first_chunk_seconds)
+        return
+
+# --- 非同期呼び出し (REST + aiohttp) ---
+# イベントループごとに1つのセッションを使い回し、HTTP接続を再利用する
+_sessions = {}
+
+def _session() -> 'aiohttp.ClientSession':
+    if not AIOHTTP_AVAILABLE:
+        raise RuntimeError("非同期呼び出しには 'aiohttp' ライブラリが必要です (pip install aiohttp)")
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        import aiohttp
+        session = _sessions[loop] = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=ASYNC_TIMEOUT_SECONDS))
+    return session
+
+async def close_async() -> None:
+    """現在のイベントループで使ったHTTPセッションを閉じる"""
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+async def _post_generate(endpoint: str, api_key: str, model_name: str, prompt: str,
+                         generation_config: dict | None) -> tuple[str, dict | None]:
+    url = f"{endpoint.rstrip('/')}/v1beta/models/{model_name}:generateContent"
+    payload = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+    if generation_config:
+        payload["generationConfig"] = generation_config
+    async with _session().post(url, params={"key": api_key}, json=payload) as response:
+        if response.status != 200:
+            error_text = await response.text()
+            raise GeminiAPIError(f"ステータス {response.status}, レスポンス: {error_text[:200]}", response.status)
+        result = await response.json()
+    try:
+        parts = result["candidates"][0]["content"]["parts"]
+    except (KeyError, IndexError, TypeError):
+        raise GeminiAPIError(f"予期しないレスポンス構造: {str(result)[:200]}")
+    usage = result.get("usageMetadata")
+    if usage is not None:
+        usage = {"prompt_tokens": usage.get("promptTokenCount"), "output_tokens": usage.get("candidatesTokenCount")}
+    return "".join(part.get("text", "") for part in parts), usage
+
+async def generate_async(prompt: str, model_name: str = DEFAULT_MODEL, generation_config: dict | None = None,
+                         api_key: str | None = None, endpoint: str = GEMINI_API_ENDPOINT, label: str = "",
+                         cache_ttl: float | None = None, cache_refresh: bool = False) -> str:
+    """generate() の非同期版。REST APIを直接呼び、generation_config はREST形式 (camelCase) で渡す"""
+    started = time.perf_counter()
+    key = response_cache_key(prompt, model_name, generation_config) if cache_ttl is not None else None
+    cached = _cache_lookup(key, cache_ttl, cache_refresh) if key else None
+    if cached is not None:
+        _record_call(label, model_name, "cache", started, 0, None, True)
+        return cached["text"]
+
+    api_key = api_key or get_api_key()
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            text, usage = await _post_generate(endpoint, api_key, model_name, prompt, generation_config)
+        except Exception as e:
+            if attempt + 1 < MAX_ATTEMPTS and is_transient_error(e):
+                delay = backoff_delay(attempt)
+                print(f"警告: Gemini APIの一時的なエラーのため {delay:.1f}秒後に再試行します: {e}", file=sys.stderr)
+                await asyncio.sleep(delay)
+                continue
+            _record_call(label, model_name, "async", started, attempt + 1, None, False)
+            raise
+        _record_call(label, model_name, "async", started, attempt + 1, usage, True)
+        if key:
+            _cache_store(key, cache_ttl, model_name, text, usage)
+        return text
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gemini応答キャッシュを管理します。")
+    parser.add_argument("--purge-cache", action="store_true", help="応答キャッシュをすべて削除する")
+    args = parser.parse_args()
+    if args.purge_cache:
+        print(f"応答キャッシュを {purge_response_cache()} 件削除しました: {_response_cache.root}")
+    else:
+        parser.print_help()
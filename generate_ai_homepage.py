@@ -4,34 +4,20 @@
 
 import os
 import sys
+import asyncio
 import datetime
-try:
-    import google.generativeai as genai
-except ImportError:
-    print("エラー: 'google-generativeai' ライブラリが見つかりません。", file=sys.stderr)
-    sys.exit(1)
+
+import gemini_client
+import pipeline_metrics
 
 # --- 定数 ---
-PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-API_FILE_PATH = os.path.join(PROJECT_ROOT, "api")
 OUTPUT_DIR_PUBLIC = "/var/www/html/public/"
-
-# --- APIキー取得 ---
-def get_gemini_api_key() -> str | None:
-    # ... (Implementation from previous version is fine)
-    if os.path.exists(API_FILE_PATH):
-        with open(API_FILE_PATH, 'r', encoding='utf-8') as f:
-            return f.read().strip()
-    return os.getenv("GEMINI_API_KEY")
+# 同じ物語のHTML化はこの期間キャッシュした応答を使う (パイプラインの再実行でAPIを呼び直さない)
+AI_HTML_CACHE_TTL = 7 * 24 * 60 * 60
 
 # --- AIコンテンツ生成 ---
-def get_ai_story_html(api_key: str, story_content: str) -> str | None:
-    """AIに物語のHTML版を生成させる"""
-    print("AIに物語のHTML版をリクエスト中...")
-    try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        prompt = f"""
+def build_story_html_prompt(story_content: str) -> str:
+    return f"""
 以下の物語を、Webページに掲載するための魅力的なHTMLコンテンツにしてください。
 - 物語の重要な部分を抜き出し、感動的な要約を作成します。
 - `<h2>`タグで見出しを、`<p>`タグで段落を作成してください。
@@ -42,38 +28,42 @@ def get_ai_story_html(api_key: str, story_content: str) -> str | None:
 
 --- 出力 (HTMLのみ) ---
 """
-        response = model.generate_content(prompt)
-        # Markdown ```html ... ``` を削除
-        if response.text.startswith('```html'):
-            return response.text[7:-4].strip()
-        return response.text
-    except Exception as e:
-        print(f"エラー: Gemini APIの呼び出し中にエラー: {e}", file=sys.stderr)
-        return None
-
-# --- メイン処理 ---
-def main(story_content: str, story_name: str, video_filepath: str) -> str | None:
-    """ホームページを生成し、成功すればファイルパスを、失敗すればNoneを返す。"""
-    print("--- 進化するAIホームページコンテンツ生成ツール ---")
 
-    # 1. 引数チェック
-    if not all([story_content, story_name, video_filepath]):
-        print("エラー: 必要な引数（物語内容, 物語名, 動画パス）が不足しています。", file=sys.stderr)
-        return None
+def strip_code_fence(text: str) -> str:
+    # Markdown ```html ... ``` を削除
+    if text.startswith('```html'):
+        return text[7:-4].strip()
+    return text
 
-    # 2. APIキー取得
-    api_key = get_gemini_api_key()
-    if not api_key:
-        print("エラー: Gemini APIキーが取得できませんでした。", file=sys.stderr)
+def get_ai_story_html(api_key: str, story_content: str, use_cache: bool = True) -> str | None:
+    """AIに物語のHTML版を生成させる (use_cache=False ならキャッシュを使わずに生成し直す)"""
+    print("AIに物語のHTML版をリクエスト中...")
+    try:
+        text = gemini_client.generate(build_story_html_prompt(story_content), api_key=api_key,
+                                      label="generate_ai_homepage",
+                                      cache_ttl=AI_HTML_CACHE_TTL, cache_refresh=not use_cache)
+        return strip_code_fence(text)
+    except Exception as e:
+        print(f"エラー: Gemini APIの呼び出し中にエラー: {e}", file=sys.stderr)
         return None
 
-    # 3. AIによるHTMLコンテンツ生成
-    ai_html_content = get_ai_story_html(api_key, story_content)
-    if not ai_html_content:
-        print("エラー: AIによるコンテンツ生成に失敗しました。", file=sys.stderr)
+async def get_ai_story_html_async(api_key: str, story_content: str, use_cache: bool = True) -> str | None:
+    """get_ai_story_html() の非同期版 (aiohttp がなければスレッドで同期版を呼ぶ)"""
+    if not gemini_client.AIOHTTP_AVAILABLE:
+        return await asyncio.to_thread(get_ai_story_html, api_key, story_content, use_cache)
+    print("AIに物語のHTML版をリクエスト中...")
+    try:
+        text = await gemini_client.generate_async(build_story_html_prompt(story_content), api_key=api_key,
+                                                  label="generate_ai_homepage",
+                                                  cache_ttl=AI_HTML_CACHE_TTL, cache_refresh=not use_cache)
+        return strip_code_fence(text)
+    except Exception as e:
+        print(f"エラー: Gemini APIの呼び出し中にエラー: {e}", file=sys.stderr)
         return None
 
-    # 4. 完全なHTMLページを構築
+# --- ページ構築 ---
+def write_homepage(story_name: str, video_filepath: str, ai_html_content: str) -> str | None:
+    """AIが生成したHTMLと動画プレイヤーから完全なページを作って保存し、ファイルパスを返す"""
     site_title = f"AI Saga Weaver - {story_name.replace('.md', '')}"
     video_filename = os.path.basename(video_filepath)
     
@@ -111,19 +101,47 @@ def main(story_content: str, story_name: str, video_filepath: str) -> str | None
 </body>
 </html>
 """
-    # 5. ファイルに保存
+    # ファイルに保存
     output_filename = "ai_business_homepage.html"
     output_filepath = os.path.join(OUTPUT_DIR_PUBLIC, output_filename)
     os.makedirs(OUTPUT_DIR_PUBLIC, exist_ok=True)
     try:
         with open(output_filepath, 'w', encoding='utf-8') as f:
             f.write(full_html)
+        pipeline_metrics.record_file(output_filepath)
         print(f"ホームページコンテンツが {output_filepath} に生成されました。")
         return output_filepath
     except Exception as e:
         print(f"エラー: ホームページコンテンツの保存に失敗しました: {e}", file=sys.stderr)
         return None
 
+# --- メイン処理 ---
+@pipeline_metrics.instrument("generate_ai_homepage")
+def main(story_content: str, story_name: str, video_filepath: str, use_cache: bool = True) -> str | None:
+    """ホームページを生成し、成功すればファイルパスを、失敗すればNoneを返す。
+    use_cache=False ならキャッシュされたAI応答を使わない。"""
+    print("--- 進化するAIホームページコンテンツ生成ツール ---")
+
+    # 1. 引数チェック
+    if not all([story_content, story_name, video_filepath]):
+        print("エラー: 必要な引数（物語内容, 物語名, 動画パス）が不足しています。", file=sys.stderr)
+        return None
+
+    # 2. APIキー取得
+    api_key = gemini_client.get_api_key()
+    if not api_key:
+        print("エラー: Gemini APIキーが取得できませんでした。", file=sys.stderr)
+        return None
+
+    # 3. AIによるHTMLコンテンツ生成
+    ai_html_content = get_ai_story_html(api_key, story_content, use_cache)
+    if not ai_html_content:
+        print("エラー: AIによるコンテンツ生成に失敗しました。", file=sys.stderr)
+        return None
+
+    # 4. 完全なHTMLページを構築して保存
+    return write_homepage(story_name, video_filepath, ai_html_content)
+
 if __name__ == "__main__":
     print("このスクリプトはオーケストレーターから呼び出されることを想定しています。", file=sys.stderr)
     print("直接実行はできません。", file=sys.stderr)
@@ -4,7 +4,8 @@
 
 import os
 import sys
-import glob
+import argparse
+import asyncio
 import random
 import re
 import subprocess
@@ -18,84 +19,117 @@ if script_dir not in sys.path:
 # 各モジュールをインポート
 import append_saga_story
 import assemble_video # ImageMagick/ffmpeg版
+import gemini_client
 import generate_ai_homepage
+import pipeline_dag
+import pipeline_metrics
+import saga_manifest
 
 # --- 定数 ---
 NWS_COLLECTION_ROOT = os.path.expanduser("~/neo_world_saga_collection/")
 BGM_FILEPATH = "/usr/share/starfighter/music/frozen_jam.ogg"
+# 動画のエンコードプロファイル (assemble_video.ENCODING_PROFILES のキー)
+VIDEO_PROFILE = "web"
+# 実行記録の名前 (pipeline_dag.RUNS_DIR 内の <名前>.json)
+RUN_RECORD_NAME = "daily_video_and_homepage"
 
 # --- ヘルパー関数 ---
-def load_random_saga_story() -> tuple[str | None, str | None]:
-    """ネオワールドサーガの物語をランダムに選び、内容とファイル名を返す"""
+def select_random_saga_story() -> str | None:
+    """ネオワールドサーガの物語 (200バイトより大きいもの) をランダムに選び、パスを返す"""
     try:
-        search_path = os.path.join(NWS_COLLECTION_ROOT, "**", "*.md")
-        files = glob.glob(search_path, recursive=True)
-        if not files:
+        manifest = saga_manifest.load_manifest(NWS_COLLECTION_ROOT)
+        if not manifest.files:
             print(f"警告: ディレクトリに物語ファイルが見つかりません: {NWS_COLLECTION_ROOT}", file=sys.stderr)
-            return None, None
+            return None
         
-        valid_files = [f for f in files if os.path.getsize(f) > 200]
+        valid_files = manifest.paths(min_size=201)
         if not valid_files:
             print(f"警告: 200バイト以上の物語ファイルが見つかりません。", file=sys.stderr)
-            return None, None
+            return None
 
-        selected_file = random.choice(valid_files)
-        with open(selected_file, 'r', encoding='utf-8') as f:
-            return f.read(), os.path.basename(selected_file)
+        return random.choice(valid_files)
     except Exception as e:
-        print(f"エラー: 物語のランダム読み込み中にエラー: {e}", file=sys.stderr)
-        return None, None
-
-# --- メイン処理 ---
-def main():
-    """動画生成パイプラインをオーケストレーションします。"""
-    print("--- 全体オーケストレーター開始 ---")
+        print(f"エラー: 物語のランダム選択中にエラー: {e}", file=sys.stderr)
+        return None
 
+def read_selected_story(story: dict) -> str:
+    """select_story の結果 ({"path", "name", "mtime_ns"}) から物語を読み込む。
+    選択後に物語が書き換えられていれば、動画とホームページの内容がずれるため StageFailed を送出する"""
     try:
-        # 1. 物語の続きを自動執筆
+        if os.stat(story["path"]).st_mtime_ns != story["mtime_ns"]:
+            raise pipeline_dag.StageFailed(f"選択後に物語が変更されました: {story['name']}")
+        with open(story["path"], 'r', encoding='utf-8') as f:
+            return f.read()
+    except OSError as e:
+        raise pipeline_dag.StageFailed(f"物語を読み込めませんでした: {e}")
+
+# --- パイプライン ---
+def build_pipeline(video_profile: str = VIDEO_PROFILE, use_cache: bool = True,
+                   record: pipeline_dag.RunRecord | None = None, resume: bool = False) -> pipeline_dag.Pipeline:
+    """パイプラインを依存グラフとして組み立てる。
+    動画の組み立て (ffmpeg) とAIによるHTML生成 (Gemini) は、どちらも選ばれた物語だけに依存するため並行して走る。
+    resume=True なら record に残った前回の結果のうち、まだ有効なステージを飛ばす"""
+    audio_filepath = BGM_FILEPATH
+
+    def write_story():
+        # このステップは失敗しても致命的ではないため、警告に留めて続行
         print("\n1. ネオワールドサーガの物語を自動執筆中...")
-        if not append_saga_story.main():
-            # このステップは失敗しても致命的ではないため、警告に留めて続行
+        if not append_saga_story.main(append_saga_story.RECENT_SECTIONS):
             print("警告: 物語の自動執筆に失敗しました。処理は続行します。", file=sys.stderr)
-        
-        # 2. 動画・HP化する物語をランダムに選択
+
+    def select_story(_):
         print("\n2. 動画・ホームページ化する物語を選択中...")
-        story_content, story_name = load_random_saga_story()
-        if not story_content:
-            print("エラー: 物語を取得できませんでした。処理を中止します。", file=sys.stderr)
-            return 1
+        story_path = select_random_saga_story()
+        if not story_path:
+            raise pipeline_dag.StageFailed("物語を取得できませんでした。処理を中止します。")
+        story_name = os.path.basename(story_path)
         print(f"  - 選択された物語: {story_name}")
-
-        # 変数初期化
-        video_filepath = None
-        html_filepath = None
-        audio_filepath = BGM_FILEPATH
-
-        # 3. ナレーション音声を生成（今回はスキップ）
+        # ナレーション音声の生成は今回はスキップ
         print("\n3. ナレーション音声をスキップし、BGMを使用します。")
+        # 実行記録には本文ではなく、パスと更新時刻だけを残す
+        return {"path": story_path, "name": story_name, "mtime_ns": os.stat(story_path).st_mtime_ns}
 
-        # 4. テキストと映像を合成
+    def build_video(story):
+        # エンコードはffmpegの子プロセスと assemble_video 内のプロセスプールで行われるため、ここはスレッドで待つだけでよい
         print("\n4. 動画を組み立て中 (ImageMagick/ffmpeg版)...")
-        video_filepath = assemble_video.main(story_content, story_name, audio_filepath)
+        video_filepath, _ = assemble_video.main(read_selected_story(story), story["name"], audio_filepath,
+                                                profile=video_profile)
         if not video_filepath:
-            print("エラー: 動画ファイルの組み立てに失敗しました。", file=sys.stderr)
-            return 1
+            raise pipeline_dag.StageFailed("動画ファイルの組み立てに失敗しました。")
         print(f"  - 生成された動画ファイル: {video_filepath}")
-
-        # 5. ホームページコンテンツを生成
-        print("\n5. ホームページコンテンツを生成中 (動画埋め込み)...")
-        html_filepath = generate_ai_homepage.main(story_content, story_name, video_filepath)
+        return video_filepath
+
+    async def generate_story_html(story):
+        story_content = await asyncio.to_thread(read_selected_story, story)
+        print("\n5. ホームページコンテンツを生成中 (AIによるHTML化)...")
+        api_key = gemini_client.get_api_key()
+        if not api_key:
+            raise pipeline_dag.StageFailed("Gemini APIキーが取得できませんでした。")
+        ai_html_content = await generate_ai_homepage.get_ai_story_html_async(api_key, story_content, use_cache)
+        if not ai_html_content:
+            raise pipeline_dag.StageFailed("AIによるコンテンツ生成に失敗しました。")
+        return ai_html_content
+
+    def write_homepage(story, video_filepath, ai_html_content):
+        print("\n6. ホームページを構築中 (動画埋め込み)...")
+        html_filepath = generate_ai_homepage.write_homepage(story["name"], video_filepath, ai_html_content)
         if not html_filepath:
-            print("エラー: ホームページコンテンツの生成に失敗しました。", file=sys.stderr)
-            return 1
+            raise pipeline_dag.StageFailed("ホームページコンテンツの生成に失敗しました。")
         print(f"  - 生成されたHTMLファイル: {html_filepath}")
+        return html_filepath
 
-        # 6. デプロイ
-        print("\n6. ホームページと動画をデプロイ中...")
+    def deploy(video_filepath, _html_filepath):
+        print("\n7. ホームページと動画をデプロイ中...")
         deploy_script_path = os.path.join(script_dir, "deploy_ai_business_homepage.sh")
         deploy_command = [deploy_script_path, video_filepath]
 
-        deploy_process = subprocess.run(deploy_command, capture_output=True, text=True, check=True)
+        try:
+            deploy_process = subprocess.run(deploy_command, capture_output=True, text=True, check=True,
+                                            env=pipeline_metrics.child_env())
+        except subprocess.CalledProcessError as e:
+            pipeline_metrics.record_exit_code(e.returncode)
+            raise
+        pipeline_metrics.record_exit_code(deploy_process.returncode)
         print("--- デプロイスクリプト STDOUT ---")
         print(deploy_process.stdout)
         if deploy_process.stderr:
@@ -103,22 +137,88 @@ def main():
             print(deploy_process.stderr, file=sys.stderr)
         print("デプロイプロセスが完了しました。")
 
-    except subprocess.CalledProcessError as e:
-        print("エラー: スクリプトの実行に失敗しました。", file=sys.stderr)
-        print(f"リターンコード: {e.returncode}", file=sys.stderr)
-        print("\n--- FAILED SCRIPT STDOUT ---", file=sys.stderr)
-        print(e.stdout, file=sys.stderr)
-        print("\n--- FAILED SCRIPT STDERR ---", file=sys.stderr)
-        print(e.stderr, file=sys.stderr)
-        return 1
-    except Exception as e:
-        import traceback
-        print(f"エラー: パイプライン実行中に予期せぬエラーが発生しました: {e}", file=sys.stderr)
-        traceback.print_exc()
+    return pipeline_dag.Pipeline([
+        pipeline_dag.Stage("write_story", write_story),
+        pipeline_dag.Stage("select_story", select_story, deps=("write_story",),
+                           artifacts=lambda story: [story["path"]]),
+        pipeline_dag.Stage("video", build_video, deps=("select_story",), artifacts=lambda path: [path]),
+        pipeline_dag.Stage("story_html", generate_story_html, deps=("select_story",), kind="async"),
+        pipeline_dag.Stage("homepage", write_homepage, deps=("select_story", "video", "story_html"),
+                           artifacts=lambda path: [path]),
+        pipeline_dag.Stage("deploy", deploy, deps=("video", "homepage")),
+    ], record=record, resume=resume)
+
+async def run_pipeline(pipeline: pipeline_dag.Pipeline) -> dict:
+    try:
+        return await pipeline.run_async()
+    finally:
+        await gemini_client.close_async()
+
+# --- メイン処理 ---
+def main(video_profile: str = VIDEO_PROFILE, use_cache: bool = True, resume: bool = False):
+    """動画生成パイプラインをオーケストレーションします。
+    resume=True なら前回の実行記録から、最初に失敗したステージ (または成果物が変わったステージ) 以降だけを実行し直す。"""
+    print("--- 全体オーケストレーター開始 ---")
+    # 物語の自動執筆がSDKを使うため、パイプラインを始める前に確かめる
+    gemini_client.require_genai()
+
+    # 日付を実行条件に含め、前日以前の記録からは再開しない
+    record = pipeline_dag.RunRecord(RUN_RECORD_NAME, params={"video_profile": video_profile,
+                                                             "date": datetime.now().strftime("%Y-%m-%d")})
+    pipeline = build_pipeline(video_profile, use_cache, record, resume)
+    if resume:
+        if not record.load():
+            print("警告: 再開できる実行記録がないため、最初から実行します。", file=sys.stderr)
+            resume = pipeline.resume = False
+        elif record.completed(pipeline.order):
+            print(f"エラー: 前回の実行 ({record.started} 開始) はすべて完了しているため、再開するものがありません。"
+                  "もう一度実行するには --resume を付けずに実行してください。", file=sys.stderr)
+            return 1
+        else:
+            print(f"前回の実行記録 ({record.started} 開始) から再開します: {record.path}")
+    # 常駐プロセスのジョブとして呼ばれた場合は、その実行IDのまま記録する
+    with pipeline_metrics.run(), \
+            pipeline_metrics.stage("daily_pipeline", video_profile=video_profile, resume=resume) as metrics:
+        try:
+            asyncio.run(run_pipeline(pipeline))
+        except pipeline_dag.StageFailed as e:
+            print(f"エラー: {e}", file=sys.stderr)
+            metrics.ok = False
+        except subprocess.CalledProcessError as e:
+            print("エラー: スクリプトの実行に失敗しました。", file=sys.stderr)
+            print(f"リターンコード: {e.returncode}", file=sys.stderr)
+            print("\n--- FAILED SCRIPT STDOUT ---", file=sys.stderr)
+            print(e.stdout, file=sys.stderr)
+            print("\n--- FAILED SCRIPT STDERR ---", file=sys.stderr)
+            print(e.stderr, file=sys.stderr)
+            metrics.ok = False
+        except Exception as e:
+            import traceback
+            print(f"エラー: パイプライン実行中に予期せぬエラーが発生しました: {e}", file=sys.stderr)
+            traceback.print_exc()
+            metrics.ok = False
+        finally:
+            pipeline.print_timings()
+            print(f"実行記録: {record.path} (--resume で失敗したステージから再開できます)")
+        metrics.set(skipped=pipeline.skipped)
+    if not metrics.ok:
         return 1
 
     print("\n--- 全体オーケストレーター完了 ---")
     return 0 # 成功
 
 if __name__ == "__main__":
-    sys.exit(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="物語の自動執筆から動画・ホームページのデプロイまでを実行します。")
+    parser.add_argument("--video-profile", choices=list(assemble_video.ENCODING_PROFILES), default=VIDEO_PROFILE,
+                        help="動画のエンコードプロファイル")
+    parser.add_argument("--no-cache", action="store_true", help="キャッシュされたAI応答を使わずに生成し直す")
+    parser.add_argument("--resume", action="store_true",
+                        help="前回の実行記録から再開し、結果が有効なステージ (物語の選択・動画など) を飛ばす")
+    args = parser.parse_args()
+    import saga_daemon
+    # 常駐プロセスが同じジョブを実行中なら重ねて実行しない
+    with saga_daemon.job_lock("daily_video") as acquired:
+        if not acquired:
+            print("エラー: 日次の動画生成が別のプロセス (常駐プロセスなど) で実行中です。", file=sys.stderr)
+            sys.exit(1)
+        sys.exit(main(video_profile=args.video_profile, use_cache=not args.no_cache, resume=args.resume))
@@ -4,28 +4,25 @@
 
 import sys
 import os
-import glob
-import markdown
 from datetime import datetime
 import re # description生成用
 import shutil # クリーンアップ用
 
+import saga_manifest
+
 # --- 定数 ---
 NWS_COLLECTION_ROOT = os.path.expanduser("~/neo_world_saga_collection/")
 OUTPUT_FILE_PATH = os.path.join(os.path.expanduser("/var/www/html/public/"), "neo_world_saga.html")
 TEMPLATE_FILE = os.path.join(os.path.dirname(__file__), "template.html") # template.htmlのパス
 
-def load_html_template(template_path: str) -> str:
-    """外部のHTMLテンプレートファイルを読み込む"""
+def load_html_template(template_path: str) -> str | None:
+    """外部のHTMLテンプレートファイルを読み込む (失敗したらNone)"""
     try:
         with open(template_path, 'r', encoding='utf-8') as f:
             return f.read()
     except Exception as e:
         print(f"エラー: HTMLテンプレートの読み込みに失敗しました: {e}", file=sys.stderr)
-        sys.exit(1)
-
-# HTMLテンプレートを読み込み
-HTML_TEMPLATE = load_html_template(TEMPLATE_FILE)
+        return None
 
 def generate_description(markdown_text: str) -> str:
     """Markdownテキストからmeta descriptionを生成する"""
@@ -39,28 +36,28 @@ def generate_description(markdown_text: str) -> str:
         description = plain_text
     return description.replace('"', '&quot;')
 
-def main():
-    """メイン関数"""
+def main() -> bool:
+    """メイン関数。HTMLを書き出せればTrue"""
     print("--- マスターサーガ HTML生成ツール ---")
     print(f"対象コレクション: {NWS_COLLECTION_ROOT}")
     print(f"出力ファイル: {OUTPUT_FILE_PATH}")
     print("----------------------------------------")
 
+    # HTMLテンプレートを読み込み (見つからなければ終了)
+    html_template = load_html_template(TEMPLATE_FILE)
+    if html_template is None:
+        return False
+
     # 全てのMarkdownファイルを検索
-    all_md_files = []
     try:
-        for root, _, files in os.walk(NWS_COLLECTION_ROOT):
-            for name in files:
-                if name.endswith(".md"):
-                    all_md_files.append(os.path.join(root, name))
-        all_md_files.sort()
+        all_md_files = saga_manifest.load_manifest(NWS_COLLECTION_ROOT).paths()
     except Exception as e:
         print(f"ファイル検索中にエラーが発生しました: {e}", file=sys.stderr)
-        return
+        return False
 
     if not all_md_files:
         print(f"エラー: {NWS_COLLECTION_ROOT} 以下に .md ファイルが見つかりませんでした。")
-        return
+        return False
 
     print(f"{len(all_md_files)} 個のMarkdownファイルを結合してHTMLを生成します。\n")
 
@@ -72,7 +69,7 @@ def main():
                 combined_markdown_text += f.read() + "\n\n---\n\n" # 各章の間に区切りを追加
         except Exception as e:
             print(f"エラー: {md_file_path} の読み込みに失敗しました: {e}", file=sys.stderr)
-            return
+            return False
     
     # メインのタイトル
     main_title = "ネオワールドサーガ マスターコレクション"
@@ -82,10 +79,11 @@ def main():
 
     # HTMLに変換
     print("結合されたMarkdownをHTMLに変換中...")
+    import markdown # 読み込みに時間がかかるため、HTMLを生成するときに読み込む
     html_content = markdown.markdown(combined_markdown_text, extensions=['fenced_code', 'tables'])
 
     # テンプレートに埋め込み
-    final_html = HTML_TEMPLATE.format(title=main_title, description=description, content=html_content)
+    final_html = html_template.format(title=main_title, description=description, content=html_content)
 
     # HTMLファイルとして保存
     output_dir = os.path.dirname(OUTPUT_FILE_PATH)
@@ -98,9 +96,16 @@ def main():
         print(f"出力ファイル: {OUTPUT_FILE_PATH}")
     except Exception as e:
         print(f"エラー: HTMLファイルの保存に失敗しました: {e}", file=sys.stderr)
-        return
+        return False
 
     print("\n--- 処理完了 ---")
+    return True
 
 if __name__ == "__main__":
-    main()
+    import saga_daemon
+    # 常駐プロセスが同じジョブを実行中なら重ねて実行しない
+    with saga_daemon.job_lock("master_saga") as acquired:
+        if not acquired:
+            print("エラー: マスターサーガの生成が別のプロセス (常駐プロセスなど) で実行中です。", file=sys.stderr)
+            sys.exit(1)
+        sys.exit(0 if main() else 1)
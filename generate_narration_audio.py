@@ -5,12 +5,22 @@
 import os
 import sys
 import subprocess
-import glob
 import random
 import re
+import time
+import wave
+import unicodedata
+import shutil
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import markdown
-from bs4 import BeautifulSoup
+
+import disk_cache
+import markdown_text
+import pipeline_metrics
+import saga_manifest
 
 # --- 定数 ---
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -21,12 +31,28 @@ AUDIO_OUTPUT_DIR = os.path.join(PROJECT_ROOT, "scripts", "generated_audio")
 OPEN_JTALK_DIC = "/var/lib/mecab/dic/open-jtalk/naist-jdic"
 OPEN_JTALK_VOICE = "/usr/share/hts-voice/nitech-jp-atr503-m001/nitech_jp_atr503_m001.htsvoice"
 
+# 並列合成の設定 (文の区切りで分割したチャンクを複数のopen_jtalkで同時に合成する)
+SYNTH_WORKERS = os.cpu_count() or 1
+CHUNK_MAX_CHARS = 300
+SENTENCE_PATTERN = re.compile(r'[^。！？!?]+[。！？!?]*|[。！？!?]+')
+# 文ごとの合成済み音声のキャッシュ (続きが追記された物語は新しい文だけを合成する)
+NARRATION_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+NARRATION_CACHE = disk_cache.DiskCache("narration", NARRATION_CACHE_MAX_BYTES, suffix=".wav")
+# 出力形式 (既定は従来どおりWAV)。wav以外は合成したPCMをffmpegのエンコーダに直接流し込み、連結したWAVを書き出さない。
+# aac (.m4a) と opus はassemble_videoで再エンコードせずにMP4へコピーされる
+NARRATION_FORMATS = {
+    "wav": {"extension": ".wav", "codec_args": None},
+    "aac": {"extension": ".m4a", "codec_args": ['-c:a', 'aac', '-b:a', '64k', '-movflags', '+faststart']},
+    # libopusは48kHz系のサンプルレートしか受け付けないので明示的に変換する
+    "opus": {"extension": ".opus", "codec_args": ['-c:a', 'libopus', '-b:a', '32k', '-application', 'voip', '-ar', '48000']},
+}
+DEFAULT_NARRATION_FORMAT = "wav"
+
 # --- ヘルパー関数 ---
 def load_random_saga_story() -> tuple[str | None, str | None]:
     """ネオワールドサーガの物語をランダムに選び、内容とファイル名を返す"""
     try:
-        search_path = os.path.join(NWS_COLLECTION_ROOT, "**", "*.md")
-        files = glob.glob(search_path, recursive=True)
+        files = saga_manifest.load_manifest(NWS_COLLECTION_ROOT).paths()
         if not files:
             print(f"警告: ディレクトリに物語ファイルが見つかりません: {NWS_COLLECTION_ROOT}", file=sys.stderr)
             return None, None
@@ -40,46 +66,246 @@ def load_random_saga_story() -> tuple[str | None, str | None]:
 
 def clean_text_for_tts(text: str) -> str:
     """音声合成のためにMarkdownからクリーンなテキストを抽出し、改行を句読点に変換する。"""
-    html_content = markdown.markdown(text, extensions=['fenced_code', 'tables'])
-    soup = BeautifulSoup(html_content, 'html.parser')
-    plain_text = soup.get_text()
-
-    # 複数の改行を一つにまとめる
-    plain_text = re.sub(r'\n\s*\n', '\n', plain_text).strip()
+    # 複数の改行・スペースをまとめたプレーンテキスト (同じ本文の変換結果は再利用される)
+    plain_text = markdown_text.extract_plain_text(text)
     # 残った改行を読点に変換し、自然な間を表現
-    plain_text = plain_text.replace('\n', '、')
-    # 複数のスペースを一つに
-    plain_text = re.sub(r' +', ' ', plain_text)
+    return plain_text.replace('\n', '、')
 
-    return plain_text
+def split_sentences(text: str) -> list[str]:
+    """テキストを文末 (。！？) の直後で文に分割する"""
+    return [s.strip() for s in SENTENCE_PATTERN.findall(text) if s.strip()]
 
-# --- Open JTalk実行関数 ---
-def generate_audio_from_text(text: str, output_filepath: str) -> bool:
-    """テキストからOpen JTalkを使って音声ファイルを生成する"""
-    print(f"音声ファイルを生成中: {output_filepath}")
+def chunk_sentences(sentences: list[str], max_chars: int = CHUNK_MAX_CHARS) -> list[str]:
+    """文を順番どおりに、max_chars 程度の長さのチャンクにまとめる"""
+    chunks = []
+    current = ""
+    for sentence in sentences:
+        if current and len(current) + len(sentence) > max_chars:
+            chunks.append(current)
+            current = ""
+        current += sentence
+    if current:
+        chunks.append(current)
+    return chunks
 
+def join_wav_files(input_paths: list[str], output_path: str) -> None:
+    """同じ形式のWAVファイルを順番に連結する。PCMデータはそのままコピーし、ヘッダだけを書き直す"""
+    with wave.open(output_path, 'wb') as out:
+        params = None
+        for path in input_paths:
+            with wave.open(path, 'rb') as src:
+                src_params = (src.getnchannels(), src.getsampwidth(), src.getframerate())
+                if params is None:
+                    params = src_params
+                    out.setnchannels(params[0])
+                    out.setsampwidth(params[1])
+                    out.setframerate(params[2])
+                elif src_params != params:
+                    raise ValueError(f"WAVの形式が一致しません: {path} {src_params} != {params}")
+                out.writeframes(src.readframes(src.getnframes()))
+
+def encode_wav_files(input_paths: list[str], output_path: str, codec_args: list[str]) -> None:
+    """同じ形式のWAVファイルのPCMを順番にffmpegの標準入力へ流し込み、圧縮音声にエンコードする"""
+    with wave.open(input_paths[0], 'rb') as first:
+        channels, sample_width, frame_rate = first.getnchannels(), first.getsampwidth(), first.getframerate()
+    pcm_format = 'u8' if sample_width == 1 else f's{sample_width * 8}le'
+    command = [
+        'ffmpeg', '-loglevel', 'error',
+        '-f', pcm_format, '-ar', str(frame_rate), '-ac', str(channels), '-i', 'pipe:0',
+        *codec_args, '-y', output_path
+    ]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    # ffmpegのエラー出力でパイプが詰まらないよう、別スレッドで読み続ける
+    stderr_chunks = []
+    reader = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)
+    reader.start()
+    try:
+        for path in input_paths:
+            with wave.open(path, 'rb') as src:
+                src_params = (src.getnchannels(), src.getsampwidth(), src.getframerate())
+                if src_params != (channels, sample_width, frame_rate):
+                    raise ValueError(f"WAVの形式が一致しません: {path} {src_params} != {(channels, sample_width, frame_rate)}")
+                process.stdin.write(src.readframes(src.getnframes()))
+        process.stdin.close()
+    except BrokenPipeError:
+        # ffmpegが途中で終了した。原因は下で終了コードとエラー出力から報告する
+        pass
+    except BaseException:
+        process.kill()
+        raise
+    finally:
+        process.wait()
+        reader.join()
+    pipeline_metrics.record_exit_code(process.returncode)
+    if process.returncode != 0:
+        stderr = b"".join(stderr_chunks).decode('utf-8', errors='replace')
+        raise RuntimeError(f"ffmpegの終了コード {process.returncode}: {stderr.strip()}")
+
+def write_narration(clip_paths: list[str], output_path: str, audio_format: str) -> None:
+    """音声クリップを順番に連結して、指定形式の音声ファイルを書き出す"""
+    codec_args = NARRATION_FORMATS[audio_format]["codec_args"]
+    if codec_args is None:
+        join_wav_files(clip_paths, output_path)
+    else:
+        encode_wav_files(clip_paths, output_path, codec_args)
+
+# --- Open JTalk実行関数 ---
+def synthesize_with_open_jtalk(text: str, output_filepath: str) -> None:
+    """1つのopen_jtalkプロセスでテキストを合成する (失敗時は例外を送出)"""
     command = [
         'open_jtalk',
         '-x', OPEN_JTALK_DIC,
         '-m', OPEN_JTALK_VOICE,
         '-ow', output_filepath
     ]
-
     try:
         subprocess.run(command, input=text, text=True, check=True, capture_output=True, encoding='utf-8')
-        print("音声ファイルの生成が完了しました。")
+    except subprocess.CalledProcessError as e:
+        pipeline_metrics.record_exit_code(e.returncode)
+        raise
+    pipeline_metrics.record_exit_code(0)
+
+def sentence_cache_key(sentence: str) -> str:
+    """文の音声キャッシュのキー (正規化した文と、辞書・音声モデルのパス) を返す"""
+    normalized = re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', sentence)).strip()
+    return disk_cache.make_key("open_jtalk", normalized, OPEN_JTALK_DIC, OPEN_JTALK_VOICE)
+
+def synthesize_sentences_cached(sentences: list[str], workers: int = SYNTH_WORKERS,
+                                cache: disk_cache.DiskCache = NARRATION_CACHE) -> list[str]:
+    """各文の音声をキャッシュから集め、ないものだけを並列に合成してキャッシュに保存する。
+    文の順に並んだ音声クリップのパスを返す (失敗時は例外を送出)。"""
+    keys = [sentence_cache_key(sentence) for sentence in sentences]
+    clip_paths = [None] * len(sentences)
+    pending = {}
+    for i, key in enumerate(keys):
+        if key in pending:
+            continue
+        cached_path = cache.get(key)
+        if cached_path:
+            clip_paths[i] = cached_path
+        else:
+            pending[key] = i
+    print(f"ナレーションキャッシュ: ヒット {cache.hits} / ミス {cache.misses} ({len(sentences)} 文)")
+
+    if pending:
+        print(f"{len(pending)} 文を {max(1, min(workers, len(pending)))} 並列で合成中...")
+        temp_paths = {key: cache.temp_path(key) for key in pending}
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                jobs = [(sentences[i], temp_paths[key]) for key, i in pending.items()]
+                synthesize = pipeline_metrics.bind(synthesize_with_open_jtalk)
+                list(executor.map(lambda job: synthesize(*job), jobs))
+            for key, i in pending.items():
+                clip_paths[i] = cache.commit(key, temp_paths.pop(key))
+        finally:
+            for temp_path in temp_paths.values():
+                cache.discard(temp_path)
+
+    # 同じ文の繰り返しは最初に合成したクリップを共有する
+    for i, key in enumerate(keys):
+        if clip_paths[i] is None:
+            clip_paths[i] = cache.path_for(key)
+    return clip_paths
+
+def generate_audio_from_text(text: str, output_filepath: str, workers: int = SYNTH_WORKERS,
+                             use_cache: bool = True, audio_format: str = "wav",
+                             cache: disk_cache.DiskCache = NARRATION_CACHE) -> bool:
+    """テキストからOpen JTalkを使って音声ファイルを生成する。
+    use_cache=True の場合は文ごとの音声キャッシュ (cache) を使い、未合成の文だけを並列に合成して連結する。
+    キャッシュが空だと1文ごとにopen_jtalkを起動するため、初めての物語では use_cache=False より遅い。
+    use_cache=False の場合は文の区切りでチャンクに分け、並列に合成してから順番に連結する。
+    audio_format は NARRATION_FORMATS のキー (出力パスの拡張子は呼び出し側で合わせる)。"""
+    print(f"音声ファイルを生成中: {output_filepath}")
+
+    sentences = split_sentences(text)
+    chunks = chunk_sentences(sentences)
+    # 読み上げる文字を含まない文 (記号のみ) はopen_jtalkに渡さない
+    spoken = [sentence for sentence in sentences if re.search(r'\w', sentence)]
+    if not spoken:
+        print("エラー: 読み上げるテキストがありません。", file=sys.stderr)
+        return False
+    try:
+        if use_cache:
+            try:
+                with pipeline_metrics.stage("open_jtalk", sentences=len(spoken)):
+                    clip_paths = synthesize_sentences_cached(spoken, workers, cache)
+                with pipeline_metrics.stage("encode_narration", format=audio_format):
+                    write_narration(clip_paths, output_filepath, audio_format)
+            finally:
+                stats = cache.save_stats()
+                cache.evict()
+                print(f"ナレーションキャッシュ累計: ヒット {stats['hits']} / ミス {stats['misses']}")
+        elif audio_format == "wav" and (workers <= 1 or len(chunks) <= 1):
+            with pipeline_metrics.stage("open_jtalk", chunks=1):
+                synthesize_with_open_jtalk(text, output_filepath)
+        else:
+            temp_dir = tempfile.mkdtemp(prefix="narration_")
+            try:
+                chunk_paths = [os.path.join(temp_dir, f"chunk_{i:04d}.wav") for i in range(len(chunks))]
+                print(f"{len(chunks)} チャンクを {min(workers, len(chunks))} 並列で合成中...")
+                with pipeline_metrics.stage("open_jtalk", chunks=len(chunks)), \
+                        ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                    # map() は入力順に結果を返し、1つでも失敗すれば例外が送出される
+                    list(executor.map(pipeline_metrics.bind(synthesize_with_open_jtalk), chunks, chunk_paths))
+                with pipeline_metrics.stage("encode_narration", format=audio_format):
+                    write_narration(chunk_paths, output_filepath, audio_format)
+            finally:
+                shutil.rmtree(temp_dir)
+        print(f"音声ファイルの生成が完了しました ({os.path.getsize(output_filepath) / 1024:.1f} KB)。")
         return True
     except subprocess.CalledProcessError as e:
         print(f"エラー: Open JTalkの実行に失敗しました。", file=sys.stderr)
         print(f"エラー出力:\n{e.stderr}", file=sys.stderr)
         return False
-    except FileNotFoundError:
-        print(f"エラー: 'open_jtalk' コマンドが見つかりません。インストールされているか確認してください。", file=sys.stderr)
+    except FileNotFoundError as e:
+        command = os.path.basename(e.filename) if e.filename else 'open_jtalk'
+        print(f"エラー: '{command}' コマンドが見つかりません。インストールされているか確認してください。", file=sys.stderr)
+        return False
+    except RuntimeError as e:
+        print(f"エラー: 音声のエンコードに失敗しました: {e}", file=sys.stderr)
         return False
+    except (wave.Error, ValueError) as e:
+        print(f"エラー: 音声チャンクの連結に失敗しました: {e}", file=sys.stderr)
+        return False
+
+def benchmark_synthesis(story_content: str) -> None:
+    """同じ物語を1プロセス合成・並列チャンク合成・文ごとのキャッシュ合成 (既定の方式) で音声化し、所要時間を比較する。
+    キャッシュ合成は空の一時キャッシュで測り (コールド: 1文ごとにopen_jtalkを起動)、
+    続けて同じキャッシュで再実行する (ウォーム: 合成なし)。普段のキャッシュには書き込まない"""
+    cleaned_story = clean_text_for_tts(story_content)
+    temp_dir = tempfile.mkdtemp(prefix="narration_bench_")
+    # 共有の NARRATION_CACHE には触れず、一時ディレクトリに置いた別のキャッシュで測る
+    bench_cache = disk_cache.DiskCache(NARRATION_CACHE.name, NARRATION_CACHE.max_bytes, suffix=NARRATION_CACHE.suffix)
+    bench_cache.root = os.path.join(temp_dir, "cache")
+    try:
+        results = {}
+        runs = [
+            ("1プロセス", 1, False),
+            (f"{SYNTH_WORKERS}並列チャンク", SYNTH_WORKERS, False),
+            ("文キャッシュ (コールド)", SYNTH_WORKERS, True),
+            ("文キャッシュ (ウォーム)", SYNTH_WORKERS, True),
+        ]
+        for i, (label, workers, use_cache) in enumerate(runs):
+            start = time.perf_counter()
+            output_path = os.path.join(temp_dir, f"{i}.wav")
+            if not generate_audio_from_text(cleaned_story, output_path, workers, use_cache=use_cache, cache=bench_cache):
+                print(f"{label}: 合成に失敗しました。", file=sys.stderr)
+                return
+            results[label] = time.perf_counter() - start
+    finally:
+        shutil.rmtree(temp_dir)
+    sentences = [sentence for sentence in split_sentences(cleaned_story) if re.search(r'\w', sentence)]
+    print(f"--- 合成ベンチマーク ({len(cleaned_story)} 文字, {len(sentences)} 文, "
+          f"{len(chunk_sentences(split_sentences(cleaned_story)))} チャンク) ---")
+    single = results["1プロセス"]
+    for label, seconds in results.items():
+        print(f"{label}: {seconds:.2f}秒 (1プロセスの {single / seconds:.2f} 倍)")
 
 # --- メイン処理 ---
-def main(input_story_content: str = None, input_story_name: str = None) -> str | None:
-    """メイン関数"""
+@pipeline_metrics.instrument("generate_narration_audio")
+def main(input_story_content: str = None, input_story_name: str = None,
+         audio_format: str = DEFAULT_NARRATION_FORMAT, use_cache: bool = True) -> str | None:
+    """メイン関数 (use_cache=False なら文キャッシュを使わずにチャンク単位で並列合成する)"""
     print("--- ナレーション音声生成ツール ---")
 
     os.makedirs(AUDIO_OUTPUT_DIR, exist_ok=True)
@@ -101,10 +327,11 @@ def main(input_story_content: str = None, input_story_name: str = None) -> str |
 
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     safe_story_name = re.sub(r'[^\w\-_\. ]', '_', story_name.replace('.md', ''))
-    output_filename = f"narration_{safe_story_name}_{timestamp}.wav"
+    extension = NARRATION_FORMATS[audio_format]["extension"]
+    output_filename = f"narration_{safe_story_name}_{timestamp}{extension}"
     output_filepath = os.path.join(AUDIO_OUTPUT_DIR, output_filename)
     
-    if not generate_audio_from_text(cleaned_story, output_filepath):
+    if not generate_audio_from_text(cleaned_story, output_filepath, use_cache=use_cache, audio_format=audio_format):
         return None
 
     print(f"\n生成されたファイル: {output_filepath}")
@@ -113,18 +340,27 @@ def main(input_story_content: str = None, input_story_name: str = None) -> str |
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 3:
-        try:
-            with open(sys.argv[1], 'r', encoding='utf-8') as f:
-                content = f.read()
-            # mainの戻り値でexitコードを決定
-            if main(content, sys.argv[2]):
-                sys.exit(0)
-            else:
-                sys.exit(1)
-        except Exception as e:
-            print(f"エラー: コマンドライン引数からの物語読み込み中にエラー: {e}", file=sys.stderr)
+    parser = argparse.ArgumentParser(description="物語からOpen JTalkでナレーション音声を生成します。")
+    parser.add_argument("story_filepath", help="物語のMarkdownファイル")
+    parser.add_argument("story_name", help="物語名 (出力ファイル名に使用)")
+    parser.add_argument("--format", choices=list(NARRATION_FORMATS), default=DEFAULT_NARRATION_FORMAT,
+                        help="出力形式 (既定: wav。aac/opus を指定するとWAVを経由せずに圧縮する)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="文ごとの音声キャッシュを使わず、チャンク単位で並列に合成する (初めての物語ではこちらが速い)")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="音声は保存せず、1プロセス・並列チャンク・文キャッシュ (コールド/ウォーム) の所要時間を比較する")
+    args = parser.parse_args()
+    try:
+        with open(args.story_filepath, 'r', encoding='utf-8') as f:
+            content = f.read()
+        if args.benchmark:
+            benchmark_synthesis(content)
+            sys.exit(0)
+        # mainの戻り値でexitコードを決定
+        if main(content, args.story_name, args.format, use_cache=not args.no_cache):
+            sys.exit(0)
+        else:
             sys.exit(1)
-    else:
-        print("使用法: python generate_narration_audio.py <story_filepath> <story_name>", file=sys.stderr)
-        sys.exit(1)
\ No newline at end of file
+    except Exception as e:
+        print(f"エラー: コマンドライン引数からの物語読み込み中にエラー: {e}", file=sys.stderr)
+        sys.exit(1)
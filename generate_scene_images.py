@@ -1,6 +1,6 @@
 #!/home/hirosi/my_gemini_project/venv/bin/python
 # -*- coding: utf-8 -*-
-# DESCRIPTION: 物語のテキストからImageMagickを使ってシーン画像を生成します。
+# DESCRIPTION: 物語のテキストからPillow (またはImageMagick) を使ってシーン画像を生成します。
 
 import os
 import sys
@@ -9,8 +9,10 @@ import glob
 import random
 import re
 from datetime import datetime
-import markdown
-from bs4 import BeautifulSoup
+
+import markdown_text
+import pipeline_metrics
+import text_rasterizer
 
 # --- 定数 ---
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -20,15 +22,13 @@ IMAGE_OUTPUT_DIR = os.path.join(PROJECT_ROOT, "scripts", "generated_images")
 # ImageMagickのフォント設定 (要調整。システムにインストールされているフォント名を使用)
 # 日本語フォント例: 'Noto-Sans-JP', 'TakaoPGothic', 'IPAPGothic' など
 FONT = "Noto-Sans-JP" # システムにインストールされているフォント名
+POINTSIZE = 40
+INTERLINE_SPACING = 15
 
 # --- ヘルパー関数 ---
 def clean_text_for_image(text: str, max_length: int = 100) -> str:
     """画像生成のためにMarkdownからクリーンなテキストを抽出・要約する"""
-    html_content = markdown.markdown(text, extensions=['fenced_code', 'tables'])
-    soup = BeautifulSoup(html_content, 'html.parser')
-    plain_text = soup.get_text()
-    plain_text = re.sub(r'\n\s*\n', '\n', plain_text).strip()
-    plain_text = re.sub(r' +', ' ', plain_text)
+    plain_text = markdown_text.extract_plain_text(text)
 
     if len(plain_text) > max_length:
         plain_text = plain_text[:max_length].rsplit(' ', 1)[0] + '...' if ' ' in plain_text[:max_length] else plain_text[:max_length] + '...'
@@ -36,17 +36,29 @@ def clean_text_for_image(text: str, max_length: int = 100) -> str:
     return plain_text or "物語の要約"
 
 def generate_image_from_text(text: str, output_filepath: str, width=1280, height=720) -> bool:
-    """ImageMagickを使ってテキストから画像を生成する。成功すればTrue、失敗すればFalseを返す。"""
+    """テキストから画像を生成する。成功すればTrue、失敗すればFalseを返す。
+    プロセス内ラスタライザ (Pillow) が使えない場合はImageMagickで生成する。"""
     print(f"画像を生成中: {output_filepath}")
 
+    rasterizer = text_rasterizer.get_rasterizer(FONT) if FONT else None
+    if rasterizer:
+        try:
+            image = rasterizer.render_annotate(text, width, height, POINTSIZE, INTERLINE_SPACING)
+            text_rasterizer.save_png(image, output_filepath)
+            pipeline_metrics.record_file(output_filepath)
+            print("画像の生成が完了しました。")
+            return True
+        except Exception as e:
+            print(f"警告: Pillowでの画像生成に失敗したため、ImageMagickで再試行します: {e}", file=sys.stderr)
+
     command = [
         'convert',
         '-size', f'{width}x{height}',
         'xc:black',
         '-fill', 'white',
         '-gravity', 'center',
-        '-pointsize', '40',
-        '-interline-spacing', '15',
+        '-pointsize', str(POINTSIZE),
+        '-interline-spacing', str(INTERLINE_SPACING),
     ]
 
     # フォントが指定されていればコマンドに追加
@@ -57,6 +69,8 @@ def generate_image_from_text(text: str, output_filepath: str, width=1280, height
 
     try:
         result = subprocess.run(command, check=True, capture_output=True, text=True, encoding='utf-8')
+        pipeline_metrics.record_exit_code(result.returncode)
+        pipeline_metrics.record_file(output_filepath)
         print("画像の生成が完了しました。")
         if not os.path.exists(output_filepath):
              print(f"エラー: 画像生成は成功しましたが、ファイルが見つかりません: {output_filepath}", file=sys.stderr)
@@ -66,6 +80,7 @@ def generate_image_from_text(text: str, output_filepath: str, width=1280, height
         print("エラー: 'convert' コマンドが見つかりません。ImageMagickがインストールされているか確認してください。", file=sys.stderr)
         return False
     except subprocess.CalledProcessError as e:
+        pipeline_metrics.record_exit_code(e.returncode)
         print("エラー: ImageMagickの実行に失敗しました。", file=sys.stderr)
         print(f"コマンド: {' '.join(e.cmd)}", file=sys.stderr)
         print(f"リターンコード: {e.returncode}", file=sys.stderr)
@@ -73,6 +88,7 @@ def generate_image_from_text(text: str, output_filepath: str, width=1280, height
         return False
 
 # --- メイン処理 ---
+@pipeline_metrics.instrument("generate_scene_images")
 def main(input_story_content: str = None, input_story_name: str = None) -> str | None:
     """メイン関数。成功した場合は画像ファイルパスを、失敗した場合はNoneを返す。"""
     print("--- シーン画像生成ツール ---")
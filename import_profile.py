@@ -0,0 +1,125 @@
+#!/home/hirosi/my_gemini_project/venv/bin/python
+# -*- coding: utf-8 -*-
+# DESCRIPTION: 各スクリプトの起動時のインポート時間を `python -X importtime` で測り、重いモジュールと基準値からの増加を報告します。
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+from disk_cache import CACHE_ROOT
+
+# --- 定数 ---
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 測定するスクリプト (cronやオーケストレーターから起動されるもの)
+ENTRY_MODULES = [
+    "generate_daily_video_and_homepage",
+    "append_saga_story",
+    "assemble_video",
+    "generate_ai_homepage",
+    "generate_narration_audio",
+    "generate_scene_images",
+    "generate_master_saga",
+    "nws_writer",
+    "brush_up_homepage",
+    "saga_search",
+]
+BASELINE_PATH = os.path.join(CACHE_ROOT, "import_times.json")
+# 測定のばらつきを抑えるため、各スクリプトを複数回測って最小値を使う
+REPEATS = 3
+# 基準値からこの割合と絶対値の両方を超えて遅くなったら退行とみなす
+REGRESSION_RATIO = 0.2
+REGRESSION_SLACK_MS = 20.0
+TOP_IMPORTS = 3
+
+# --- 測定 ---
+def parse_importtime(stderr: str) -> list[tuple[str, int, int]]:
+    """`-X importtime` の出力を (モジュール名, 入れ子の深さ (最上位が0), 累積マイクロ秒) のリストにする"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue # 見出し行
+        # 区切りの後の空白1つに続いて、入れ子1段につき2つの空白で字下げされている
+        name = parts[2].rstrip()[1:]
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((name.strip(), depth, int(parts[1])))
+    return entries
+
+def measure_import(module: str, python: str = sys.executable) -> tuple[float, list[tuple[str, float]]]:
+    """module をインポートするのにかかった時間 (ミリ秒) と、直接インポートした重いモジュールの上位を返す"""
+    result = subprocess.run([python, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=SCRIPT_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        last_line = (result.stderr.strip().splitlines() or ["(出力なし)"])[-1]
+        raise RuntimeError(f"{module} をインポートできませんでした: {last_line}")
+    entries = parse_importtime(result.stderr)
+    total = next((us for name, depth, us in entries if name == module and depth == 0), None)
+    if total is None:
+        raise RuntimeError(f"{module} のインポート時間が出力に見つかりません")
+    # 対象モジュールの中で直接インポートされたもの (深さ1) のうち重いもの
+    children = sorted(((name, us / 1000) for name, depth, us in entries if depth == 1), key=lambda item: -item[1])
+    return total / 1000, children[:TOP_IMPORTS]
+
+def measure_all(modules: list[str], repeats: int = REPEATS) -> dict[str, dict]:
+    results = {}
+    for module in modules:
+        best = None
+        try:
+            for _ in range(max(1, repeats)):
+                total, top = measure_import(module)
+                if best is None or total < best[0]:
+                    best = (total, top)
+        except RuntimeError as e:
+            print(f"警告: {e}", file=sys.stderr)
+            continue
+        results[module] = {"ms": round(best[0], 1), "top": [[name, round(ms, 1)] for name, ms in best[1]]}
+    return results
+
+def load_baseline(path: str) -> dict[str, float]:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_baseline(path: str, results: dict[str, dict]) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({module: result["ms"] for module, result in results.items()}, f, ensure_ascii=False, indent=2)
+
+def is_regression(ms: float, baseline_ms: float) -> bool:
+    return ms > baseline_ms * (1 + REGRESSION_RATIO) and ms - baseline_ms > REGRESSION_SLACK_MS
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="スクリプトの起動時のインポート時間を測定し、基準値と比べます。")
+    parser.add_argument("modules", nargs="*", default=ENTRY_MODULES, help="測定するモジュール (省略時は主なスクリプトすべて)")
+    parser.add_argument("--repeats", type=int, default=REPEATS, help="各スクリプトを測る回数 (最小値を使う)")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="基準値のJSONファイル")
+    parser.add_argument("--save", action="store_true", help="今回の測定値を基準値として保存する")
+    parser.add_argument("--check", action="store_true", help="基準値より遅くなったスクリプトがあれば終了コード1で終わる")
+    args = parser.parse_args()
+
+    results = measure_all(args.modules, args.repeats)
+    baseline = load_baseline(args.baseline)
+    regressions = []
+    print(f"{'スクリプト':<36}{'起動ms':>9}{'基準ms':>9}  重いインポート")
+    for module, result in results.items():
+        base = baseline.get(module)
+        mark = ""
+        if base is not None and is_regression(result["ms"], base):
+            regressions.append(module)
+            mark = " ← 遅くなりました"
+        top = ", ".join(f"{name} {ms:.0f}ms" for name, ms in result["top"])
+        base_text = f"{base:.1f}" if base is not None else "-"
+        print(f"{module:<36}{result['ms']:>9.1f}{base_text:>9}  {top}{mark}")
+
+    if args.save:
+        save_baseline(args.baseline, results)
+        print(f"基準値を保存しました: {args.baseline}")
+    if args.check and regressions:
+        print(f"エラー: 起動時間が基準値より遅くなりました: {', '.join(regressions)}", file=sys.stderr)
+        sys.exit(1)
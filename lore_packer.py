@@ -0,0 +1,123 @@
+#!/home/hirosi/my_gemini_project/venv/bin/python
+# -*- coding: utf-8 -*-
+# DESCRIPTION: 背景資料を節に分け、執筆指示との関連度が高い節からトークン予算の範囲でプロンプトに詰め込みます。
+
+import re
+import sys
+import math
+import hashlib
+import argparse
+import unicodedata
+from collections import Counter
+
+from saga_search import ngrams, bm25
+
+# --- 定数 ---
+# 背景資料に使うトークン数の既定値
+LORE_TOKEN_BUDGET = 30000
+# 1つの節の最大文字数 (これより長い節は段落単位で分割する)
+SECTION_MAX_CHARS = 2000
+# 見出しと区切り線 (---, ***, ___) の行で節を分ける
+SECTION_BREAK_RE = re.compile(r'^(?=#{1,6}\s)|^[ ]{0,3}(?:[-*_][ ]*){3,}$\n?', re.MULTILINE)
+# トークン数の見積もり: 日本語 (CJK・かな) は1文字1トークン、それ以外は4文字1トークン
+WIDE_CHAR_RE = re.compile(r'[　-ヿ㐀-䶿一-鿿豈-﫿＀-￯]')
+
+# --- ヘルパー関数 ---
+def estimate_tokens(text: str) -> int:
+    """文字種から大まかなトークン数を見積もる"""
+    wide = len(WIDE_CHAR_RE.findall(text))
+    return wide + math.ceil((len(text) - wide) / 4)
+
+def split_sections(text: str, max_chars: int = SECTION_MAX_CHARS) -> list[str]:
+    """見出し・区切り線で節に分け、長すぎる節は段落の境目で max_chars 以下にまとめ直す"""
+    sections = []
+    for part in SECTION_BREAK_RE.split(text):
+        part = part.strip()
+        if not part:
+            continue
+        if len(part) <= max_chars:
+            sections.append(part)
+            continue
+        current = ""
+        for paragraph in re.split(r'\n\s*\n', part):
+            paragraph = paragraph.strip()
+            if current and len(current) + len(paragraph) + 2 > max_chars:
+                sections.append(current)
+                current = ""
+            current = f"{current}\n\n{paragraph}" if current else paragraph
+            # 1段落だけで長すぎる場合は文字数で切る
+            while len(current) > max_chars:
+                sections.append(current[:max_chars])
+                current = current[max_chars:]
+        if current:
+            sections.append(current)
+    return sections
+
+def pack_lore(lore_data: dict[str, str], user_instruction: str,
+              token_budget: int = LORE_TOKEN_BUDGET) -> tuple[dict[str, list[str]], int]:
+    """背景資料の節を執筆指示との関連度 (BM25) で順位づけし、予算内で上位から選ぶ。
+    重複する節は1度だけ使い、選んだ節は資料・節の元の順番に並べ直す。
+    ({ファイル名: [節, ...]}, 見積もりトークン数) を返す。"""
+    sections = []
+    seen = set()
+    for file_order, (filename, content) in enumerate(lore_data.items()):
+        for section_order, section in enumerate(split_sections(content)):
+            key = hashlib.blake2b(unicodedata.normalize('NFKC', ' '.join(section.split())).encode('utf-8'),
+                                  digest_size=16).digest()
+            if key in seen:
+                continue
+            seen.add(key)
+            sections.append({
+                "order": (file_order, section_order),
+                "filename": filename,
+                "text": section,
+                "grams": ngrams(section),
+                "tokens": estimate_tokens(section),
+            })
+    if not sections:
+        return {}, 0
+
+    query = ngrams(user_instruction)
+    df = Counter()
+    for section in sections:
+        df.update(gram for gram in query if gram in section["grams"])
+    avg_length = sum(sum(s["grams"].values()) for s in sections) / len(sections)
+    for section in sections:
+        length = sum(section["grams"].values())
+        section["score"] = sum(
+            count * bm25(section["grams"][gram], df[gram], len(sections), length, avg_length)
+            for gram, count in query.items() if gram in section["grams"]
+        )
+
+    # 関連度が同じなら元の順番を優先し、結果を安定させる
+    selected, used = [], 0
+    for section in sorted(sections, key=lambda s: (-s["score"], s["order"])):
+        if used + section["tokens"] > token_budget:
+            continue
+        selected.append(section)
+        used += section["tokens"]
+
+    packed = {}
+    for section in sorted(selected, key=lambda s: s["order"]):
+        packed.setdefault(section["filename"], []).append(section["text"])
+    return packed, used
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="背景資料を執筆指示に合わせてトークン予算内に詰め込み、結果を表示します。")
+    parser.add_argument("instruction", help="執筆指示")
+    parser.add_argument("files", nargs="+", help="背景資料のMarkdownファイル")
+    parser.add_argument("--budget", type=int, default=LORE_TOKEN_BUDGET, help="背景資料に使うトークン数")
+    args = parser.parse_args()
+
+    lore_data = {}
+    for path in args.files:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                lore_data[path] = f.read()
+        except OSError as e:
+            print(f"警告: ファイル読み込み中にエラー - {path}: {e}", file=sys.stderr)
+    total = sum(estimate_tokens(content) for content in lore_data.values())
+    packed, used = pack_lore(lore_data, args.instruction, args.budget)
+    print(f"背景資料: 全体 約{total} トークン → 選択 約{used} トークン (予算 {args.budget})")
+    for filename, chunks in packed.items():
+        print(f"  {filename}: {len(chunks)} 節")
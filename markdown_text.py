@@ -0,0 +1,251 @@
+#!/home/hirosi/my_gemini_project/venv/bin/python
+# -*- coding: utf-8 -*-
+# DESCRIPTION: MarkdownをHTMLに直列化せずに、要素ツリーから直接プレーンテキストを抽出します (markdown + BeautifulSoup の get_text() 相当)。
+
+import os
+import re
+import sys
+import glob
+import html
+import time
+import argparse
+import hashlib
+import threading
+from collections import OrderedDict
+from html.entities import html5
+
+# --- 定数 ---
+NWS_COLLECTION_ROOT = os.path.expanduser("~/neo_world_saga_collection/")
+# 抽出結果を保持する件数 (キーは本文のハッシュ)
+MEMO_MAX_ENTRIES = 64
+# ベンチマークに使う物語のサイズ
+BENCHMARK_BYTES = 1024 * 1024
+MARKDOWN_EXTENSIONS = ['fenced_code', 'tables']
+# テキストを集める処理の優先度 (段落の改行を整える prettify と、エスケープを戻す unescape の後に実行する)
+COLLECTOR_PRIORITY = -10
+
+# 生のHTMLブロックや、get_text() の結果が構文解析に依存するタグを含む文書は
+# 従来どおり markdown + BeautifulSoup で処理する
+RAW_HTML_RE = re.compile(r'^[ ]{0,3}<[A-Za-z!?/]|<(?:script|style|textarea|title)\b|<!\[CDATA\[', re.MULTILINE | re.IGNORECASE)
+# BeautifulSoupが文字に戻す文字参照 (それ以外の & はMarkdownがエスケープする)
+ENTITY_REF_RE = re.compile(r'&(\#[0-9]+|\#[xX][0-9a-fA-F]+|[0-9a-zA-Z]+);')
+# BeautifulSoupが空白とみなす文字と、空白をそのまま残す要素
+ASCII_SPACES = ' \n\t\x0c\r'
+PRESERVE_WHITESPACE_TAGS = frozenset(['pre', 'textarea'])
+# 退避されたHTML (インラインのタグ・文字参照・フェンスで囲まれたコード) からテキストを取り出す
+RAW_TAG_RE = re.compile(r'<!--.*?-->|<[^>]*>', re.DOTALL)
+
+# --- 抽出 ---
+def _decode_entity(m: re.Match) -> str:
+    """BeautifulSoup (html.parser) と同じように文字参照を文字に戻す"""
+    name = m.group(1)
+    if name.startswith('#'):
+        return html.unescape(m.group(0))
+    if name[0].isdigit():
+        return m.group(0)
+    character = html5.get(name + ';')
+    # 未知の名前はセミコロンを除いてそのまま残る
+    return character if character is not None else '&' + name
+
+def _raw_html_text(raw) -> str:
+    """Markdownが退避したHTMLを、get_text() と同じようにタグを除いたテキストにする"""
+    if not isinstance(raw, str):
+        # 要素として退避されたもの
+        return ''.join(raw.itertext())
+    return ENTITY_REF_RE.sub(_decode_entity, RAW_TAG_RE.sub('', raw))
+
+def _element_strings(element, preserve: bool = False):
+    """要素ツリーの文字列を文書順に (文字列, 空白を保持するか) として返す"""
+    preserve = preserve or element.tag in PRESERVE_WHITESPACE_TAGS
+    if element.text:
+        yield element.text, preserve
+    for child in element:
+        yield from _element_strings(child, preserve)
+        if child.tail:
+            yield child.tail, preserve
+
+def _collapse_spaces(text: str) -> str:
+    """BeautifulSoupと同じく、空白だけの文字列を改行1つ (改行を含まなければスペース1つ) にまとめる"""
+    if text and not text.strip(ASCII_SPACES):
+        return '\n' if '\n' in text else ' '
+    return text
+
+def _tree_text(root, stash, placeholder_re: re.Pattern, amp_substitute: str) -> str:
+    """要素ツリーのテキストを、HTMLに直列化して get_text() した場合と同じ文字列にする。
+    直列化すると残る文字参照 (コード中の &lt; やメールアドレスの難読化など) は文字に戻し、
+    退避されたHTMLのプレースホルダはそのテキストに置き換える"""
+    parts = []
+    for text, preserve in _element_strings(root):
+        text = ENTITY_REF_RE.sub(_decode_entity, text.replace(amp_substitute, '&'))
+        # 退避されたタグの前後で文字列が分かれる (文字参照は前後の文字列とつながる)
+        pieces = placeholder_re.split(text)
+        current = pieces[0]
+        for index, following in zip(pieces[1::2], pieces[2::2]):
+            raw = stash.rawHtmlBlocks[int(index)]
+            if isinstance(raw, str) and not RAW_TAG_RE.search(raw):
+                current += _raw_html_text(raw)
+            else:
+                parts.append(current if preserve else _collapse_spaces(current))
+                parts.append(_raw_html_text(raw))
+                current = ''
+            current += following
+        parts.append(current if preserve else _collapse_spaces(current))
+    return ''.join(parts)
+
+_local = threading.local()
+
+def _text_markdown():
+    """テキスト抽出用に設定したMarkdownインスタンスを返す (インスタンスはスレッドごとに1つ作って使い回す)"""
+    md = getattr(_local, "md", None)
+    if md is None:
+        import markdown # 読み込みに時間がかかるため、最初に変換するときに読み込む
+        from markdown.treeprocessors import Treeprocessor
+        from markdown.util import AMP_SUBSTITUTE, HTML_PLACEHOLDER_RE
+
+        class TextCollector(Treeprocessor):
+            """要素ツリーのテキストを md.plain_text に保存し、HTMLへの直列化を省くために空の文書を返す"""
+
+            def run(self, root):
+                self.md.plain_text = _tree_text(root, self.md.htmlStash, HTML_PLACEHOLDER_RE, AMP_SUBSTITUTE)
+                return root.makeelement(root.tag, {})
+
+        md = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+        md.treeprocessors.register(TextCollector(md), 'plain_text', COLLECTOR_PRIORITY)
+        _local.md = md
+    return md
+
+def _reference_markdown_to_text(text: str) -> str:
+    """従来の方法 (markdown → HTML → BeautifulSoup) でテキストを取り出す"""
+    import markdown
+    from bs4 import BeautifulSoup
+    html_content = markdown.markdown(text, extensions=MARKDOWN_EXTENSIONS)
+    return BeautifulSoup(html_content, 'html.parser').get_text()
+
+def normalize_plain_text(text: str) -> str:
+    """空行をまとめ、前後の空白を除き、連続するスペースを1つにする"""
+    text = re.sub(r'\n\s*\n', '\n', text).strip()
+    return re.sub(r' +', ' ', text)
+
+def markdown_to_text(text: str) -> str:
+    """Markdownを get_text() と同じプレーンテキストに変換する (前後の改行などの空白は異なりうる。メモ化なし)"""
+    if RAW_HTML_RE.search(text):
+        try:
+            return _reference_markdown_to_text(text)
+        except ImportError:
+            # bs4 がない環境では、HTMLブロックもタグを除いて近似的に処理する
+            pass
+    if not text.strip():
+        return ''
+    md = _text_markdown()
+    md.reset()
+    md.plain_text = ''
+    md.convert(text)
+    return md.plain_text
+
+_memo = OrderedDict()
+_memo_lock = threading.Lock()
+
+def extract_plain_text(text: str) -> str:
+    """Markdownから、空行をまとめたプレーンテキストを抽出する。
+    同じ本文は内容のハッシュで覚えておき、2回目以降は変換しない。"""
+    key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+    with _memo_lock:
+        cached = _memo.get(key)
+        if cached is not None:
+            _memo.move_to_end(key)
+            return cached
+    plain_text = normalize_plain_text(markdown_to_text(text))
+    with _memo_lock:
+        _memo[key] = plain_text
+        if len(_memo) > MEMO_MAX_ENTRIES:
+            _memo.popitem(last=False)
+    return plain_text
+
+def clear_memo() -> None:
+    with _memo_lock:
+        _memo.clear()
+
+# --- 検証・ベンチマーク ---
+def find_story_files(paths: list[str]) -> list[str]:
+    """指定されたファイル/ディレクトリ (省略時は物語コレクション) 以下のMarkdownファイルを返す"""
+    files = []
+    for path in paths or [NWS_COLLECTION_ROOT]:
+        if os.path.isdir(path):
+            files.extend(glob.glob(os.path.join(path, "**", "*.md"), recursive=True))
+        elif os.path.isfile(path):
+            files.append(path)
+    return sorted(files)
+
+def verify(paths: list[str]) -> bool:
+    """各ファイルについて、従来の markdown + BeautifulSoup の結果と一致するか確認する"""
+    files = find_story_files(paths)
+    if not files:
+        print("エラー: 検証するMarkdownファイルが見つかりません。", file=sys.stderr)
+        return False
+    mismatches = 0
+    for path in files:
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        expected = normalize_plain_text(_reference_markdown_to_text(text))
+        actual = normalize_plain_text(markdown_to_text(text))
+        if actual != expected:
+            mismatches += 1
+            position = next((i for i, (a, b) in enumerate(zip(actual, expected)) if a != b),
+                            min(len(actual), len(expected)))
+            print(f"不一致: {path} ({position} 文字目)")
+            print(f"  従来: {expected[max(0, position - 30):position + 30]!r}")
+            print(f"  高速: {actual[max(0, position - 30):position + 30]!r}")
+    print(f"検証結果: {len(files) - mismatches} / {len(files)} ファイルが一致")
+    return mismatches == 0
+
+def benchmark(paths: list[str]) -> None:
+    """約1MBの物語で、従来の変換・高速な抽出・メモ化済みの抽出の所要時間を比較する"""
+    sources = []
+    for path in find_story_files(paths):
+        with open(path, 'r', encoding='utf-8') as f:
+            sources.append(f.read())
+    if not sources:
+        sources = ["# 第一章\n\n**ネオワールド**の空は、今日も*静か*だった。\n\n> 「行こう」と彼は言った。\n\n- 星図\n- 古い鍵\n\n---\n"]
+    parts, size = [], 0
+    while size < BENCHMARK_BYTES:
+        for source in sources:
+            parts.append(source)
+            size += len(source.encode('utf-8'))
+            if size >= BENCHMARK_BYTES:
+                break
+    text = "\n\n".join(parts)
+    print(f"--- Markdown抽出ベンチマーク ({len(text.encode('utf-8')) / 1024 / 1024:.2f} MB) ---")
+
+    start = time.perf_counter()
+    expected = normalize_plain_text(_reference_markdown_to_text(text))
+    reference_seconds = time.perf_counter() - start
+
+    clear_memo()
+    start = time.perf_counter()
+    actual = extract_plain_text(text)
+    fast_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    extract_plain_text(text)
+    memo_seconds = time.perf_counter() - start
+
+    print(f"markdown + BeautifulSoup: {reference_seconds:.3f}秒")
+    print(f"直接抽出: {fast_seconds:.3f}秒 ({reference_seconds / fast_seconds:.1f} 倍)")
+    print(f"メモ化済み: {memo_seconds * 1000:.2f}ミリ秒")
+    print(f"出力の一致: {'OK' if actual == expected else 'NG'}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Markdownからプレーンテキストを抽出します。")
+    parser.add_argument("paths", nargs="*", help="Markdownファイルまたはディレクトリ (省略時は物語コレクション)")
+    parser.add_argument("--verify", action="store_true", help="従来の markdown + BeautifulSoup の結果と比較する")
+    parser.add_argument("--benchmark", action="store_true", help="約1MBの物語で抽出速度を比較する")
+    args = parser.parse_args()
+
+    if args.verify:
+        sys.exit(0 if verify(args.paths) else 1)
+    if args.benchmark:
+        benchmark(args.paths)
+        sys.exit(0)
+    for path in find_story_files(args.paths):
+        with open(path, 'r', encoding='utf-8') as f:
+            print(extract_plain_text(f.read()))
@@ -4,21 +4,20 @@
 import time
 import sys
 import os
-import glob
+import argparse
+import tempfile
 from datetime import datetime
-try:
-    import google.generativeai as genai # Gemini API Library
-except ImportError:
-    print("エラー: 'google-generativeai' ライブラリが見つかりません。", file=sys.stderr)
-    print("以下のコマンドでインストールしてください:", file=sys.stderr)
-    print("pip install google-generativeai", file=sys.stderr)
-    sys.exit(1)
+
+import gemini_client
+import lore_packer
+import saga_manifest
+import saga_search
 
 
 # --- パス設定 ---
-PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-API_FILE_PATH = os.path.join(PROJECT_ROOT, "api")
 NWS_COLLECTION_ROOT = os.path.expanduser("~/neo_world_saga_collection/")
+# プロット指示との関連度で提案する背景資料の数
+LORE_SUGGESTION_COUNT = 5
 
 
 def read_text_file(filepath: str) -> str | None:
@@ -30,32 +29,22 @@ def read_text_file(filepath: str) -> str | None:
         print(f"警告: ファイル読み込み中にエラー - {filepath}: {e}", file=sys.stderr)
         return None
 
-def get_gemini_api_key() -> str:
-    """APIキーを取得する (apiファイル > 環境変数 > ユーザー入力)"""
-    if os.path.exists(API_FILE_PATH):
-        with open(API_FILE_PATH, 'r', encoding='utf-8') as f:
-            api_key = f.read().strip()
-        if api_key:
-            return api_key
-        else:
-            print(f"警告: '{API_FILE_PATH}' は空です。", file=sys.stderr)
-
-    api_key = os.getenv("GEMINI_API_KEY")
-    if api_key:
-        return api_key
-    
-    print("\n--- Gemini APIキーの入力 ---")
+def suggest_lore_files(user_instruction: str, limit: int = LORE_SUGGESTION_COUNT) -> list[tuple[str, float]]:
+    """全文検索インデックスで、プロット指示に関連する背景資料を (パス, スコア) のリストで返す"""
     try:
-        api_key = input("APIキーを直接入力してください: ")
-    except (EOFError, KeyboardInterrupt):
-        api_key = ""
-    return api_key
+        index = saga_search.open_index(NWS_COLLECTION_ROOT)
+        try:
+            return index.search(user_instruction, limit)
+        finally:
+            index.close()
+    except Exception as e:
+        print(f"警告: 関連する背景資料を検索できませんでした: {e}", file=sys.stderr)
+        return []
 
-def select_lore_files() -> dict:
-    """ユーザーに参照するloreファイルを選択させる"""
+def select_lore_files(user_instruction: str = "") -> dict:
+    """ユーザーに参照するloreファイルを選択させる (プロット指示があれば関連する資料を提案する)"""
     print("\n--- 背景資料の選択 ---")
-    search_path = os.path.join(NWS_COLLECTION_ROOT, "**", "*.md")
-    all_files = sorted(glob.glob(search_path, recursive=True))
+    all_files = saga_manifest.load_manifest(NWS_COLLECTION_ROOT).paths()
 
     if not all_files:
         print("背景資料となるマークダウンファイルが見つかりませんでした。")
@@ -64,15 +53,31 @@ def select_lore_files() -> dict:
     for i, filepath in enumerate(all_files):
         print(f"  [{i+1}] {os.path.relpath(filepath, NWS_COLLECTION_ROOT)}")
 
+    suggested_indices = []
+    if user_instruction:
+        file_numbers = {filepath: i for i, filepath in enumerate(all_files)}
+        suggestions = [(path, score) for path, score in suggest_lore_files(user_instruction) if path in file_numbers]
+        if suggestions:
+            print("\nプロット指示に関連する資料 (関連度順):")
+            for path, score in suggestions:
+                suggested_indices.append(file_numbers[path])
+                print(f"  [{file_numbers[path]+1}] {os.path.relpath(path, NWS_COLLECTION_ROOT)} (スコア {score:.1f})")
+
     print("\nAIに参照させたいファイルの番号を、カンマ区切りで入力してください。")
     
     try:
-        choice = input("(例: 1,3,5) (すべて選択する場合は 'all', 何も選択しない場合はそのままEnter): ")
+        prompt = "(例: 1,3,5) (すべて選択する場合は 'all', "
+        if suggested_indices:
+            prompt += "関連する資料を選択する場合は 'auto', "
+        choice = input(prompt + "何も選択しない場合はそのままEnter): ")
         if not choice:
             return {}
         if choice.lower() == 'all':
-            print("すべてのファイルを選択しました。トークン数上限に注意してください。")
+            print("すべてのファイルを選択しました。プロンプトには関連する節だけがトークン予算内で含まれます。")
             selected_indices = range(len(all_files))
+        elif choice.lower() == 'auto' and suggested_indices:
+            print(f"関連する資料を{len(suggested_indices)}個選択しました。")
+            selected_indices = suggested_indices
         else:
             selected_indices = [int(i.strip()) - 1 for i in choice.split(',') if i.strip().isdigit()]
     except (EOFError, KeyboardInterrupt):
@@ -91,65 +96,134 @@ def select_lore_files() -> dict:
     
     return lore_data
 
-def generate_story_with_gemini(api_key: str, lore_data: dict[str, str], user_instruction: str) -> str | None:
+def build_story_prompt(lore_data: dict[str, str], user_instruction: str,
+                       lore_token_budget: int = lore_packer.LORE_TOKEN_BUDGET) -> str:
+    """執筆プロンプトを作る。背景資料は指示に関連する節だけをトークン予算内で含める"""
+    prompt_parts = [
+        "あなたはネオワールドサーガの世界観と文体を深く理解したAIライターです。\n",
+        "以下の背景資料に基づき、ユーザーの指示に従って物語を生成してください。\n",
+        "物語の文末は、必ず「余韻」を残す形で締めくくってください。明確な結末は必要ありません。\n",
+        "====================\n",
+        "--- 背景資料 ---\n",
+    ]
+    if not lore_data:
+        prompt_parts.append("（背景資料なし）\n")
+    else:
+        packed_lore, lore_tokens = lore_packer.pack_lore(lore_data, user_instruction, lore_token_budget)
+        total_tokens = sum(lore_packer.estimate_tokens(content) for content in lore_data.values())
+        print(f"\n背景資料: 約{total_tokens}トークンのうち、約{lore_tokens}トークン分を使用します (予算 {lore_token_budget})。")
+        for filename, sections in packed_lore.items():
+            content = "\n\n---\n\n".join(sections)
+            prompt_parts.append(f"ファイル名: {filename}\n内容:\n{content}\n\n")
+    
+    prompt_parts.append("====================\n")
+    prompt_parts.extend([
+        f"--- ユーザーからの執筆指示 ---\n{user_instruction}\n",
+        "====================\n",
+        "上記情報に基づき、ネオワールドサーガの物語を執筆してください。\n",
+    ])
+
+    full_prompt = "".join(prompt_parts)
+    print(f"プロンプト全体の見積もり: 約{lore_packer.estimate_tokens(full_prompt)}トークン")
+    return full_prompt
+
+def generate_story_with_gemini(api_key: str, lore_data: dict[str, str], user_instruction: str,
+                               lore_token_budget: int = lore_packer.LORE_TOKEN_BUDGET) -> str | None:
     """Gemini APIを呼び出して物語を生成する"""
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-2.5-flash')
-
-        prompt_parts = [
-            "あなたはネオワールドサーガの世界観と文体を深く理解したAIライターです。\n",
-            "以下の背景資料に基づき、ユーザーの指示に従って物語を生成してください。\n",
-            "物語の文末は、必ず「余韻」を残す形で締めくくってください。明確な結末は必要ありません。\n",
-            "====================\n",
-            "--- 背景資料 ---\n",
-        ]
-        if not lore_data:
-            prompt_parts.append("（背景資料なし）\n")
-        else:
-            for filename, content in lore_data.items():
-                prompt_parts.append(f"ファイル名: {filename}\n内容:\n{content}\n\n")
-        
-        prompt_parts.append("====================\n")
-        prompt_parts.extend([
-            f"--- ユーザーからの執筆指示 ---\n{user_instruction}\n",
-            "====================\n",
-            "上記情報に基づき、ネオワールドサーガの物語を執筆してください。\n",
-        ])
-
-        full_prompt = "".join(prompt_parts)
-        
+        full_prompt = build_story_prompt(lore_data, user_instruction, lore_token_budget)
         print("\nGemini APIを呼び出し、物語を生成中...しばらくお待ちください。")
-        response = model.generate_content(full_prompt)
-        
-        return response.text
+        return gemini_client.generate(full_prompt, api_key=api_key, label="nws_writer")
 
     except Exception as e:
         print(f"エラー: Gemini APIの呼び出し中にエラーが発生しました: {e}", file=sys.stderr)
         return None
 
-def main():
-    """メイン関数"""
+def stream_story_with_gemini(api_key: str, lore_data: dict[str, str], user_instruction: str, save_path: str,
+                             lore_token_budget: int = lore_packer.LORE_TOKEN_BUDGET,
+                             endpoint: str | None = None) -> bool:
+    """物語を生成しながら表示し、届いた分から一時ファイルに書き込んで、最後に save_path に置く。
+    途中でエラーになっても、それまでに受け取った文章は save_path に残る (何も受け取れなければ残さない)。成功すればTrue"""
+    started = time.perf_counter()
+    first_chunk_seconds = None
+    characters = 0
+    temp_path = None
+    try:
+        full_prompt = build_story_prompt(lore_data, user_instruction, lore_token_budget)
+        print("\nGemini APIを呼び出し、物語をストリーミングで生成します。")
+        print("\n--- 生成された物語 ---")
+        # 書き込み中のファイルはマニフェストに載らないよう、隠しファイルにしておく
+        fd, temp_path = tempfile.mkstemp(prefix=".tmp_", suffix=".md", dir=os.path.dirname(save_path))
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(f"# プロット指示: {user_instruction}\n\n")
+            try:
+                for chunk in gemini_client.generate_stream(full_prompt, api_key=api_key, endpoint=endpoint,
+                                                           label="nws_writer"):
+                    if first_chunk_seconds is None:
+                        first_chunk_seconds = time.perf_counter() - started
+                    print(chunk, end="", flush=True)
+                    f.write(chunk)
+                    f.flush()
+                    characters += len(chunk)
+            except Exception as e:
+                print(f"\nエラー: ストリーミング中にエラーが発生しました: {e}", file=sys.stderr)
+                if not characters:
+                    return False
+                f.close()
+                os.replace(temp_path, save_path)
+                print(f"それまでに受け取った {characters} 字は保存されています:\n{save_path}", file=sys.stderr)
+                return False
+        if not characters:
+            print("\n警告: 文章が生成されなかったため、保存しませんでした。", file=sys.stderr)
+            return False
+        os.replace(temp_path, save_path)
+    except OSError as e:
+        print(f"\nエラー: 物語のファイル保存中にエラーが発生しました: {e}", file=sys.stderr)
+        return False
+    except Exception as e:
+        print(f"\nエラー: 物語の生成中にエラーが発生しました: {e}", file=sys.stderr)
+        return False
+    finally:
+        if temp_path is not None:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+
+    print("\n--------------------")
+    total_seconds = time.perf_counter() - started
+    if first_chunk_seconds is not None:
+        print(f"最初の出力まで {first_chunk_seconds:.1f}秒, 全体 {total_seconds:.1f}秒 ({characters} 字)")
+    print(f"\n物語を以下のファイルに保存しました:\n{save_path}")
+    return True
+
+def story_save_path(user_instruction: str) -> str:
+    """生成した物語の保存先 (99_その他/generated_story_*.md) を決める"""
+    save_dir = os.path.join(NWS_COLLECTION_ROOT, "99_その他")
+    os.makedirs(save_dir, exist_ok=True) 
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    
+    # ファイル名として安全な文字列を生成
+    safe_chars = [c if c.isalnum() else '_' for c in user_instruction]
+    filename_base = "".join(safe_chars)[:50] or "untitled"
+    
+    filename = f"generated_story_{timestamp}_{filename_base}.md"
+    return os.path.join(save_dir, filename)
+
+def main(lore_token_budget: int = lore_packer.LORE_TOKEN_BUDGET, stream: bool = False, endpoint: str | None = None):
+    """メイン関数 (stream=True なら生成中の文章を逐次表示・保存する)"""
     print("ようこそ、ネオワールドサーガ執筆支援エージェントへ。")
     print("-" * 30)
 
-    api_key = get_gemini_api_key()
+    api_key = gemini_client.get_api_key(interactive=True)
     if not api_key:
         print("エラー: Gemini APIキーが取得できませんでした。処理を中断します。", file=sys.stderr)
         return
     
     print("-" * 30)
     
-    # Loreファイルの選択
-    lore_data = select_lore_files()
-    if not lore_data:
-        print("\n背景資料は選択されませんでした。")
-    else:
-        print(f"\n{len(lore_data)}個のLoreファイルを選択しました。")
-
-    print("-" * 30)
-    
-    # ユーザーからのプロット指示の受け付け
+    # ユーザーからのプロット指示の受け付け (背景資料の提案に使うため、先に尋ねる)
     try:
         print("\n--- 物語のプロット指示 ---")
         user_plot_instruction = input("どのような物語を執筆したいですか？ (例: ガトールが新たな敵と出会う場面)\n> ")
@@ -162,8 +236,24 @@ def main():
         
     print("-" * 30)
 
+    # Loreファイルの選択
+    lore_data = select_lore_files(user_plot_instruction)
+    if not lore_data:
+        print("\n背景資料は選択されませんでした。")
+    else:
+        print(f"\n{len(lore_data)}個のLoreファイルを選択しました。")
+
+    print("-" * 30)
+
     # Gemini APIの呼び出し
-    generated_story = generate_story_with_gemini(api_key, lore_data, user_plot_instruction)
+    if stream:
+        if not stream_story_with_gemini(api_key, lore_data, user_plot_instruction,
+                                        story_save_path(user_plot_instruction), lore_token_budget, endpoint):
+            print("\n物語の生成に失敗しました。", file=sys.stderr)
+        print("\nスクリプトの全処理が完了しました。")
+        return
+
+    generated_story = generate_story_with_gemini(api_key, lore_data, user_plot_instruction, lore_token_budget)
 
     if generated_story:
         print("\n--- 生成された物語 ---")
@@ -171,17 +261,7 @@ def main():
         print("--------------------")
 
         # ファイルへの自動保存
-        save_dir = os.path.join(NWS_COLLECTION_ROOT, "99_その他")
-        os.makedirs(save_dir, exist_ok=True) 
-
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        
-        # ファイル名として安全な文字列を生成
-        safe_chars = [c if c.isalnum() else '_' for c in user_plot_instruction]
-        filename_base = "".join(safe_chars)[:50] or "untitled"
-        
-        filename = f"generated_story_{timestamp}_{filename_base}.md"
-        save_path = os.path.join(save_dir, filename)
+        save_path = story_save_path(user_plot_instruction)
 
         try:
             with open(save_path, 'w', encoding='utf-8') as f:
@@ -196,4 +276,12 @@ def main():
     print("\nスクリプトの全処理が完了しました。")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="ネオワールドサーガ専用の執筆支援AIを起動します。")
+    parser.add_argument("--lore-budget", type=int, default=lore_packer.LORE_TOKEN_BUDGET,
+                        help=f"背景資料に使うトークン数の上限 (デフォルト: {lore_packer.LORE_TOKEN_BUDGET})")
+    parser.add_argument("--stream", action="store_true", help="生成中の文章を逐次表示し、ファイルにも逐次書き込む")
+    parser.add_argument("--endpoint", help="ストリーミングで使うAPIのエンドポイント (fake_gemini_server.py の偽サーバーで試す場合など)")
+    args = parser.parse_args()
+    if not args.endpoint:
+        gemini_client.require_genai()
+    main(args.lore_budget, args.stream or bool(args.endpoint), args.endpoint)
\ No newline at end of file
@@ -0,0 +1,314 @@
+#!/home/hirosi/my_gemini_project/venv/bin/python
+# -*- coding: utf-8 -*-
+# DESCRIPTION: 依存関係のある処理 (ステージ) をグラフとして定義し、互いに独立したステージを並行して実行します。
+
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+import concurrent.futures
+from datetime import datetime
+
+from disk_cache import CACHE_ROOT
+import pipeline_metrics
+from saga_manifest import hash_file
+
+# --- 定数 ---
+# thread: 外部コマンドやI/Oを待つ処理, process: CPUを使うPythonの処理 (関数と引数はpickle可能であること),
+# async: ネットワーク待ちのコルーチン関数
+STAGE_KINDS = ("thread", "process", "async")
+# processステージのワーカーの起動方式。スレッドを持つプロセス (saga_daemon など) からのforkは安全でないため、
+# forkserver (なければspawn) を使う。関数はモジュールの最上位で定義されている必要がある
+PROCESS_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+# 実行記録の保存先
+RUNS_DIR = os.path.join(CACHE_ROOT, "pipeline_runs")
+RUN_RECORD_VERSION = 1
+
+class StageFailed(RuntimeError):
+    """ステージが失敗し、パイプライン全体を中止すべきことを表す"""
+
+class Stage:
+    """パイプラインの1ステージ。func は依存ステージの結果を deps の順に引数として受け取る。
+    artifacts は結果から成果物ファイルのパスのリストを返す関数 (実行記録で内容ハッシュを確かめる)"""
+
+    def __init__(self, name: str, func, deps: tuple[str, ...] = (), kind: str = "thread", artifacts=None):
+        if kind not in STAGE_KINDS:
+            raise ValueError(f"不明なステージの種類です: {kind}")
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.kind = kind
+        self.artifacts = artifacts
+
+def _digest(value) -> str:
+    return hashlib.sha256(json.dumps(value, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+class RunRecord:
+    """パイプライン実行の記録。ステージごとに入力と出力の内容ハッシュ、結果、成果物のハッシュを保存し、
+    再開時には入力が同じで成果物も変わっていないステージを実行せずに結果を使い回す。
+    入力ハッシュには実行の開始時刻を含めるので、結果を使い回せるのは同じ実行の記録から再開したときだけ。
+    ステージの結果はJSONで保存できる値であること (タプルはリストとして戻る)"""
+
+    def __init__(self, name: str, params: dict | None = None, path: str | None = None):
+        self.name = name
+        self.path = path or os.path.join(RUNS_DIR, f"{name}.json")
+        # 実行条件 (動画プロファイルや日付など)。保存済みの記録と異なれば、その記録からは再開しない
+        self.params = params or {}
+        self.started = datetime.now().isoformat(timespec="seconds")
+        # ステージ名 -> {"status", "input_hash", "output_hash", "result", "artifacts", "error", "finished"}
+        self.stages = {}
+        # 並行するステージの記録が、書き出し中の記録を変更しないようにする
+        self._lock = threading.Lock()
+
+    def load(self) -> bool:
+        """保存済みの記録を読み込む。使えるものがなければFalse"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+        if data.get("version") != RUN_RECORD_VERSION or data.get("name") != self.name:
+            return False
+        if data.get("params") != self.params:
+            print(f"警告: 実行条件が異なるため、前回の実行記録は使えません: {data.get('params')} != {self.params}",
+                  file=sys.stderr)
+            return False
+        self.started = data.get("started", self.started)
+        self.stages = data.get("stages", {})
+        return True
+
+    def save(self) -> None:
+        """記録をアトミックに書き出す"""
+        with self._lock:
+            self._save_locked()
+
+    def _save_locked(self) -> None:
+        data = {"version": RUN_RECORD_VERSION, "name": self.name, "started": self.started,
+                "params": self.params, "stages": self.stages}
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(prefix=".tmp_", suffix=".json", dir=os.path.dirname(self.path))
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"警告: 実行記録の保存に失敗しました: {e}", file=sys.stderr)
+
+    def completed(self, names) -> bool:
+        """names のステージがすべて成功済みならTrue (再開しても実行するものがない)"""
+        return all(self.stages.get(name, {}).get("status") == "done" for name in names)
+
+    def input_hash(self, dep_names: tuple[str, ...]) -> str:
+        """実行条件・実行の開始時刻・依存ステージの出力ハッシュから、ステージの入力ハッシュを作る"""
+        return _digest({"params": self.params, "run": self.started,
+                        "deps": [self.stages.get(dep, {}).get("output_hash") for dep in dep_names]})
+
+    def reusable(self, name: str, input_hash: str) -> tuple[bool, object]:
+        """前回の結果が使えるか確かめ、(使えるか, 結果) を返す"""
+        entry = self.stages.get(name)
+        if not entry or entry.get("status") != "done" or entry.get("input_hash") != input_hash:
+            return False, None
+        for path, sha256 in entry.get("artifacts", {}).items():
+            try:
+                if hash_file(path) != sha256:
+                    return False, None
+            except OSError:
+                return False, None
+        return True, entry.get("result")
+
+    def mark_done(self, name: str, input_hash: str, result, artifact_paths: list[str]) -> None:
+        artifacts = {path: hash_file(path) for path in artifact_paths}
+        self._update(name, {
+            "status": "done",
+            "input_hash": input_hash,
+            "output_hash": _digest({"result": result, "artifacts": artifacts}),
+            "result": result,
+            "artifacts": artifacts,
+            "finished": datetime.now().isoformat(timespec="seconds"),
+        })
+
+    def mark_failed(self, name: str, input_hash: str, error: BaseException) -> None:
+        self._update(name, {
+            "status": "failed",
+            "input_hash": input_hash,
+            "error": str(error),
+            "finished": datetime.now().isoformat(timespec="seconds"),
+        })
+
+    def _update(self, name: str, entry: dict) -> None:
+        with self._lock:
+            self.stages[name] = entry
+            self._save_locked()
+
+class Pipeline:
+    """ステージの依存グラフ。依存先がすべて終わったステージから並行して実行し、
+    どれかが失敗したら残りを取り消して、その例外をそのまま送出する (fail-fast)。
+    スレッド/プロセスで実行中だったステージは止められないので、終わるのを待ってから送出する。
+    record を渡すと各ステージの結果を記録し、resume=True なら記録が有効なステージを飛ばして再開する"""
+
+    def __init__(self, stages: list[Stage], max_workers: int | None = None,
+                 record: RunRecord | None = None, resume: bool = False):
+        self.stages = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f"ステージ名が重複しています: {stage.name}")
+            self.stages[stage.name] = stage
+        for stage in stages:
+            for dep in stage.deps:
+                if dep not in self.stages:
+                    raise ValueError(f"ステージ {stage.name} の依存先 {dep} がありません")
+        self.order = self._topological_order()
+        self.max_workers = max_workers
+        self.record = record
+        self.resume = resume
+        self.skipped = []
+        # ステージ名 -> (開始秒, 終了秒) (パイプライン開始からの経過時間)
+        self.timings = {}
+        self.wall_seconds = 0.0
+
+    def _topological_order(self) -> list[str]:
+        remaining = {name: set(stage.deps) for name, stage in self.stages.items()}
+        order = []
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError(f"ステージの依存関係が循環しています: {', '.join(remaining)}")
+            for name in ready:
+                order.append(name)
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+        return order
+
+    async def run_async(self) -> dict:
+        """全ステージを実行し、{ステージ名: 結果} を返す"""
+        loop = asyncio.get_running_loop()
+        threads = concurrent.futures.ThreadPoolExecutor(self.max_workers, thread_name_prefix="stage")
+        processes = None
+        if any(stage.kind == "process" for stage in self.stages.values()):
+            processes = concurrent.futures.ProcessPoolExecutor(
+                self.max_workers, mp_context=multiprocessing.get_context(PROCESS_START_METHOD))
+        pipeline_start = time.perf_counter()
+        tasks = {}
+
+        async def in_thread(func, *args):
+            """成果物のハッシュ計算や記録の書き出しを、イベントループを止めないようにスレッドで実行する
+            (大きな動画のハッシュ計算中も async のステージが進むようにする)"""
+            return await loop.run_in_executor(threads, func, *args)
+
+        async def run_in_pool(stage: Stage, future: concurrent.futures.Future):
+            """スレッド/プロセスで実行中のステージの結果を待つ。
+            取り消されても実行中の処理は止められないため、終わるまで待ち、成功していれば結果を記録してから取り消される
+            (成果物が書き出された後で記録がないと、再開時にやり直すことになる)"""
+            waiter = asyncio.wrap_future(future)
+            try:
+                return await asyncio.shield(waiter)
+            except asyncio.CancelledError:
+                if future.cancel():
+                    raise
+                print(f"  [{stage.name}] 取り消し: 実行中の処理が終わるのを待っています...")
+                try:
+                    result = await waiter
+                except Exception as e:
+                    if self.record is not None:
+                        await in_thread(self.record.mark_failed, stage.name, self.record.input_hash(stage.deps), e)
+                    raise asyncio.CancelledError() from e
+                if self.record is not None:
+                    await in_thread(self.record.mark_done, stage.name, self.record.input_hash(stage.deps), result,
+                                    stage.artifacts(result) if stage.artifacts else [])
+                print(f"  [{stage.name}] 実行中だった処理が完了したため、結果を記録しました")
+                raise
+
+        async def run_stage(stage: Stage):
+            args = [await tasks[dep] for dep in stage.deps]
+            input_hash = None
+            if self.record is not None:
+                input_hash = self.record.input_hash(stage.deps)
+                if self.resume:
+                    reusable, result = await in_thread(self.record.reusable, stage.name, input_hash)
+                    if reusable:
+                        self.skipped.append(stage.name)
+                        print(f"  [{stage.name}] 前回の結果を使用します (スキップ)")
+                        return result
+            started = time.perf_counter()
+            try:
+                with pipeline_metrics.stage(stage.name, kind=stage.kind):
+                    if stage.kind == "async":
+                        result = await stage.func(*args)
+                    elif stage.kind == "thread":
+                        result = await run_in_pool(stage, threads.submit(pipeline_metrics.bind(stage.func), *args))
+                    else:
+                        result = await run_in_pool(stage, processes.submit(stage.func, *args))
+            except Exception as e:
+                if self.record is not None:
+                    await in_thread(self.record.mark_failed, stage.name, input_hash, e)
+                raise
+            if self.record is not None:
+                await in_thread(self.record.mark_done, stage.name, input_hash, result,
+                                stage.artifacts(result) if stage.artifacts else [])
+            finished = time.perf_counter()
+            self.timings[stage.name] = (started - pipeline_start, finished - pipeline_start)
+            print(f"  [{stage.name}] 完了 ({finished - started:.1f}秒)")
+            return result
+
+        try:
+            for name in self.order:
+                tasks[name] = asyncio.create_task(run_stage(self.stages[name]), name=name)
+            done, pending = await asyncio.wait(tasks.values(), return_when=asyncio.FIRST_EXCEPTION)
+            failed = [task for task in tasks.values() if task in done and not task.cancelled() and task.exception()]
+            if failed:
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*tasks.values(), return_exceptions=True)
+                # 依存先の失敗を受け取っただけのステージではなく、最初に失敗したステージの例外を送出する
+                raise min(failed, key=lambda task: self.order.index(task.get_name())).exception()
+            return {name: task.result() for name, task in tasks.items()}
+        finally:
+            self.wall_seconds = time.perf_counter() - pipeline_start
+            # 取り消されたステージは実行中の処理が終わるまで待ってから終わるため、
+            # ここで残っているのは開始前の処理だけになる (それらを取り消す)
+            threads.shutdown(wait=False, cancel_futures=True)
+            if processes:
+                processes.shutdown(wait=False, cancel_futures=True)
+
+    def run(self) -> dict:
+        return asyncio.run(self.run_async())
+
+    def print_timings(self) -> None:
+        """ステージごとの所要時間と、逐次実行した場合との比較を表示する"""
+        if not self.timings:
+            return
+        print("--- ステージ実行時間 ---")
+        for name in self.order:
+            if name in self.timings:
+                start, end = self.timings[name]
+                print(f"  {name:<16} {start:7.1f}s → {end:7.1f}s ({end - start:.1f}秒)")
+        serial = sum(end - start for start, end in self.timings.values())
+        print(f"  全体 {self.wall_seconds:.1f}秒 (逐次実行なら約 {serial:.1f}秒)")
+
+if __name__ == "__main__":
+    # 動作確認: 2つの独立した待ち時間のあるステージが並行して走ることを確かめる
+    def wait_then(seconds: float, value: str):
+        def run(*_):
+            time.sleep(seconds)
+            return value
+        return run
+
+    async def network(_):
+        await asyncio.sleep(1.0)
+        return "html"
+
+    pipeline = Pipeline([
+        Stage("select", wait_then(0.2, "story")),
+        Stage("video", wait_then(1.0, "video"), deps=("select",)),
+        Stage("html", network, deps=("select",), kind="async"),
+        Stage("homepage", wait_then(0.1, "page"), deps=("video", "html")),
+    ])
+    results = pipeline.run()
+    pipeline.print_timings()
+    sys.exit(0 if results["homepage"] == "page" else 1)
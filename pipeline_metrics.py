@@ -0,0 +1,306 @@
+#!/home/hirosi/my_gemini_project/venv/bin/python
+# -*- coding: utf-8 -*-
+# DESCRIPTION: パイプラインの各ステージの所要時間・CPU時間・メモリ・終了コード・書き込み量・Geminiのトークン数をJSONLに記録し、集計します。
+
+import os
+import sys
+import json
+import time
+import argparse
+import functools
+import threading
+import contextlib
+import contextvars
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+from disk_cache import PROJECT_ROOT
+
+try:
+    import resource
+    RESOURCE_AVAILABLE = True
+except ImportError:
+    RESOURCE_AVAILABLE = False
+
+# --- 定数 ---
+METRICS_PATH = os.path.join(PROJECT_ROOT, "scripts", "metrics", "pipeline_metrics.jsonl")
+# 記録先のJSONLファイルを変える環境変数 ("off" で記録しない)
+METRICS_ENV = "PIPELINE_METRICS"
+# 実行IDを子プロセスに引き継ぐ環境変数 (同じ実行の記録をまとめて集計する。child_env() で設定する)
+RUN_ID_ENV = "PIPELINE_RUN_ID"
+# 集計に使う直近の実行数
+SUMMARY_RUNS = 20
+
+_current = contextvars.ContextVar("pipeline_metrics_stage", default=None)
+_run_id = contextvars.ContextVar("pipeline_metrics_run_id", default=None)
+_process_run_id = None
+_write_lock = threading.Lock()
+_write_warned = False
+
+# --- 実行ID ---
+def new_run_id() -> str:
+    """重複しない実行IDを作る (同じ秒・同じプロセスで作っても別のIDになる)"""
+    return f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}_{uuid.uuid4().hex[:8]}"
+
+@contextlib.contextmanager
+def run(run_id: str | None = None):
+    """with の中を1回の実行として記録する。run_id を省略した場合、実行中の run() の中 (常駐プロセスのジョブなど)
+    や親プロセスから引き継いだIDがあればそれを使い、なければ新しいIDにする。
+    IDはコンテキスト変数に持つので、同じプロセスで並行する実行のIDは混ざらない"""
+    run_id = run_id or _run_id.get() or os.environ.get(RUN_ID_ENV) or new_run_id()
+    token = _run_id.set(run_id)
+    try:
+        yield run_id
+    finally:
+        _run_id.reset(token)
+
+def run_id() -> str:
+    """現在の実行ID。run() の外では、親プロセスから引き継いだIDか、このプロセスで1つ作ったID"""
+    global _process_run_id
+    current_id = _run_id.get()
+    if current_id:
+        return current_id
+    with _write_lock:
+        if _process_run_id is None:
+            _process_run_id = os.environ.get(RUN_ID_ENV) or new_run_id()
+        return _process_run_id
+
+def child_env(env: dict | None = None) -> dict:
+    """子プロセスに渡す環境変数 (現在の実行IDを引き継ぐ)"""
+    return {**(os.environ if env is None else env), RUN_ID_ENV: run_id()}
+
+def metrics_path() -> str | None:
+    """記録先のパス。記録しない設定ならNone"""
+    path = os.environ.get(METRICS_ENV, METRICS_PATH)
+    return None if path.lower() in ("off", "0", "") else path
+
+# --- 計測 ---
+def _usage() -> tuple[float, float, float | None]:
+    """(自プロセスのCPU秒, 終了した子プロセスのCPU秒, 最大RSSのMB) を返す"""
+    if not RESOURCE_AVAILABLE:
+        return time.process_time(), 0.0, None
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # Linuxの ru_maxrss はKB単位
+    peak_rss = max(own.ru_maxrss, children.ru_maxrss) / 1024
+    return own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime, peak_rss
+
+class StageMetrics:
+    """1つのステージの計測値。終了コード・書き込み量・Geminiの呼び出しは親ステージにも合算される"""
+
+    def __init__(self, name: str, parent: 'StageMetrics | None', fields: dict):
+        self.name = name
+        self.parent = parent
+        self.fields = dict(fields)
+        self.ok = True
+        self.exit_codes = []
+        self.bytes_written = 0
+        self.gemini_calls = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self._lock = threading.Lock()
+
+    def set(self, **fields) -> None:
+        """任意の項目 (シーン数・モードなど) を記録に加える"""
+        self.fields.update(fields)
+
+    def add_exit_code(self, code: int) -> None:
+        with self._lock:
+            self.exit_codes.append(code)
+
+    def add_bytes(self, count: int) -> None:
+        with self._lock:
+            self.bytes_written += count
+
+    def add_file(self, path: str) -> None:
+        """書き出したファイルのサイズを書き込み量に加える"""
+        try:
+            self.add_bytes(os.path.getsize(path))
+        except OSError:
+            pass
+
+    def add_gemini_call(self, prompt_tokens: int | None, output_tokens: int | None) -> None:
+        with self._lock:
+            self.gemini_calls += 1
+            self.prompt_tokens += prompt_tokens or 0
+            self.output_tokens += output_tokens or 0
+
+    def _merge_into(self, other: 'StageMetrics') -> None:
+        with other._lock:
+            other.exit_codes.extend(self.exit_codes)
+            other.bytes_written += self.bytes_written
+            other.gemini_calls += self.gemini_calls
+            other.prompt_tokens += self.prompt_tokens
+            other.output_tokens += self.output_tokens
+
+@contextlib.contextmanager
+def stage(name: str, **fields):
+    """with の中をステージ name として計測し、終了時に1行記録する。
+    CPU時間はプロセス全体の差分なので、同時に走る他のステージの分も含む"""
+    parent = _current.get()
+    metrics = StageMetrics(name, parent, fields)
+    token = _current.set(metrics)
+    started_at = datetime.now()
+    started = time.perf_counter()
+    own_cpu, child_cpu, _ = _usage()
+    try:
+        yield metrics
+    except BaseException:
+        metrics.ok = False
+        raise
+    finally:
+        _current.reset(token)
+        wall = time.perf_counter() - started
+        own_cpu_end, child_cpu_end, peak_rss = _usage()
+        if parent is not None:
+            metrics._merge_into(parent)
+        write_record({
+            "run_id": run_id(),
+            "script": os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else None,
+            "stage": name,
+            "parent": parent.name if parent else None,
+            "start": started_at.isoformat(timespec="milliseconds"),
+            "end": datetime.now().isoformat(timespec="milliseconds"),
+            "wall_seconds": round(wall, 3),
+            "cpu_seconds": round(own_cpu_end - own_cpu, 3),
+            "child_cpu_seconds": round(child_cpu_end - child_cpu, 3),
+            "peak_rss_mb": round(peak_rss, 1) if peak_rss is not None else None,
+            "exit_codes": metrics.exit_codes,
+            "bytes_written": metrics.bytes_written,
+            "gemini_calls": metrics.gemini_calls,
+            "prompt_tokens": metrics.prompt_tokens,
+            "output_tokens": metrics.output_tokens,
+            "ok": metrics.ok,
+            **metrics.fields,
+        })
+
+def instrument(name: str):
+    """関数全体をステージとして計測するデコレータ。
+    戻り値が None/False (失敗時にそれを返す関数) なら失敗として記録し、ファイルパスを返したらその書き込み量を加える。
+    タプルを返す関数は、先頭の要素で判定する"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name) as metrics:
+                result = func(*args, **kwargs)
+                outcome = result[0] if isinstance(result, tuple) and result else result
+                if outcome is None or outcome is False:
+                    metrics.ok = False
+                elif isinstance(outcome, str) and os.path.isfile(outcome):
+                    metrics.add_file(outcome)
+                return result
+        return wrapper
+    return decorator
+
+def current() -> StageMetrics | None:
+    """実行中のステージ (なければNone)"""
+    return _current.get()
+
+def record_exit_code(code: int) -> None:
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add_exit_code(code)
+
+def record_file(path: str) -> None:
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add_file(path)
+
+def record_gemini_call(usage: dict | None) -> None:
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add_gemini_call((usage or {}).get("prompt_tokens"), (usage or {}).get("output_tokens"))
+
+def bind(func):
+    """実行中のステージを引き継いで、func を別スレッドから呼べるようにする (ThreadPoolExecutor に渡す場合など)"""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+    return run
+
+def write_record(record: dict) -> None:
+    """記録を1行のJSONとして追記する"""
+    global _write_warned
+    path = metrics_path()
+    if path is None:
+        return
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    try:
+        with _write_lock:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(line)
+    except OSError as e:
+        if not _write_warned:
+            _write_warned = True
+            print(f"警告: 計測値の記録に失敗しました: {e}", file=sys.stderr)
+
+# --- 集計 ---
+def load_records(path: str) -> list[dict]:
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(record, dict) and "stage" in record and "wall_seconds" in record:
+                records.append(record)
+    return records
+
+def percentile(values: list[float], q: float) -> float:
+    """線形補間のパーセンタイル (q は 0〜100)"""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def summarize(records: list[dict], runs: int = SUMMARY_RUNS) -> dict[str, dict]:
+    """直近 runs 回の実行について、ステージごとの所要時間のp50/p95などを集計する"""
+    run_ids = list(dict.fromkeys(record.get("run_id") for record in records))[-runs:]
+    recent = set(run_ids)
+    grouped = defaultdict(list)
+    for record in records:
+        if record.get("run_id") in recent:
+            grouped[record["stage"]].append(record)
+    summary = {}
+    for name, items in grouped.items():
+        walls = [item["wall_seconds"] for item in items]
+        summary[name] = {
+            "count": len(items),
+            "failed": sum(1 for item in items if not item.get("ok", True)),
+            "p50": percentile(walls, 50),
+            "p95": percentile(walls, 95),
+            "cpu_p50": percentile([item.get("cpu_seconds", 0) + item.get("child_cpu_seconds", 0) for item in items], 50),
+            "peak_rss_mb": max((item.get("peak_rss_mb") or 0 for item in items), default=0),
+            "bytes_written": sum(item.get("bytes_written", 0) for item in items) / len(items),
+            "tokens": sum(item.get("prompt_tokens", 0) + item.get("output_tokens", 0) for item in items) / len(items),
+        }
+    return summary
+
+def print_summary(summary: dict[str, dict]) -> None:
+    print(f"{'ステージ':<24}{'回数':>6}{'失敗':>6}{'p50秒':>9}{'p95秒':>9}{'CPU秒':>8}{'RSS MB':>9}{'書込MB':>9}{'トークン':>9}")
+    for name, s in sorted(summary.items(), key=lambda item: -item[1]["p50"]):
+        print(f"{name:<24}{s['count']:>6}{s['failed']:>6}{s['p50']:>9.2f}{s['p95']:>9.2f}{s['cpu_p50']:>8.2f}"
+              f"{s['peak_rss_mb']:>9.1f}{s['bytes_written'] / 1024 / 1024:>9.1f}{s['tokens']:>9.0f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="記録されたパイプラインの計測値を、ステージごとに集計して表示します。")
+    parser.add_argument("--path", default=metrics_path() or METRICS_PATH, help="計測値のJSONLファイル")
+    parser.add_argument("--runs", type=int, default=SUMMARY_RUNS, help="集計する直近の実行数")
+    args = parser.parse_args()
+    try:
+        records = load_records(args.path)
+    except FileNotFoundError:
+        print(f"エラー: 計測値のファイルが見つかりません: {args.path}", file=sys.stderr)
+        sys.exit(1)
+    if not records:
+        print("計測値がまだありません。")
+        sys.exit(0)
+    print(f"{args.path} の直近 {args.runs} 回の実行を集計します。")
+    print_summary(summarize(records, args.runs))
@@ -0,0 +1,10 @@
+#!/home/hirosi/my_gemini_project/venv/bin/python
+# -*- coding: utf-8 -*-
+# DESCRIPTION: シーン描画のforkserverに読み込ませ、字幕フォントを1度だけ解決しておくモジュールです。ワーカーは解決済みのラスタライザを引き継ぎます。
+
+import assemble_video
+import text_rasterizer
+
+# forkserverの起動時に1度だけフォントを探して読み込む。ワーカーはここからforkされるので、
+# プールを作り直すたびにワーカーごとにフォントを解決し直さずに済む (Pillowがなければ何もしない)
+text_rasterizer.get_rasterizer(assemble_video.FONT)
@@ -0,0 +1,313 @@
+#!/home/hirosi/my_gemini_project/venv/bin/python
+# -*- coding: utf-8 -*-
+# DESCRIPTION: パイプラインを常駐プロセスから定期実行し、SDK・マニフェスト・検索インデックス・フォントを読み込んだまま、制御ソケットで実行や状態確認を受け付けます。
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import signal
+import asyncio
+import argparse
+import contextlib
+import traceback
+import multiprocessing.forkserver
+from datetime import datetime, timedelta
+
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+from disk_cache import CACHE_ROOT
+import pipeline_metrics
+
+# --- 定数 ---
+NWS_COLLECTION_ROOT = os.path.expanduser("~/neo_world_saga_collection/")
+SOCKET_PATH = os.path.join(CACHE_ROOT, "saga_daemon.sock")
+# ジョブのロックファイルの置き場所。常駐プロセスと各スクリプトの __main__ が同じロックを取るので、
+# cronなどから直接起動したスクリプトと常駐プロセスの同じジョブが重ならない
+LOCK_DIR = os.path.join(CACHE_ROOT, "locks")
+# 定期実行するジョブ: ジョブ名 -> (毎日の実行時刻 "HH:MM", 開始を遅らせる最大秒数)
+JOB_SCHEDULES = {
+    "daily_video": ("06:00", 15 * 60),
+    "master_saga": ("06:45", 10 * 60),
+    "refresh_index": ("05:30", 5 * 60),
+}
+
+# --- ジョブ ---
+def run_daily_video() -> bool:
+    import generate_daily_video_and_homepage
+    return generate_daily_video_and_homepage.main() == 0
+
+def run_append_story() -> bool:
+    import append_saga_story
+    return append_saga_story.main(append_saga_story.RECENT_SECTIONS)
+
+def run_master_saga() -> bool:
+    import generate_master_saga
+    return generate_master_saga.main()
+
+def run_refresh_index() -> bool:
+    import saga_search
+    # 接続とマニフェストはプロセス内で使い回し、変わった物語だけを索引し直す
+    saga_search.shared_index(NWS_COLLECTION_ROOT)
+    return True
+
+JOBS = {
+    "daily_video": run_daily_video,
+    "append_story": run_append_story,
+    "master_saga": run_master_saga,
+    "refresh_index": run_refresh_index,
+}
+
+def warm_up() -> None:
+    """ジョブで使うモジュール・APIクライアント・マニフェスト・検索インデックス・フォントを先に読み込んでおく。
+    シーン描画のforkserverもここで起動する。forkserverは render_preload でフォントを1度だけ解決するので、
+    ジョブごとに作られるワーカーは解決済みのラスタライザを引き継ぐ"""
+    start = time.perf_counter()
+    import assemble_video
+    import gemini_client
+    import generate_daily_video_and_homepage
+    import generate_master_saga
+    import saga_manifest
+    import saga_search
+    import text_rasterizer
+
+    api_key = gemini_client.get_api_key()
+    if api_key and gemini_client.GENAI_AVAILABLE:
+        gemini_client.get_model(api_key=api_key)
+    saga_manifest.load_manifest(NWS_COLLECTION_ROOT)
+    saga_search.shared_index(NWS_COLLECTION_ROOT)
+    if text_rasterizer.PIL_AVAILABLE:
+        text_rasterizer.get_rasterizer(assemble_video.FONT)
+    if assemble_video.RENDER_START_METHOD == "forkserver":
+        assemble_video.render_context()
+        multiprocessing.forkserver.ensure_running()
+    print(f"準備完了 ({time.perf_counter() - start:.1f}秒)")
+
+@contextlib.contextmanager
+def job_lock(name: str):
+    """ジョブのロックファイルを排他的に取る。別プロセスが実行中なら False を返す。
+    ジョブ名は JOBS のキー (直接起動したスクリプトも同じ名前でロックを取る)"""
+    if not FCNTL_AVAILABLE:
+        yield True
+        return
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    with open(os.path.join(LOCK_DIR, f"{name}.lock"), 'w') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def next_run_time(at: str, jitter_seconds: float, now: datetime | None = None) -> datetime:
+    """次の実行時刻 (毎日 at の時刻に 0〜jitter_seconds 秒のゆらぎを加えたもの) を返す"""
+    now = now or datetime.now()
+    hour, minute = (int(part) for part in at.split(":"))
+    run_at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if run_at <= now:
+        run_at += timedelta(days=1)
+    return run_at + timedelta(seconds=random.uniform(0, jitter_seconds))
+
+# --- 常駐プロセス ---
+class SagaDaemon:
+    """ジョブを定期実行し、制御ソケットからの要求 (status / run / stop) に応える。
+    同じジョブは同時に1つしか実行しない"""
+
+    def __init__(self, socket_path: str = SOCKET_PATH, schedules: dict | None = None):
+        self.socket_path = socket_path
+        self.schedules = JOB_SCHEDULES if schedules is None else schedules
+        self.started = datetime.now()
+        # ジョブ名 -> {"running", "runs", "last_started", "last_finished", "last_seconds", "last_ok", "last_error", "next_run"}
+        self.state = {name: {"running": False, "runs": 0, "last_started": None, "last_finished": None,
+                             "last_seconds": None, "last_ok": None, "last_error": None, "next_run": None}
+                      for name in JOBS}
+        self._tasks = {}
+        self._stop = None
+
+    def _run_job(self, name: str) -> tuple[bool, str | None]:
+        """ジョブを実行する (作業スレッドで呼ばれる)。(成功したか, エラー) を返す"""
+        with job_lock(name) as acquired:
+            if not acquired:
+                return False, "別のプロセスで実行中のためスキップしました"
+            try:
+                # ジョブごとに新しい実行IDにする (並行するジョブのIDはコンテキスト変数で分かれる)
+                with pipeline_metrics.run(pipeline_metrics.new_run_id()):
+                    return bool(JOBS[name]()), None
+            except SystemExit as e:
+                return e.code in (0, None), f"終了コード {e.code}"
+            except Exception as e:
+                traceback.print_exc()
+                return False, str(e)
+
+    def trigger(self, name: str, reason: str) -> asyncio.Task | None:
+        """ジョブを開始する。同じジョブが実行中ならNone"""
+        state = self.state[name]
+        if state["running"]:
+            print(f"[{name}] 実行中のため、{reason}による実行をスキップします。")
+            return None
+        state["running"] = True
+        task = asyncio.create_task(self._execute(name, reason))
+        self._tasks[name] = task
+        return task
+
+    async def _execute(self, name: str, reason: str) -> bool:
+        state = self.state[name]
+        print(f"\n[{name}] 開始 ({reason})")
+        state["last_started"] = datetime.now().isoformat(timespec="seconds")
+        start = time.perf_counter()
+        try:
+            ok, error = await asyncio.get_running_loop().run_in_executor(None, self._run_job, name)
+        finally:
+            state["running"] = False
+        state.update(runs=state["runs"] + 1, last_ok=ok, last_error=error,
+                     last_finished=datetime.now().isoformat(timespec="seconds"),
+                     last_seconds=round(time.perf_counter() - start, 1))
+        print(f"[{name}] {'完了' if ok else '失敗'} ({state['last_seconds']}秒){': ' + error if error else ''}")
+        return ok
+
+    async def _schedule(self, name: str, at: str, jitter_seconds: float) -> None:
+        while True:
+            run_at = next_run_time(at, jitter_seconds)
+            self.state[name]["next_run"] = run_at.isoformat(timespec="seconds")
+            await asyncio.sleep(max(0.0, (run_at - datetime.now()).total_seconds()))
+            self.trigger(name, "定期実行")
+
+    async def _handle(self, request: dict) -> dict:
+        command = request.get("command")
+        if command == "status":
+            return {"ok": True, "started": self.started.isoformat(timespec="seconds"), "jobs": self.state}
+        if command == "run":
+            name = request.get("job")
+            if name not in JOBS:
+                return {"ok": False, "error": f"不明なジョブです: {name} (選択肢: {', '.join(JOBS)})"}
+            task = self.trigger(name, "手動実行")
+            if task is None:
+                return {"ok": False, "error": f"{name} は実行中です"}
+            if request.get("wait"):
+                return {"ok": await task, "job": self.state[name]}
+            return {"ok": True, "message": f"{name} を開始しました"}
+        if command == "stop":
+            self._stop.set()
+            return {"ok": True, "message": "実行中のジョブの終了を待って停止します"}
+        return {"ok": False, "error": f"不明なコマンドです: {command}"}
+
+    async def _client_connected(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            try:
+                request = json.loads(await reader.readline())
+                response = await self._handle(request if isinstance(request, dict) else {})
+            except json.JSONDecodeError:
+                response = {"ok": False, "error": "要求はJSONの1行で送ってください"}
+            writer.write((json.dumps(response, ensure_ascii=False) + "\n").encode('utf-8'))
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self) -> None:
+        self._stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self._stop.set)
+
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        if os.path.exists(self.socket_path):
+            if is_running(self.socket_path):
+                raise RuntimeError(f"常駐プロセスはすでに起動しています: {self.socket_path}")
+            os.remove(self.socket_path) # 前回の異常終了で残ったソケット
+        server = await asyncio.start_unix_server(self._client_connected, path=self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        schedulers = [asyncio.create_task(self._schedule(name, at, jitter))
+                      for name, (at, jitter) in self.schedules.items()]
+        await asyncio.sleep(0) # 各ジョブの次回の実行時刻を計算させる
+        print(f"制御ソケット: {self.socket_path}")
+        for name, (at, _) in self.schedules.items():
+            print(f"  {name}: 毎日 {at} 頃 (次回 {self.state[name]['next_run']})")
+
+        try:
+            await self._stop.wait()
+        finally:
+            print("停止しています...")
+            for task in schedulers:
+                task.cancel()
+            server.close()
+            await server.wait_closed()
+            # 実行中のジョブはスレッドで動いているため、終わるまで待つ
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.socket_path)
+
+# --- クライアント ---
+def send_command(request: dict, socket_path: str = SOCKET_PATH, timeout: float | None = 10.0) -> dict:
+    """制御ソケットに要求を送り、応答を返す"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(socket_path)
+        client.sendall((json.dumps(request) + "\n").encode('utf-8'))
+        with client.makefile('r', encoding='utf-8') as f:
+            return json.loads(f.readline())
+
+def is_running(socket_path: str = SOCKET_PATH) -> bool:
+    try:
+        return send_command({"command": "status"}, socket_path, timeout=2.0).get("ok", False)
+    except (OSError, json.JSONDecodeError):
+        return False
+
+def print_status(status: dict) -> None:
+    print(f"常駐プロセス開始: {status['started']}")
+    for name, job in status["jobs"].items():
+        last = "未実行"
+        if job["last_finished"]:
+            last = f"{'成功' if job['last_ok'] else '失敗'} {job['last_finished']} ({job['last_seconds']}秒)"
+        running = " [実行中]" if job["running"] else ""
+        next_run = f", 次回 {job['next_run']}" if job["next_run"] else ""
+        print(f"  {name:<14} {job['runs']} 回, 前回 {last}{next_run}{running}")
+        if job["last_error"]:
+            print(f"  {'':<14} エラー: {job['last_error']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="パイプラインを常駐プロセスで定期実行し、制御ソケットで操作します。")
+    parser.add_argument("command", choices=["serve", "status", "run", "stop"],
+                        help="serve: 常駐プロセスを起動, status: 状態を表示, run: ジョブを今すぐ実行, stop: 停止")
+    parser.add_argument("job", nargs="?", choices=list(JOBS), help="run で実行するジョブ")
+    parser.add_argument("--wait", action="store_true", help="run でジョブの終了まで待つ")
+    parser.add_argument("--no-schedule", action="store_true", help="serve で定期実行をせず、制御ソケットからの実行だけを受け付ける")
+    parser.add_argument("--socket", default=SOCKET_PATH, help="制御ソケットのパス")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        print("--- ネオワールドサーガ 常駐プロセス ---")
+        warm_up()
+        daemon = SagaDaemon(args.socket, {} if args.no_schedule else None)
+        try:
+            asyncio.run(daemon.serve())
+        except RuntimeError as e:
+            print(f"エラー: {e}", file=sys.stderr)
+            sys.exit(1)
+        sys.exit(0)
+
+    if args.command == "run" and not args.job:
+        parser.error("run にはジョブ名が必要です")
+    request = {"command": args.command, "job": args.job, "wait": args.wait}
+    try:
+        response = send_command(request, args.socket, timeout=None if args.wait else 10.0)
+    except OSError as e:
+        print(f"エラー: 常駐プロセスに接続できません ({args.socket}): {e}", file=sys.stderr)
+        sys.exit(1)
+    if args.command == "status" and response.get("ok"):
+        print_status(response)
+    elif "job" in response:
+        job = response["job"]
+        print(f"{args.job}: {'成功' if job['last_ok'] else '失敗'} ({job['last_seconds']}秒)"
+              f"{': ' + job['last_error'] if job['last_error'] else ''}")
+    else:
+        print(response.get("message") or response.get("error") or json.dumps(response, ensure_ascii=False))
+    sys.exit(0 if response.get("ok") else 1)
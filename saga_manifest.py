@@ -0,0 +1,210 @@
+#!/home/hirosi/my_gemini_project/venv/bin/python
+# -*- coding: utf-8 -*-
+# DESCRIPTION: 物語コレクションのファイル一覧 (パス・サイズ・更新時刻・ハッシュ・シリーズ・話数) をマニフェストに保存し、差分だけ更新します。
+
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+
+from disk_cache import CACHE_ROOT, make_key
+
+# --- 定数 ---
+NWS_COLLECTION_ROOT = os.path.expanduser("~/neo_world_saga_collection/")
+MANIFEST_VERSION = 1
+# ファイル名から話数を読み取る (例: 第3話, ep03, episode_3, 03_xxx)
+EPISODE_RE = re.compile(r'第\s*(\d+)\s*[話章部]|(?:^|[^a-z])ep(?:isode)?[\s_-]*(\d+)|^(\d+)(?=[\s_.-]|$)', re.IGNORECASE)
+
+# --- ヘルパー関数 ---
+def manifest_path_for(root: str) -> str:
+    """コレクションのルートごとのマニフェストファイルのパスを返す"""
+    return os.path.join(CACHE_ROOT, f"saga_manifest_{make_key(os.path.abspath(root))[:12]}.json")
+
+def parse_episode(filename: str) -> int | None:
+    """ファイル名から話数を取り出す。見つからなければNone"""
+    m = EPISODE_RE.search(os.path.splitext(filename)[0])
+    if not m:
+        return None
+    return int(next(group for group in m.groups() if group is not None))
+
+def hash_file(path: str) -> str:
+    """ファイル内容のSHA-256を返す"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class SagaManifest:
+    """物語コレクションのマニフェスト。
+    refresh() は更新時刻が変わったディレクトリだけを読み直し、サイズか更新時刻が変わったファイルだけをハッシュし直す。"""
+
+    def __init__(self, root: str = NWS_COLLECTION_ROOT, manifest_path: str | None = None):
+        self.root = os.path.abspath(root)
+        self.manifest_path = manifest_path or manifest_path_for(root)
+        # 相対ディレクトリ -> {"mtime_ns", "files", "subdirs"}
+        self.dirs = {}
+        # 相対パス -> {"path", "size", "mtime_ns", "sha256", "series", "episode"}
+        self.files = {}
+        # 直近の refresh() で読み直したディレクトリ数・ハッシュしたファイル数
+        self.scanned_dirs = 0
+        self.hashed_files = 0
+        self._lock = threading.Lock()
+
+    def load(self) -> bool:
+        """保存済みのマニフェストを読み込む。使えるものがなければFalse"""
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+        if data.get("version") != MANIFEST_VERSION or data.get("root") != self.root:
+            return False
+        self.dirs = data.get("dirs", {})
+        self.files = data.get("files", {})
+        return True
+
+    def save(self) -> None:
+        """マニフェストをアトミックに書き出す"""
+        data = {"version": MANIFEST_VERSION, "root": self.root, "dirs": self.dirs, "files": self.files}
+        try:
+            os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(prefix=".tmp_", suffix=".json", dir=os.path.dirname(self.manifest_path))
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(temp_path, self.manifest_path)
+        except OSError as e:
+            print(f"警告: マニフェストの保存に失敗しました: {e}", file=sys.stderr)
+
+    def _list_dir(self, rel_dir: str) -> tuple[list[str], list[str]]:
+        """ディレクトリ直下のMarkdownファイルとサブディレクトリを返す (glob と同じく隠しファイルは除く)"""
+        files, subdirs = [], []
+        with os.scandir(os.path.join(self.root, rel_dir)) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                elif entry.name.endswith('.md') and entry.is_file():
+                    files.append(entry.name)
+        self.scanned_dirs += 1
+        return sorted(files), sorted(subdirs)
+
+    def _entry_for(self, rel_path: str, st: os.stat_result) -> dict:
+        old = self.files.get(rel_path)
+        if old and old["size"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns:
+            return old
+        self.hashed_files += 1
+        parts = rel_path.split('/')
+        return {
+            "path": rel_path,
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "sha256": hash_file(os.path.join(self.root, rel_path)),
+            "series": parts[0] if len(parts) > 1 else "",
+            "episode": parse_episode(parts[-1]),
+        }
+
+    def refresh(self) -> bool:
+        """コレクションの変更をマニフェストに反映する。変更があればTrue"""
+        with self._lock:
+            self.scanned_dirs = self.hashed_files = 0
+            dirs, files = {}, {}
+            pending = [""]
+            while pending:
+                rel_dir = pending.pop()
+                try:
+                    dir_mtime = os.stat(os.path.join(self.root, rel_dir)).st_mtime_ns
+                    cached = self.dirs.get(rel_dir)
+                    # ディレクトリの更新時刻は直下のエントリの追加・削除でしか変わらない
+                    if cached and cached["mtime_ns"] == dir_mtime:
+                        names, subdirs = cached["files"], cached["subdirs"]
+                    else:
+                        names, subdirs = self._list_dir(rel_dir)
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+                dirs[rel_dir] = {"mtime_ns": dir_mtime, "files": names, "subdirs": subdirs}
+                pending.extend(f"{rel_dir}/{name}" if rel_dir else name for name in subdirs)
+                for name in names:
+                    rel_path = f"{rel_dir}/{name}" if rel_dir else name
+                    try:
+                        files[rel_path] = self._entry_for(rel_path, os.stat(os.path.join(self.root, rel_path)))
+                    except FileNotFoundError:
+                        continue
+
+            changed = dirs != self.dirs or files != self.files
+            self.dirs, self.files = dirs, files
+            return changed
+
+    # --- 問い合わせ ---
+    def full_path(self, entry: dict) -> str:
+        return os.path.join(self.root, entry["path"])
+
+    def entries(self, series: str | None = None, min_size: int = 0) -> list[dict]:
+        """条件に合うエントリをパス順に返す"""
+        return [
+            entry for _, entry in sorted(self.files.items())
+            if (series is None or entry["series"] == series) and entry["size"] >= min_size
+        ]
+
+    def paths(self, series: str | None = None, min_size: int = 0) -> list[str]:
+        """条件に合う物語ファイルの絶対パスをパス順に返す"""
+        return [self.full_path(entry) for entry in self.entries(series, min_size)]
+
+    def get(self, path: str) -> dict | None:
+        """絶対パスまたはルートからの相対パスでエントリを探す"""
+        if os.path.isabs(path):
+            path = os.path.relpath(path, self.root)
+        return self.files.get(path.replace(os.sep, '/'))
+
+    def series(self) -> list[str]:
+        """シリーズ (ルート直下のディレクトリ) の一覧を返す"""
+        return sorted({entry["series"] for entry in self.files.values()})
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+def load_manifest(root: str = NWS_COLLECTION_ROOT) -> SagaManifest:
+    """マニフェストを読み込み、コレクションの変更を反映して返す。
+    同じプロセス内では同じオブジェクトを使い回し、呼ぶたびに差分だけ更新する。"""
+    key = os.path.abspath(root)
+    with _manifests_lock:
+        manifest = _manifests.get(key)
+        if manifest is None:
+            manifest = SagaManifest(root)
+            manifest.load()
+            _manifests[key] = manifest
+    if manifest.refresh():
+        manifest.save()
+    return manifest
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="物語コレクションのマニフェストを更新し、概要を表示します。")
+    parser.add_argument("root", nargs="?", default=NWS_COLLECTION_ROOT, help="物語コレクションのルート")
+    parser.add_argument("--rebuild", action="store_true", help="保存済みのマニフェストを使わずに作り直す")
+    parser.add_argument("--list", action="store_true", help="ファイルごとの情報を表示する")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        try:
+            os.remove(manifest_path_for(args.root))
+        except FileNotFoundError:
+            pass
+    start = time.perf_counter()
+    manifest = load_manifest(args.root)
+    elapsed = time.perf_counter() - start
+    print(f"マニフェスト: {manifest.manifest_path}")
+    print(f"{len(manifest.files)} ファイル, {len(manifest.dirs)} ディレクトリ "
+          f"(読み直し {manifest.scanned_dirs} ディレクトリ, ハッシュ {manifest.hashed_files} ファイル, {elapsed * 1000:.1f}ミリ秒)")
+    for name in manifest.series():
+        entries = manifest.entries(series=name)
+        print(f"  {name or '(ルート)'}: {len(entries)} ファイル, {sum(e['size'] for e in entries) / 1024:.1f} KB")
+    if args.list:
+        for entry in manifest.entries():
+            episode = entry["episode"] if entry["episode"] is not None else "-"
+            print(f"{entry['path']}\t{entry['size']}\t{episode}\t{entry['sha256'][:12]}")
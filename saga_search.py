@@ -0,0 +1,200 @@
+#!/home/hirosi/my_gemini_project/venv/bin/python
+# -*- coding: utf-8 -*-
+# DESCRIPTION: 物語コレクションの文字n-gram転置インデックスを作り、指示文に関連する物語をランキングで検索します。
+
+import os
+import re
+import sys
+import math
+import time
+import sqlite3
+import argparse
+import threading
+import unicodedata
+from collections import Counter
+
+from disk_cache import CACHE_ROOT, make_key
+import markdown_text
+import saga_manifest
+
+# --- 定数 ---
+NWS_COLLECTION_ROOT = os.path.expanduser("~/neo_world_saga_collection/")
+INDEX_VERSION = 1
+# 形態素解析なしで日本語を扱うため、文字2-gramで索引する
+NGRAM_SIZE = 2
+# BM25のパラメータ
+BM25_K1 = 1.2
+BM25_B = 0.75
+# n-gramを作る前に取り除く文字 (空白・記号)
+NON_WORD_RE = re.compile(r'[\W_]+')
+
+# --- ヘルパー関数 ---
+def index_path_for(root: str) -> str:
+    """コレクションのルートごとのインデックスファイルのパスを返す"""
+    return os.path.join(CACHE_ROOT, f"saga_search_{make_key(os.path.abspath(root))[:12]}.sqlite")
+
+def ngrams(text: str) -> Counter:
+    """テキストを正規化し、記号で区切られた語ごとに文字n-gramの出現回数を数える"""
+    text = unicodedata.normalize('NFKC', text).lower()
+    counts = Counter()
+    for word in NON_WORD_RE.split(text):
+        if len(word) < NGRAM_SIZE:
+            if word:
+                counts[word] += 1
+            continue
+        counts.update(word[i:i + NGRAM_SIZE] for i in range(len(word) - NGRAM_SIZE + 1))
+    return counts
+
+def bm25(tf: int, df: int, doc_count: int, length: int, avg_length: float) -> float:
+    """1つのn-gramについてのBM25スコア"""
+    idf = max(0.0, math.log((doc_count - df + 0.5) / (df + 0.5) + 1.0))
+    norm = 1 - BM25_B + BM25_B * length / (avg_length or 1)
+    return idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * norm)
+
+class SagaSearchIndex:
+    """マニフェストの内容ハッシュと照らし合わせて、変わった物語だけを索引し直す転置インデックス (SQLite)"""
+
+    def __init__(self, root: str = NWS_COLLECTION_ROOT, index_path: str | None = None):
+        self.root = os.path.abspath(root)
+        self.index_path = index_path or index_path_for(root)
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        # shared_index() で複数のスレッドから使えるよう、接続の利用は _lock で直列化する
+        self.conn = sqlite3.connect(self.index_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._create_schema()
+
+    def _create_schema(self) -> None:
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != INDEX_VERSION:
+            # 形式が変わったら作り直す
+            self.conn.executescript("DROP TABLE IF EXISTS postings; DROP TABLE IF EXISTS docs;")
+        self.conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS docs (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE NOT NULL,
+                sha256 TEXT NOT NULL,
+                length INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                gram TEXT NOT NULL,
+                doc_id INTEGER NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (gram, doc_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc_id);
+            PRAGMA user_version = {INDEX_VERSION};
+        """)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def update(self, manifest: saga_manifest.SagaManifest) -> tuple[int, int]:
+        """マニフェストと異なる物語だけを索引し直す。(索引した件数, 削除した件数) を返す"""
+        with self._lock:
+            return self._update(manifest)
+
+    def _update(self, manifest: saga_manifest.SagaManifest) -> tuple[int, int]:
+        indexed = {path: (doc_id, sha256) for doc_id, path, sha256 in self.conn.execute("SELECT id, path, sha256 FROM docs")}
+        added = removed = 0
+        with self.conn:
+            for path, (doc_id, _) in indexed.items():
+                if path not in manifest.files:
+                    self._remove(doc_id)
+                    removed += 1
+            for path, entry in manifest.files.items():
+                current = indexed.get(path)
+                if current and current[1] == entry["sha256"]:
+                    continue
+                try:
+                    with open(manifest.full_path(entry), 'r', encoding='utf-8') as f:
+                        text = markdown_text.extract_plain_text(f.read())
+                except (OSError, UnicodeDecodeError) as e:
+                    print(f"警告: 索引できませんでした - {path}: {e}", file=sys.stderr)
+                    continue
+                if current:
+                    self._remove(current[0])
+                counts = ngrams(text)
+                cursor = self.conn.execute(
+                    "INSERT INTO docs (path, sha256, length) VALUES (?, ?, ?)",
+                    (path, entry["sha256"], sum(counts.values())),
+                )
+                self.conn.executemany(
+                    "INSERT INTO postings (gram, doc_id, tf) VALUES (?, ?, ?)",
+                    ((gram, cursor.lastrowid, tf) for gram, tf in counts.items()),
+                )
+                added += 1
+        return added, removed
+
+    def _remove(self, doc_id: int) -> None:
+        self.conn.execute("DELETE FROM postings WHERE doc_id = ?", (doc_id,))
+        self.conn.execute("DELETE FROM docs WHERE id = ?", (doc_id,))
+
+    def search(self, query: str, limit: int = 10) -> list[tuple[str, float]]:
+        """クエリに関連する物語を (絶対パス, スコア) のリストでスコア順に返す"""
+        query_counts = ngrams(query)
+        if not query_counts:
+            return []
+        with self._lock:
+            return self._search(query_counts, limit)
+
+    def _search(self, query_counts: Counter, limit: int) -> list[tuple[str, float]]:
+        doc_count, avg_length = self.conn.execute("SELECT COUNT(*), AVG(length) FROM docs").fetchone()
+        if not doc_count:
+            return []
+        grams = list(query_counts)
+        placeholders = ",".join("?" * len(grams))
+        df = dict(self.conn.execute(
+            f"SELECT gram, COUNT(*) FROM postings WHERE gram IN ({placeholders}) GROUP BY gram", grams
+        ))
+        scores = Counter()
+        rows = self.conn.execute(
+            f"SELECT p.gram, p.doc_id, p.tf, d.length FROM postings p JOIN docs d ON d.id = p.doc_id "
+            f"WHERE p.gram IN ({placeholders})", grams
+        )
+        for gram, doc_id, tf, length in rows:
+            scores[doc_id] += query_counts[gram] * bm25(tf, df[gram], doc_count, length, avg_length)
+        top = scores.most_common(limit)
+        paths = dict(self.conn.execute(
+            f"SELECT id, path FROM docs WHERE id IN ({','.join('?' * len(top))})", [doc_id for doc_id, _ in top]
+        )) if top else {}
+        return [(os.path.join(self.root, paths[doc_id]), score) for doc_id, score in top]
+
+def open_index(root: str = NWS_COLLECTION_ROOT) -> SagaSearchIndex:
+    """マニフェストを更新し、それに合わせて差分だけ索引し直したインデックスを返す"""
+    index = SagaSearchIndex(root)
+    index.update(saga_manifest.load_manifest(root))
+    return index
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def shared_index(root: str = NWS_COLLECTION_ROOT) -> SagaSearchIndex:
+    """open_index() と同じく差分だけ索引し直したインデックスを返す。
+    同じプロセス内では同じ接続を使い回す (常駐プロセス向け。close() しないこと)"""
+    key = os.path.abspath(root)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = SagaSearchIndex(root)
+            _indexes[key] = index
+    index.update(saga_manifest.load_manifest(root))
+    return index
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="物語コレクションを全文検索します。")
+    parser.add_argument("query", nargs="?", help="検索する文 (省略時はインデックスの更新のみ)")
+    parser.add_argument("--root", default=NWS_COLLECTION_ROOT, help="物語コレクションのルート")
+    parser.add_argument("--limit", type=int, default=10, help="表示する件数")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    index = SagaSearchIndex(args.root)
+    added, removed = index.update(saga_manifest.load_manifest(args.root))
+    print(f"インデックス更新: 索引 {added} 件, 削除 {removed} 件 ({(time.perf_counter() - start) * 1000:.1f}ミリ秒)")
+    if args.query:
+        start = time.perf_counter()
+        results = index.search(args.query, args.limit)
+        print(f"検索: {len(results)} 件 ({(time.perf_counter() - start) * 1000:.1f}ミリ秒)")
+        for path, score in results:
+            print(f"  {score:7.2f}  {os.path.relpath(path, index.root)}")
+    index.close()
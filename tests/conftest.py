@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+# DESCRIPTION: テスト共通の設定です。スクリプトは最上位に並んでいるので、リポジトリのルートをインポートパスに加えます。
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# テストの実行で計測値の記録 (scripts/metrics) を増やさない
+os.environ["PIPELINE_METRICS"] = "off"
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# DESCRIPTION: disk_cache のLRU順の削除とサイズ上限を確かめます。
+
+import os
+import time
+
+import disk_cache
+
+def make_cache(tmp_path, max_bytes: int) -> disk_cache.DiskCache:
+    cache = disk_cache.DiskCache("test", max_bytes, suffix=".bin")
+    cache.root = str(tmp_path / "test")
+    return cache
+
+def put(cache: disk_cache.DiskCache, key: str, size: int, age_seconds: float) -> str:
+    """size バイトのエントリを作り、最終利用時刻を age_seconds 秒前にする"""
+    temp_path = cache.temp_path(key)
+    with open(temp_path, 'wb') as f:
+        f.write(b'x' * size)
+    path = cache.commit(key, temp_path)
+    past = time.time() - age_seconds
+    os.utime(path, (past, past))
+    return path
+
+def test_get_counts_hits_and_misses(tmp_path):
+    cache = make_cache(tmp_path, 100)
+    path = put(cache, disk_cache.make_key("a"), 10, 0)
+    assert cache.get(disk_cache.make_key("a")) == path
+    assert cache.get(disk_cache.make_key("b")) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_evict_removes_least_recently_used_first(tmp_path):
+    cache = make_cache(tmp_path, 25)
+    oldest = put(cache, "aa01", 10, 300)
+    middle = put(cache, "bb02", 10, 200)
+    newest = put(cache, "cc03", 10, 100)
+    # 最も古いエントリを使うと最新扱いになり、次に古いものが削除される
+    cache.get("aa01")
+    assert cache.evict() == 1
+    assert os.path.exists(oldest)
+    assert not os.path.exists(middle)
+    assert os.path.exists(newest)
+
+def test_evict_keeps_total_size_under_cap(tmp_path):
+    cache = make_cache(tmp_path, 25)
+    paths = [put(cache, f"{i:02d}key", 10, 100 - i) for i in range(5)]
+    cache.save_stats()
+    leftover_temp = cache.temp_path("99key")
+    assert cache.evict() == 3
+    assert [os.path.exists(path) for path in paths] == [False, False, False, True, True]
+    # 統計ファイルと書き込み中の一時ファイルは削除の対象外
+    assert os.path.exists(os.path.join(cache.root, disk_cache.STATS_FILENAME))
+    assert os.path.exists(leftover_temp)
+
+def test_evict_does_nothing_under_cap(tmp_path):
+    cache = make_cache(tmp_path, 100)
+    paths = [put(cache, f"{i:02d}key", 10, i) for i in range(3)]
+    assert cache.evict() == 0
+    assert all(os.path.exists(path) for path in paths)
+
+def test_make_key_separates_parts():
+    assert disk_cache.make_key("ab", "c") != disk_cache.make_key("a", "bc")
+    assert disk_cache.make_key("a", 1) == disk_cache.make_key("a", "1")
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# DESCRIPTION: gemini_client の応答キャッシュの有効期限 (TTL) を確かめます。
+
+import json
+import os
+import time
+
+import pytest
+
+import gemini_client
+
+@pytest.fixture
+def response_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(gemini_client._response_cache, "root", str(tmp_path / "gemini_responses"))
+    monkeypatch.setattr(gemini_client, "RESPONSE_CACHE_MODE", "")
+    return gemini_client._response_cache
+
+def test_cached_response_within_ttl(response_cache):
+    key = gemini_client.response_cache_key("プロンプト", "model-a")
+    gemini_client._cache_store(key, 60, "model-a", "応答", {"prompt_tokens": 3, "output_tokens": 5})
+    entry = gemini_client._cache_lookup(key, 60, cache_refresh=False)
+    assert entry["text"] == "応答"
+    assert entry["usage"] == {"prompt_tokens": 3, "output_tokens": 5}
+
+def test_expired_response_is_dropped(response_cache):
+    key = gemini_client.response_cache_key("プロンプト", "model-a")
+    gemini_client._cache_store(key, 60, "model-a", "応答", None)
+    path = response_cache.path_for(key)
+    with open(path, 'r', encoding='utf-8') as f:
+        entry = json.load(f)
+    entry["created"] = time.time() - 120
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(entry, f)
+    assert gemini_client._cache_lookup(key, 60, cache_refresh=False) is None
+    assert not os.path.exists(path)
+
+def test_refresh_and_no_ttl_skip_the_cache(response_cache):
+    key = gemini_client.response_cache_key("プロンプト", "model-a")
+    gemini_client._cache_store(key, 60, "model-a", "応答", None)
+    assert gemini_client._cache_lookup(key, 60, cache_refresh=True) is None
+    assert gemini_client._cache_lookup(key, None, cache_refresh=False) is None
+    # cache_ttl を指定しなければ保存もしない
+    other = gemini_client.response_cache_key("別のプロンプト", "model-a")
+    gemini_client._cache_store(other, None, "model-a", "応答", None)
+    assert not os.path.exists(response_cache.path_for(other))
+
+def test_cache_key_depends_on_model_and_config():
+    base = gemini_client.response_cache_key("p", "model-a", {"temperature": 0.5})
+    assert base != gemini_client.response_cache_key("p", "model-b", {"temperature": 0.5})
+    assert base != gemini_client.response_cache_key("p", "model-a", {"temperature": 0.9})
+    assert base == gemini_client.response_cache_key("p", "model-a", {"temperature": 0.5})
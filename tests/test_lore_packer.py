@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# DESCRIPTION: lore_packer が関連度の高い節からトークン予算の範囲で背景資料を詰め込むことを確かめます。
+
+import lore_packer
+
+LORE = {
+    "地理.md": "# 北の山脈\n\n北の山脈には氷の竜が眠っている。竜の洞窟は山頂にある。\n\n"
+               "# 南の港町\n\n南の港町は交易で栄え、商人ギルドが治めている。\n",
+    "人物.md": "# アリア\n\n剣士アリアは氷の竜を討つために旅をしている。\n\n"
+               "# ボルド\n\n魔術師ボルドは港町の商人ギルドに雇われている。\n",
+    "重複.md": "# 北の山脈\n\n北の山脈には氷の竜が眠っている。竜の洞窟は山頂にある。\n",
+}
+
+def test_estimate_tokens_counts_wide_and_ascii_characters():
+    assert lore_packer.estimate_tokens("竜の洞窟") == 4
+    assert lore_packer.estimate_tokens("abcdefgh") == 2
+    assert lore_packer.estimate_tokens("竜abcde") == 1 + 2
+
+def test_split_sections_on_headings_and_rules():
+    sections = lore_packer.split_sections("前書き\n\n# 一\n\n本文1\n\n---\n\n本文2\n\n## 二\n\n本文3\n")
+    assert sections == ["前書き", "# 一\n\n本文1", "本文2", "## 二\n\n本文3"]
+
+def test_split_sections_breaks_long_sections_at_paragraphs():
+    text = "# 長い節\n\n" + "\n\n".join("あ" * 30 for _ in range(5))
+    sections = lore_packer.split_sections(text, max_chars=70)
+    assert all(len(section) <= 70 for section in sections)
+    assert "".join(sections).replace("\n", "") == text.replace("\n", "")
+
+def test_pack_stays_within_budget_and_prefers_relevant_sections():
+    budget = 60
+    packed, used = lore_packer.pack_lore(LORE, "氷の竜を討つ剣士の物語", budget)
+    assert used <= budget
+    chosen = [section for sections in packed.values() for section in sections]
+    assert used == sum(lore_packer.estimate_tokens(section) for section in chosen)
+    assert any("氷の竜が眠っている" in section for section in chosen)
+    assert any("剣士アリア" in section for section in chosen)
+    assert not any("商人ギルド" in section for section in chosen)
+
+def test_pack_uses_duplicates_once_and_keeps_original_order():
+    packed, _ = lore_packer.pack_lore(LORE, "竜", 10_000)
+    # 全部入る予算では、重複した節だけが除かれ、資料・節の元の順番に並ぶ
+    assert list(packed) == ["地理.md", "人物.md"]
+    assert [section.splitlines()[0] for section in packed["地理.md"]] == ["# 北の山脈", "# 南の港町"]
+    assert [section.splitlines()[0] for section in packed["人物.md"]] == ["# アリア", "# ボルド"]
+
+def test_pack_skips_sections_larger_than_the_remaining_budget():
+    lore = {"a.md": "# 大\n\n" + "竜" * 100 + "\n\n# 小\n\n竜の話。\n"}
+    packed, used = lore_packer.pack_lore(lore, "竜", 20)
+    assert packed == {"a.md": ["# 小\n\n竜の話。"]}
+    assert used == lore_packer.estimate_tokens("# 小\n\n竜の話。")
+
+def test_pack_empty_lore_or_zero_budget():
+    assert lore_packer.pack_lore({}, "竜") == ({}, 0)
+    assert lore_packer.pack_lore(LORE, "竜", 0) == ({}, 0)
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# DESCRIPTION: markdown_text の直接抽出が、従来の markdown + BeautifulSoup の結果と一致することを確かめます。
+
+import pytest
+
+pytest.importorskip("markdown")
+pytest.importorskip("bs4")
+
+import markdown_text
+
+SAMPLES = {
+    "見出しと段落": "# 第1話 始まり\n\n雨が降っていた。\n彼は傘を持たずに歩いた。\n\n## 二\n\n次の日。\n",
+    "強調とリンク": "これは **重要** で、*少し* 大事。[地図](https://example.com/map) と ![挿絵](a.png)。\n",
+    "リスト": "- 剣\n- 盾\n    - 小さな盾\n\n1. 起きる\n2. 戦う\n",
+    "引用と区切り線": "> 古い言い伝え\n> 二行目\n\n---\n\n本文。\n",
+    "コード": "前置き\n\n```python\nif a < b and c > d:\n    print('&amp;')\n```\n\n`x < y` のとき\n",
+    "表": "| 名前 | 役割 |\n|------|------|\n| アリア | 剣士 |\n| ボルド | 魔術師 |\n",
+    "文字参照と記号": "A &amp; B &copy; 2025 &#x41; &unknown; 5 < 6 & 7 > 3\n",
+    "インラインHTML": "彼は<span class=\"x\">静かに</span>言った。<br>改行<!-- 注釈 -->あり。\n",
+    "HTMLブロック": "<div>\n生のHTML <b>太字</b>\n</div>\n\n後ろの段落。\n",
+    "空白だけの行": "一行目   \n\n\n\n   \n二行目\t\n",
+    "メールアドレス": "連絡先: <someone@example.com>\n",
+    "空": "",
+}
+
+@pytest.mark.parametrize("name", SAMPLES)
+def test_matches_reference_extractor(name):
+    # verify() と同じく、空行と連続する空白をまとめてから比較する
+    text = SAMPLES[name]
+    expected = markdown_text.normalize_plain_text(markdown_text._reference_markdown_to_text(text))
+    assert markdown_text.normalize_plain_text(markdown_text.markdown_to_text(text)) == expected
+
+@pytest.mark.parametrize("name", SAMPLES)
+def test_extract_plain_text_matches_normalized_reference(name):
+    text = SAMPLES[name]
+    markdown_text.clear_memo()
+    expected = markdown_text.normalize_plain_text(markdown_text._reference_markdown_to_text(text))
+    assert markdown_text.extract_plain_text(text) == expected
+
+def test_memo_returns_same_text_and_is_bounded(monkeypatch):
+    markdown_text.clear_memo()
+    monkeypatch.setattr(markdown_text, "MEMO_MAX_ENTRIES", 2)
+    first = markdown_text.extract_plain_text(SAMPLES["見出しと段落"])
+    assert markdown_text.extract_plain_text(SAMPLES["見出しと段落"]) == first
+    for name in ("強調とリンク", "リスト", "表"):
+        markdown_text.extract_plain_text(SAMPLES[name])
+    assert len(markdown_text._memo) == 2
+    markdown_text.clear_memo()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# DESCRIPTION: pipeline_dag の依存順の実行、fail-fast、実行記録からの再開を確かめます。
+
+import threading
+import time
+
+import pytest
+
+import pipeline_dag
+
+class Calls:
+    """ステージの呼び出し回数を数える"""
+
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def stage(self, name: str, value=None, seconds: float = 0.0, error: Exception | None = None):
+        def run(*args):
+            with self._lock:
+                self.counts[name] = self.counts.get(name, 0) + 1
+            time.sleep(seconds)
+            if error is not None:
+                raise error
+            return value if value is not None else [name, *args]
+        return run
+
+def test_stages_receive_dependency_results_in_order():
+    calls = Calls()
+    pipeline = pipeline_dag.Pipeline([
+        pipeline_dag.Stage("a", calls.stage("a", "A")),
+        pipeline_dag.Stage("b", calls.stage("b", "B"), deps=("a",)),
+        pipeline_dag.Stage("c", calls.stage("c"), deps=("a", "b")),
+    ])
+    assert pipeline.run()["c"] == ["c", "A", "B"]
+    assert pipeline.order == ["a", "b", "c"]
+
+def test_invalid_graphs_are_rejected():
+    noop = lambda *_: None
+    with pytest.raises(ValueError):
+        pipeline_dag.Pipeline([pipeline_dag.Stage("a", noop, deps=("missing",))])
+    with pytest.raises(ValueError):
+        pipeline_dag.Pipeline([pipeline_dag.Stage("a", noop, deps=("b",)), pipeline_dag.Stage("b", noop, deps=("a",))])
+    with pytest.raises(ValueError):
+        pipeline_dag.Pipeline([pipeline_dag.Stage("a", noop), pipeline_dag.Stage("a", noop)])
+
+def test_fail_fast_raises_first_failure_and_skips_dependents():
+    calls = Calls()
+    pipeline = pipeline_dag.Pipeline([
+        pipeline_dag.Stage("broken", calls.stage("broken", error=pipeline_dag.StageFailed("壊れた"))),
+        pipeline_dag.Stage("slow", calls.stage("slow", "S", seconds=0.3)),
+        pipeline_dag.Stage("after_broken", calls.stage("after_broken"), deps=("broken",)),
+        pipeline_dag.Stage("after_slow", calls.stage("after_slow"), deps=("slow",)),
+    ])
+    with pytest.raises(pipeline_dag.StageFailed, match="壊れた"):
+        pipeline.run()
+    # 実行中だったステージは終わるまで待つが、その後続は始めない
+    assert calls.counts == {"broken": 1, "slow": 1}
+
+def test_async_stage_failure_cancels_waiting_stages():
+    calls = Calls()
+
+    async def fail(_):
+        raise RuntimeError("ネットワーク")
+
+    pipeline = pipeline_dag.Pipeline([
+        pipeline_dag.Stage("select", calls.stage("select", "story")),
+        pipeline_dag.Stage("fetch", fail, deps=("select",), kind="async"),
+        pipeline_dag.Stage("publish", calls.stage("publish"), deps=("fetch",)),
+    ])
+    with pytest.raises(RuntimeError, match="ネットワーク"):
+        pipeline.run()
+    assert "publish" not in calls.counts
+
+def build(calls: Calls, record, resume: bool, fail_second: bool = False, artifact=None):
+    return pipeline_dag.Pipeline([
+        pipeline_dag.Stage("first", calls.stage("first", "F"),
+                           artifacts=(lambda _: [str(artifact)]) if artifact else None),
+        pipeline_dag.Stage("second", calls.stage("second", "S", error=RuntimeError("失敗") if fail_second else None),
+                           deps=("first",)),
+    ], record=record, resume=resume)
+
+def test_resume_skips_stages_that_already_succeeded(tmp_path):
+    path = str(tmp_path / "run.json")
+    calls = Calls()
+    with pytest.raises(RuntimeError):
+        build(calls, pipeline_dag.RunRecord("daily", {"date": "2026-10-16"}, path), resume=False, fail_second=True).run()
+
+    record = pipeline_dag.RunRecord("daily", {"date": "2026-10-16"}, path)
+    assert record.load()
+    assert record.stages["second"]["status"] == "failed"
+    assert not record.completed(["first", "second"])
+    pipeline = build(calls, record, resume=True)
+    assert pipeline.run() == {"first": "F", "second": "S"}
+    assert pipeline.skipped == ["first"]
+    assert calls.counts == {"first": 1, "second": 2}
+    assert record.completed(["first", "second"])
+
+def test_resume_reruns_stage_when_artifact_changed(tmp_path):
+    path = str(tmp_path / "run.json")
+    artifact = tmp_path / "video.mp4"
+    artifact.write_bytes(b"v1")
+    calls = Calls()
+    with pytest.raises(RuntimeError):
+        build(calls, pipeline_dag.RunRecord("daily", {}, path), resume=False, fail_second=True, artifact=artifact).run()
+
+    artifact.write_bytes(b"v2")
+    record = pipeline_dag.RunRecord("daily", {}, path)
+    assert record.load()
+    pipeline = build(calls, record, resume=True, artifact=artifact)
+    pipeline.run()
+    assert pipeline.skipped == []
+    assert calls.counts == {"first": 2, "second": 2}
+
+def test_record_from_other_params_or_run_is_not_reused(tmp_path):
+    path = str(tmp_path / "run.json")
+    calls = Calls()
+    build(calls, pipeline_dag.RunRecord("daily", {"date": "2026-10-15"}, path), resume=False).run()
+    # 実行条件 (日付) が違う記録は読み込まない
+    assert not pipeline_dag.RunRecord("daily", {"date": "2026-10-16"}, path).load()
+    # 新しい実行の記録 (開始時刻が違う) には、前回の結果を使い回さない
+    fresh = pipeline_dag.RunRecord("daily", {"date": "2026-10-15"}, path)
+    assert fresh.load()
+    fresh.started = "another-run"
+    pipeline = build(calls, fresh, resume=True)
+    pipeline.run()
+    assert pipeline.skipped == []
+    assert calls.counts == {"first": 2, "second": 2}
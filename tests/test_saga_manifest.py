@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# DESCRIPTION: saga_manifest が更新時刻の変わったディレクトリ・ファイルだけを読み直すことを確かめます。
+
+import os
+
+import pytest
+
+import saga_manifest
+
+def write(path, text: str, mtime_ns: int | None = None) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text, encoding='utf-8')
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+@pytest.fixture
+def collection(tmp_path):
+    root = tmp_path / "saga"
+    write(root / "光の章" / "第1話_始まり.md", "# 始まり\n")
+    write(root / "光の章" / "第2話_旅立ち.md", "# 旅立ち\n")
+    write(root / "序章.md", "# 序章\n")
+    write(root / "メモ.txt", "対象外\n")
+    write(root / ".下書き.md", "隠しファイルも対象外\n")
+    return root
+
+def new_manifest(root, tmp_path) -> saga_manifest.SagaManifest:
+    return saga_manifest.SagaManifest(str(root), manifest_path=str(tmp_path / "manifest.json"))
+
+def test_first_refresh_lists_markdown_files(collection, tmp_path):
+    manifest = new_manifest(collection, tmp_path)
+    assert manifest.refresh()
+    assert sorted(manifest.files) == ["光の章/第1話_始まり.md", "光の章/第2話_旅立ち.md", "序章.md"]
+    assert manifest.hashed_files == 3
+    entry = manifest.get(str(collection / "光の章" / "第2話_旅立ち.md"))
+    assert (entry["series"], entry["episode"]) == ("光の章", 2)
+    assert manifest.series() == ["", "光の章"]
+
+def test_unchanged_collection_is_not_rescanned(collection, tmp_path):
+    manifest = new_manifest(collection, tmp_path)
+    manifest.refresh()
+    assert not manifest.refresh()
+    assert (manifest.scanned_dirs, manifest.hashed_files) == (0, 0)
+
+def test_changed_mtime_rehashes_only_that_file(collection, tmp_path):
+    manifest = new_manifest(collection, tmp_path)
+    manifest.refresh()
+    story = collection / "光の章" / "第1話_始まり.md"
+    old_hash = manifest.get(str(story))["sha256"]
+    # 同じサイズで内容だけ変え、更新時刻を確実に進める
+    mtime_ns = story.stat().st_mtime_ns + 1_000_000_000
+    write(story, "# 始めり\n", mtime_ns)
+    assert manifest.refresh()
+    assert manifest.hashed_files == 1
+    assert manifest.get(str(story))["sha256"] != old_hash
+    assert manifest.get(str(story))["mtime_ns"] == mtime_ns
+
+def test_added_and_removed_files_are_picked_up(collection, tmp_path):
+    manifest = new_manifest(collection, tmp_path)
+    manifest.refresh()
+    os.remove(collection / "序章.md")
+    write(collection / "光の章" / "第3話_嵐.md", "# 嵐\n")
+    assert manifest.refresh()
+    assert sorted(manifest.files) == ["光の章/第1話_始まり.md", "光の章/第2話_旅立ち.md", "光の章/第3話_嵐.md"]
+    assert manifest.hashed_files == 1
+
+def test_saved_manifest_is_reused(collection, tmp_path):
+    manifest = new_manifest(collection, tmp_path)
+    manifest.refresh()
+    manifest.save()
+    reloaded = new_manifest(collection, tmp_path)
+    assert reloaded.load()
+    assert not reloaded.refresh()
+    assert reloaded.hashed_files == 0
+    assert reloaded.paths("光の章") == [str(collection / "光の章" / "第1話_始まり.md"),
+                                       str(collection / "光の章" / "第2話_旅立ち.md")]
+
+@pytest.mark.parametrize("filename, episode", [
+    ("第12話_決戦.md", 12), ("ep03_night.md", 3), ("episode-7.md", 7), ("05_朝.md", 5), ("番外編.md", None),
+])
+def test_parse_episode(filename, episode):
+    assert saga_manifest.parse_episode(filename) == episode
@@ -0,0 +1,213 @@
+#!/home/hirosi/my_gemini_project/venv/bin/python
+# -*- coding: utf-8 -*-
+# DESCRIPTION: ImageMagickを起動せずに、Pillowでテキストを画像化するプロセス内ラスタライザです。
+
+import io
+import os
+import sys
+import subprocess
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+# --- 定数 ---
+# ImageMagickのフォント名から実ファイルを解決できない場合に探す日本語フォント
+FALLBACK_FONT_FILES = [
+    "/usr/share/fonts/truetype/takao-gothic/TakaoPGothic.ttf",
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/fonts-japanese-gothic.ttf",
+    "/usr/share/fonts/opentype/ipafont-gothic/ipagp.ttf",
+]
+MIN_POINTSIZE = 8
+# 文字幅を測る基準のポイントサイズと、描画用に保持するフォントサイズの上限
+LAYOUT_POINTSIZE = 100
+MAX_CACHED_FONT_SIZES = 16
+PNG_COMPRESS_LEVEL = 3
+
+# --- ヘルパー関数 ---
+def resolve_font_file(font_name: str) -> str | None:
+    """ImageMagick形式のフォント名 (例: 'Takao-Pゴシック') をフォントファイルのパスに解決する"""
+    if os.path.isfile(font_name):
+        return font_name
+
+    # ImageMagickはフォント名の空白を '-' で表すので、両方の表記でfontconfigに問い合わせる
+    for name in dict.fromkeys([font_name, font_name.replace('-', ' ')]):
+        try:
+            result = subprocess.run(
+                ['fc-match', '-f', '%{file}', f'{name}:lang=ja'],
+                check=True, capture_output=True, text=True, encoding='utf-8'
+            )
+        except (FileNotFoundError, subprocess.CalledProcessError):
+            break
+        if result.stdout and os.path.isfile(result.stdout):
+            return result.stdout
+
+    for path in FALLBACK_FONT_FILES:
+        if os.path.isfile(path):
+            return path
+    return None
+
+def _is_breakable_anywhere(char: str) -> bool:
+    """単語の途中でも改行してよい文字 (和文・全角文字) ならTrue"""
+    return ord(char) >= 0x2E80
+
+def _split_tokens(text: str) -> list[str]:
+    """改行位置の候補ごとにテキストを分割する。欧文は単語単位、和文は1文字単位"""
+    tokens = []
+    word = ""
+    for char in text:
+        if char == ' ' or _is_breakable_anywhere(char):
+            if word:
+                tokens.append(word)
+                word = ""
+            tokens.append(char)
+        else:
+            word += char
+    if word:
+        tokens.append(word)
+    return tokens
+
+class TextRasterizer:
+    """1つのフォントファイルを読み込んだまま、テキスト画像を繰り返し描画するラスタライザ。
+    レイアウトは基準サイズで測った文字幅を拡大縮小して求めるため、
+    ポイントサイズを探索しても実際にフォントを読み込むのは描画するサイズだけになる。"""
+
+    def __init__(self, font_path: str):
+        self.font_path = font_path
+        with open(font_path, 'rb') as f:
+            self._font_data = f.read()
+        self._layout_font = self._load(LAYOUT_POINTSIZE)
+        ascent, descent = self._layout_font.getmetrics()
+        self._layout_line_height = ascent + descent
+        self._advances = {}
+        self._fonts = {}
+
+    def _load(self, pointsize: int):
+        return ImageFont.truetype(io.BytesIO(self._font_data), pointsize)
+
+    def font(self, pointsize: int):
+        """描画用に指定サイズのフォントを返す (サイズごとに1度だけ読み込む)"""
+        font = self._fonts.get(pointsize)
+        if font is None:
+            if len(self._fonts) >= MAX_CACHED_FONT_SIZES:
+                self._fonts.clear()
+            font = self._load(pointsize)
+            self._fonts[pointsize] = font
+        return font
+
+    def text_width(self, text: str, pointsize: int) -> float:
+        """文字幅のキャッシュを使ってテキストの描画幅を求める"""
+        advances = self._advances
+        width = 0.0
+        for char in text:
+            advance = advances.get(char)
+            if advance is None:
+                advance = self._layout_font.getlength(char)
+                advances[char] = advance
+            width += advance
+        return width * pointsize / LAYOUT_POINTSIZE
+
+    def line_height(self, pointsize: int, interline_spacing: int = 0) -> int:
+        return round(self._layout_line_height * pointsize / LAYOUT_POINTSIZE) + interline_spacing
+
+    def wrap(self, text: str, pointsize: int, max_width: int | None) -> list[str]:
+        """ImageMagickの caption: と同様に、幅に収まるよう貪欲に改行する"""
+        lines = []
+        for paragraph in text.split('\n'):
+            if max_width is None:
+                lines.append(paragraph)
+                continue
+            line, line_width = "", 0.0
+            for token in _split_tokens(paragraph):
+                token_width = self.text_width(token, pointsize)
+                if line and line_width + token_width > max_width:
+                    lines.append(line.rstrip(' '))
+                    line, line_width = "", 0.0
+                    if token == ' ':
+                        continue
+                # 1語だけで幅を超える場合は文字単位で折り返す
+                if token_width > max_width:
+                    for char in token:
+                        char_width = self.text_width(char, pointsize)
+                        if line and line_width + char_width > max_width:
+                            lines.append(line)
+                            line, line_width = "", 0.0
+                        line += char
+                        line_width += char_width
+                    continue
+                line += token
+                line_width += token_width
+            lines.append(line.rstrip(' '))
+        return lines
+
+    def _fits(self, text: str, pointsize: int, width: int, height: int) -> bool:
+        lines = self.wrap(text, pointsize, width)
+        if len(lines) * self.line_height(pointsize) > height:
+            return False
+        return all(self.text_width(line, pointsize) <= width for line in lines)
+
+    def fit_pointsize(self, text: str, width: int, height: int) -> int:
+        """テキストが枠内に収まる最大のポイントサイズを二分探索で求める (caption: の自動サイズ)"""
+        low, high = MIN_POINTSIZE, max(MIN_POINTSIZE, height)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self._fits(text, mid, width, height):
+                low = mid
+            else:
+                high = mid - 1
+        return low
+
+    def draw_lines(self, lines: list[str], width: int, height: int, pointsize: int,
+                   interline_spacing: int = 0):
+        """行のリストを黒背景・白文字で中央揃えに描画したグレースケール画像を返す"""
+        image = Image.new('L', (width, height), 0)
+        draw = ImageDraw.Draw(image)
+        font = self.font(pointsize)
+        line_height = self.line_height(pointsize, interline_spacing)
+        block_height = len(lines) * line_height - interline_spacing
+        y = (height - block_height) / 2
+        for line in lines:
+            x = (width - self.text_width(line, pointsize)) / 2
+            draw.text((x, y), line, font=font, fill=255)
+            y += line_height
+        return image
+
+    def render_caption(self, text: str, width: int, height: int):
+        """`convert -size WxH -gravity center caption:TEXT` 相当の画像を返す"""
+        pointsize = self.fit_pointsize(text, width, height)
+        return self.draw_lines(self.wrap(text, pointsize, width), width, height, pointsize)
+
+    def render_annotate(self, text: str, width: int, height: int, pointsize: int,
+                        interline_spacing: int = 0):
+        """`convert -size WxH xc:black -gravity center -annotate 0 TEXT` 相当の画像を返す (自動改行なし)"""
+        lines = self.wrap(text, pointsize, None)
+        return self.draw_lines(lines, width, height, pointsize, interline_spacing)
+
+_rasterizers = {}
+
+def get_rasterizer(font_name: str) -> TextRasterizer | None:
+    """フォント名に対応するラスタライザを返す。プロセス内で1度だけフォントを解決・読み込みする。
+    Pillowかフォントファイルが見つからない場合はNone (呼び出し側でImageMagickにフォールバックする)"""
+    if not PIL_AVAILABLE:
+        return None
+    if font_name not in _rasterizers:
+        font_path = resolve_font_file(font_name)
+        if font_path:
+            try:
+                rasterizer = TextRasterizer(font_path)
+            except OSError as e:
+                print(f"警告: フォント '{font_path}' を読み込めませんでした: {e}", file=sys.stderr)
+                rasterizer = None
+        else:
+            print(f"警告: フォント '{font_name}' のファイルが見つかりません。", file=sys.stderr)
+            rasterizer = None
+        _rasterizers[font_name] = rasterizer
+    return _rasterizers[font_name]
+
+def save_png(image, output_path: str) -> None:
+    """画像をPNGとして保存する"""
+    image.save(output_path, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
@@ -2,20 +2,25 @@
 
 import json
 import os
+import sys
 import random
 import asyncio
 from datetime import datetime, timedelta
 
+# 共通のGeminiクライアント (scripts/gemini_client.py) をインポート
 # aiohttp が必要なので、必ず仮想環境で pip install aiohttp を実行してください
-import aiohttp
+scripts_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if scripts_dir not in sys.path:
+    sys.path.append(scripts_dir)
+import gemini_client
 
 # ==============================================================================
 # グローバル変数と設定（必要に応じて調整）
 # ==============================================================================
-# Gemini API のエンドポイント
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
-# API キーは環境変数から取得することを推奨
-API_KEY = os.getenv("GEMINI_API_KEY", "") # 環境変数に GEMINI_API_KEY を設定してください
+# 使用するモデル
+GEMINI_MODEL = "gemini-2.0-flash"
+# API キーは apiファイル または 環境変数 GEMINI_API_KEY から取得する
+API_KEY = gemini_client.get_api_key() or ""
 
 # ==============================================================================
 # ヘルパー関数
@@ -25,50 +30,34 @@ async def call_gemini_api(prompt, api_key):
     """
     Gemini API を呼び出してテキストを生成する非同期関数。
     """
-    headers = {
-        'Content-Type': 'application/json',
-    }
-    payload = {
-        "contents": [{"role": "user", "parts": [{"text": prompt}]}],
-        "generationConfig": {
-            "responseMimeType": "application/json",
-            "responseSchema": {
-                "type": "ARRAY",
-                "items": {
-                    "type": "OBJECT",
-                    "properties": {
-                        "featureName": {"type": "STRING"},
-                        "description": {"type": "STRING"},
-                        "priority": {"type": "STRING", "enum": ["Low", "Medium", "High"]},
-                        "estimatedEffortDays": {"type": "NUMBER"}
-                    },
-                    "required": ["featureName", "description", "priority", "estimatedEffortDays"]
-                }
+    generation_config = {
+        "responseMimeType": "application/json",
+        "responseSchema": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "featureName": {"type": "STRING"},
+                    "description": {"type": "STRING"},
+                    "priority": {"type": "STRING", "enum": ["Low", "Medium", "High"]},
+                    "estimatedEffortDays": {"type": "NUMBER"}
+                },
+                "required": ["featureName", "description", "priority", "estimatedEffortDays"]
             }
         }
     }
 
-    # API キーを URL に追加
-    api_url_with_key = f"{GEMINI_API_URL}?key={api_key}"
-
+    json_string = None
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(api_url_with_key, headers=headers, json=payload) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    if result.get("candidates") and result["candidates"][0].get("content") and result["candidates"][0]["content"].get("parts"):
-                        # JSON 文字列として返されるのでパース
-                        json_string = result["candidates"][0]["content"]["parts"][0]["text"]
-                        return json.loads(json_string)
-                    else:
-                        print(f"Gemini API から予期しないレスポンス構造: {result}")
-                        return None
-                else:
-                    error_text = await response.text()
-                    print(f"Gemini API エラー: ステータス {response.status}, レスポンス: {error_text}")
-                    return None
-    except aiohttp.ClientError as e:
-        print(f"HTTP リクエストエラー: {e}")
+        # 接続の再利用と一時的なエラーの再試行は gemini_client が行う
+        json_string = await gemini_client.generate_async(
+            prompt, model_name=GEMINI_MODEL, generation_config=generation_config,
+            api_key=api_key, label="daily_feature_proposer"
+        )
+        # JSON 文字列として返されるのでパース
+        return json.loads(json_string)
+    except gemini_client.GeminiAPIError as e:
+        print(f"Gemini API エラー: {e}")
         return None
     except json.JSONDecodeError as e:
         print(f"JSON デコードエラー: {e}, レスポンス: {json_string}")
@@ -166,5 +155,11 @@ if __name__ == "__main__":
     class DummySelf:
         pass
     
-    asyncio.run(execute_evolution_step(DummySelf()))
+    async def run():
+        try:
+            await execute_evolution_step(DummySelf())
+        finally:
+            await gemini_client.close_async()
+
+    asyncio.run(run())
 